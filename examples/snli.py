@@ -13,7 +13,7 @@ from spodernet.hooks import AccuracyHook, LossHook, ETAHook
 from spodernet.preprocessing.pipeline import Pipeline
 from spodernet.preprocessing.processors import AddToVocab, CreateBinsByNestedLength, SaveLengthsToState, ConvertTokenToIdx, StreamToHDF5, Tokenizer, NaiveNCharTokenizer
 from spodernet.preprocessing.processors import JsonLoaderProcessors, DictKey2ListMapper, RemoveLineOnJsonValueCondition, ToLower
-from spodernet.preprocessing.batching import StreamBatcher
+from spodernet.preprocessing.batching import StreamBatcher, ShardCacheRegistry
 from spodernet.utils.logger import Logger, LogLevel
 from spodernet.utils.global_config import Config, Backends
 from spodernet.utils.util import get_data_path
@@ -178,10 +178,12 @@ def main():
     if Config.backend == Backends.TENSORFLOW:
         from spodernet.backends.tfbackend import TensorFlowConfig
         TensorFlowConfig.init_batch_size(batch_size)
-    train_batcher = StreamBatcher('snli_example', 'snli_train', batch_size, randomize=True, loader_threads=8)
+    # the three batchers split one shard cache budget; dev and test stay in memory between evaluations
+    ShardCacheRegistry.set_budget(4)
+    train_batcher = StreamBatcher('snli_example', 'snli_train', batch_size, randomize=True, loader_threads=8, shared_cache=True)
     #train_batcher.subscribe_to_batch_prepared_event(SomeExpensivePreprocessing())
-    dev_batcher = StreamBatcher('snli_example', 'snli_dev', batch_size)
-    test_batcher  = StreamBatcher('snli_example', 'snli_test', batch_size)
+    dev_batcher = StreamBatcher('snli_example', 'snli_dev', batch_size, shared_cache=True)
+    test_batcher  = StreamBatcher('snli_example', 'snli_test', batch_size, shared_cache=True)
 
     train_batcher.subscribe_to_events(AccuracyHook('Train', print_every_x_batches=1000))
     dev_batcher.subscribe_to_events(AccuracyHook('Dev', print_every_x_batches=1000))
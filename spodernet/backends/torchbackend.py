@@ -10,14 +10,35 @@ from spodernet.utils.util import Timer
 from spodernet.utils.global_config import Config
 
 class TorchConverter(IAtBatchPreparedObservable):
-    def __init__(self, is_volatile):
+    def __init__(self, is_volatile, copy_buffers=False):
+        '''Converts the batch parts to torch variables.
+
+        Args:
+            copy_buffers: Copies parts which may share memory with buffers
+                that the batcher reuses for later batches, like the shared
+                memory slots of loader processes, so that the variables of
+                a batch stay valid when they are kept.
+        '''
         self.is_volatile = is_volatile
+        self.copy_buffers = copy_buffers
 
     def at_batch_prepared(self, str2var):
         for key in str2var.keys():
-            if 'length' in key: continue
-            if str2var[key].dtype == np.int32:
-                str2var[key] = np.int64(str2var[key])
+            if 'length' in key:
+                # narrow lengths are widened to the int32 of unnarrowed datasets
+                if str2var[key].dtype.itemsize < 4:
+                    str2var[key] = str2var[key].astype(np.int32)
+                elif self.copy_buffers:
+                    str2var[key] = np.array(str2var[key])
+                continue
+            copied = False
+            if np.issubdtype(str2var[key].dtype, np.integer):
+                # a single copy from any stored int type to torch's long
+                copied = str2var[key].dtype != np.int64
+                str2var[key] = str2var[key].astype(np.int64, copy=False)
+            if not copied and (self.copy_buffers or not str2var[key].flags.writeable):
+                # batches of memory-mapped shards are read-only views
+                str2var[key] = np.array(str2var[key])
             str2var[key] = Variable(torch.from_numpy(str2var[key]), volatile=self.is_volatile)
         return str2var
 
@@ -13,5 +13,8 @@ class IAtEpochEndObservable(object):
         raise NotImplementedError('Subclasses of IAtEpochEndObservable need to override the end_of_iter_epoch method')
 
 class IAtBatchPreparedObservable(object):
+    # observers which only transform numpy arrays may run in loader processes
+    runs_in_loader_process = False
+
     def at_batch_prepared(self, batch_parts):
         raise NotImplementedError('Subclasses of IAtBatchPreparedObservable need to override the at_batch_prepared method')
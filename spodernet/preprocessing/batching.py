@@ -1,21 +1,25 @@
 from future import standard_library
 standard_library.install_aliases()
 
-from os.path import join, exists
+from os.path import join, exists, basename
 import threading
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 
 import time
 import datetime
 import numpy as np
 import queue
 import pickle
+import traceback
+import multiprocessing
+import scipy.sparse
 
-from spodernet.utils.util import get_data_path, load_data, Timer
+from spodernet.utils.util import get_data_path, load_data_paths, to_dense, get_nbytes, RaggedArray, ShardReader, Timer
+from spodernet.utils.util import load_manifest, get_manifest_paths
 from spodernet.utils.global_config import Config, Backends
 from spodernet.hooks import ETAHook
 from spodernet.interfaces import IAtIterEndObservable, IAtEpochEndObservable, IAtEpochStartObservable, IAtBatchPreparedObservable
-from spodernet.preprocessing.processors import DictConverter
+from spodernet.preprocessing.processors import DictConverter, TrimPadding
 
 from spodernet.utils.logger import Logger
 log = Logger('batching.py.txt')
@@ -40,76 +44,174 @@ class BatcherState(object):
         self.multi_labels = None
 
 
+def concatenate_rows(x1, x2):
+    '''Joins the rows of two shards for a batch which spans both.'''
+    if isinstance(x1, RaggedArray):
+        return RaggedArray.concatenate([x1, x2])
+    elif isinstance(x1, scipy.sparse.spmatrix) or isinstance(x2, scipy.sparse.spmatrix):
+        # each shard picks its own format, so one of them may be dense
+        return scipy.sparse.vstack([scipy.sparse.csr_matrix(x1), scipy.sparse.csr_matrix(x2)], format='csr')
+    elif len(x1.shape) == 1:
+        return np.hstack([x1, x2])
+    else:
+        return np.vstack([x1, x2])
+
+
+class ShardCache(object):
+    def __init__(self, max_GB=4):
+        '''Caches the loaded shards of all loaders of a batcher.
+
+        The least recently used shards are evicted once the cache exceeds
+        its budget, but never the shard which is requested. Concurrent
+        requests for a shard which is not cached wait for a single read.
+
+        Args:
+            max_GB: Memory budget of the cache in GB.
+        '''
+        self.max_bytes = int(max_GB*(1024**3))
+        self.data = OrderedDict()
+        self.nbytes = {}
+        self.total_bytes = 0
+        self.loads = 0
+        self.loading = {}
+        self.lock = threading.Lock()
+
+    def get(self, paths):
+        '''Returns the datasets of a shard and loads them if needed.'''
+        key = tuple(paths)
+        while True:
+            with self.lock:
+                if key in self.data:
+                    # move to the most recently used end
+                    shard = self.data.pop(key)
+                    self.data[key] = shard
+                    return shard
+                if key not in self.loading:
+                    loaded = threading.Event()
+                    self.loading[key] = loaded
+                    break
+                pending = self.loading[key]
+            # another loader reads the shard already
+            pending.wait()
+
+        try:
+            # datasets in the same shard file are read with a single open;
+            # sparse matrices stay in CSR form
+            shard = load_data_paths(list(paths), keep_sparse=True)
+            with self.lock:
+                self.data[key] = shard
+                self.nbytes[key] = sum([get_nbytes(x) for x in shard])
+                self.total_bytes += self.nbytes[key]
+                self.loads += 1
+                self.evict(key)
+        finally:
+            with self.lock:
+                self.loading.pop(key, None)
+            loaded.set()
+        return shard
+
+    def evict(self, keep=None):
+        # least recently used shards first; the kept shard was used last, so
+        # it is only reached once it is the last cached shard
+        while self.total_bytes > self.max_bytes and len(self.data) > 0:
+            key, shard = self.data.popitem(last=False)
+            if key == keep:
+                self.data[key] = shard
+                break
+            self.total_bytes -= self.nbytes.pop(key)
+
+    def set_max_bytes(self, max_bytes):
+        with self.lock:
+            self.max_bytes = max_bytes
+            self.evict()
+
+    def size_GB(self):
+        return self.total_bytes/(1024.0**3.0)
+
+
+class ShardCacheRegistry(object):
+    '''Splits one process-wide memory budget between the shard caches of
+    all batchers which use a shared cache.
+
+    The budget is water-filled: a dataset which fits into its fair share
+    gets a budget of its full size, so small dev and test sets stay
+    resident between evaluations, and the rest is split evenly between
+    the larger datasets.
+    '''
+    max_GB = 8
+    caches = []
+    lock = threading.Lock()
+
+    @staticmethod
+    def set_budget(max_GB):
+        ShardCacheRegistry.max_GB = max_GB
+        ShardCacheRegistry.rebalance()
+
+    @staticmethod
+    def register(dataset_GB=None):
+        '''Returns a new shard cache with a share of the global budget.
+
+        Args:
+            dataset_GB: Size of the dataset in memory, if it is known. A
+                cache never gets a larger budget than its dataset needs.
+        '''
+        cache = ShardCache(0)
+        with ShardCacheRegistry.lock:
+            demand = float('inf') if dataset_GB is None else int(dataset_GB*(1024**3))
+            ShardCacheRegistry.caches.append((demand, cache))
+        ShardCacheRegistry.rebalance()
+        return cache
+
+    @staticmethod
+    def unregister(cache):
+        with ShardCacheRegistry.lock:
+            ShardCacheRegistry.caches = [(demand, c) for demand, c in ShardCacheRegistry.caches if c is not cache]
+        ShardCacheRegistry.rebalance()
+
+    @staticmethod
+    def rebalance():
+        with ShardCacheRegistry.lock:
+            budget = int(ShardCacheRegistry.max_GB*(1024**3))
+            caches = sorted(ShardCacheRegistry.caches, key=lambda x: x[0])
+            for i, (demand, cache) in enumerate(caches):
+                share = budget // (len(caches) - i)
+                max_bytes = int(min(demand, share))
+                budget -= max_bytes
+                cache.set_max_bytes(max_bytes)
+
+
 class DataLoaderSlave(threading.Thread):
-    def __init__(self, stream_batcher, batchidx2paths, batchidx2start_end, randomize=False, paths=None, shard2batchidx=None, seed=None, shard_fractions=None, cache_size_GB=4):
+    def __init__(self, stream_batcher, batchidx2paths, batchidx2start_end, cache, randomize=False, paths=None, shard2batchidx=None, stream_from_disk=False, batch_size=None, batch_buffers=None):
         super(DataLoaderSlave, self).__init__()
-        if randomize:
-            assert seed is not None, 'For randomized data loading a seed needs to be set!'
-        self.cache_size_GB = cache_size_GB
         self.stream_batcher = stream_batcher
+        self.batch_size = batch_size or stream_batcher.batch_size
         self.batchidx2paths = batchidx2paths
         self.batchidx2start_end = batchidx2start_end
-        self.current_data = {}
+        # loader threads share the cache of their batcher
+        self.cache = cache
         self.randomize = randomize
         self.num_batches = len(list(batchidx2paths.keys()))
-        self.rdm = np.random.RandomState(234+seed)
-        self.shard_fractions = None
         self.shard2batchidx = shard2batchidx
         self.paths = paths
-        self._stop = threading.Event()
+        # threading.Thread uses _stop internally, so the event needs another name
+        self._stop_event = threading.Event()
         self.daemon = True
         self.t = Timer()
         self.batches_processes = 0
-        self.cache_order = []
+        # without randomization batches can be read directly from disk
+        self.reader = ShardReader() if stream_from_disk and not randomize else None
+        # shuffled dense rows are gathered into a ring of reused buffers; a
+        # buffer is only reused once its batch cannot be in use anymore
+        if batch_buffers is None:
+            batch_buffers = stream_batcher.prefetch_batches + 2
+        self.batch_buffers = [{} for i in range(batch_buffers)]
+        self.batch_buffer_idx = 0
 
     def stop(self):
-        self._stop.set()
+        self._stop_event.set()
 
     def stopped(self):
-        return self._stop.isSet()
-
-    def load_files_if_needed(self, current_paths):
-        if isinstance(current_paths[0], list):
-            for paths in current_paths:
-                shuffle_idx = None
-                for path in paths:
-                    if path not in self.current_data:
-                        ordered_data = load_data(path)
-                        self.cache_order.append(path)
-                        if shuffle_idx == None and self.randomize:
-                            shuffle_idx = np.arange(ordered_data.shape[0])
-                            self.rdm.shuffle(shuffle_idx)
-
-                        if self.randomize:
-                            # be careful with pointers here, or we have trouble
-                            # with garbage collection
-                            data = np.copy(ordered_data[shuffle_idx])
-                            del ordered_data
-                            order_data = None
-                            self.current_data[path] = data
-                        else:
-                            self.current_data[path] = ordered_data
-
-                shuffle_idx = None
-        else:
-            shuffle_idx = None
-            for path in current_paths:
-                if path not in self.current_data:
-                    ordered_data = load_data(path)
-                    self.cache_order.append(path)
-                    if shuffle_idx is None and self.randomize:
-                        shuffle_idx = np.arange(ordered_data.shape[0])
-                        self.rdm.shuffle(shuffle_idx)
-
-                    if self.randomize:
-                        # be careful with pointers here, or we have trouble
-                        # with garbage collection
-                        data = np.copy(ordered_data[shuffle_idx])
-                        del ordered_data
-                        order_data = None
-                        self.current_data[path] = data
-                    else:
-                        self.current_data[path] = ordered_data
+        return self._stop_event.is_set()
 
     def create_batch_parts(self, current_paths, start, end):
         # index loaded data for minibatch
@@ -117,39 +219,90 @@ class DataLoaderSlave(threading.Thread):
         if isinstance(current_paths[0], list):
             start = start[0]
             end = end[1]
+            shard1 = self.cache.get(current_paths[0])
+            shard2 = self.cache.get(current_paths[1])
+            for x1, x2 in zip(shard1, shard2):
+                batch_parts.append(concatenate_rows(x1[start:], x2[:end]))
+        else:
+            for x in self.cache.get(current_paths):
+                batch_parts.append(x[start:end])
+
+        # ragged data is padded to the max length of this batch only and
+        # sparse data is densified for the rows of this batch only
+        return [to_dense(x) for x in batch_parts]
+
+    def get_batch_buffer(self, buffers, i, shape, dtype):
+        if i not in buffers or buffers[i].shape != shape or buffers[i].dtype != dtype:
+            buffers[i] = np.empty(shape, dtype=dtype)
+        return buffers[i]
+
+    def gather_batch_parts(self, segments):
+        # gathers the rows of a shuffled batch from one or two shards; the
+        # shards stay in stored order and dense rows are taken straight into
+        # a batch buffer, so shuffling costs O(batch) instead of O(shard)
+        shards = [self.cache.get(self.paths[shard_idx]) for shard_idx, rows in segments]
+        buffers = self.batch_buffers[self.batch_buffer_idx]
+        self.batch_buffer_idx = (self.batch_buffer_idx + 1) % len(self.batch_buffers)
+        n = sum([rows.shape[0] for shard_idx, rows in segments])
+
+        batch_parts = []
+        for i in range(len(shards[0])):
+            data = [shard[i] for shard in shards]
+            if all([isinstance(x, np.ndarray) and x.shape[1:] == data[0].shape[1:] for x in data]):
+                out = self.get_batch_buffer(buffers, i, (n,) + data[0].shape[1:], np.result_type(*data))
+                offset = 0
+                for x, (shard_idx, rows) in zip(data, segments):
+                    part = out[offset:offset+rows.shape[0]]
+                    if x.dtype == out.dtype:
+                        np.take(x, rows, axis=0, out=part)
+                    else:
+                        part[:] = x[rows]
+                    offset += rows.shape[0]
+                batch_parts.append(out)
+            else:
+                # ragged and sparse rows are gathered by their own indexing
+                x = data[0][segments[0][1]]
+                for x2, (shard_idx, rows) in zip(data[1:], segments[1:]):
+                    x = concatenate_rows(x, x2[rows])
+                batch_parts.append(to_dense(x))
+
+        return batch_parts
+
+    def read_batch_parts(self, current_paths, start, end):
+        # reads only the rows of the batch from disk
+        batch_parts = []
+        if isinstance(current_paths[0], list):
             for i in range(len(current_paths[0])):
-                x1 = self.current_data[current_paths[0][i]][start:]
-                x2 = self.current_data[current_paths[1][i]][:end]
-                if len(x1.shape) == 1:
-                    x = np.hstack([x1, x2])
-                else:
-                    x = np.vstack([x1, x2])
-                batch_parts.append(x)
+                x1 = self.reader.read_rows(current_paths[0][i], start[0], None, keep_sparse=True)
+                x2 = self.reader.read_rows(current_paths[1][i], None, end[1], keep_sparse=True)
+                batch_parts.append(concatenate_rows(x1, x2))
         else:
             for path in current_paths:
-                batch_parts.append(self.current_data[path][start:end])
+                batch_parts.append(self.reader.read_rows(path, start, end, keep_sparse=True))
 
-        return batch_parts
+        return [to_dense(x) for x in batch_parts]
 
-    def determine_cache_size(self):
-        total_bytes = 0
-        for path, shard in self.current_data.items():
-            total_bytes += shard.nbytes
-        return total_bytes/(1024.0**3.0)
-
-    def clean_cache(self, current_paths):
-        # delete unused cached data
-        i = 0
-        n = len(self.cache_order)
-        while i < n:
-            if self.cache_order[i] in current_paths:
-                i += 1
-                continue
-            path = self.cache_order.pop(i)
-            self.current_data.pop(path, None)
-            GB_usage = self.determine_cache_size()
-            n -= 1
-            if GB_usage < self.cache_size_GB: break
+    def prepare_batch(self, batch_idx, segments=None):
+        '''Loads the data of a batch and returns its batch parts.
+
+        Args:
+            batch_idx: Index of the batch in stored order.
+            segments: The (shard_idx, rows) segments of a shuffled batch as
+                planned by EpochShuffler. If given, batch_idx is not used.
+        '''
+        if segments is not None:
+            batch_parts = self.gather_batch_parts(segments)
+        else:
+            if batch_idx not in self.batchidx2paths:
+                log.error('{0}, {1}', batch_idx, list(self.batchidx2paths.keys()))
+            current_paths = self.batchidx2paths[batch_idx]
+            start, end = self.batchidx2start_end[batch_idx]
+
+            if self.reader is not None:
+                batch_parts = self.read_batch_parts(current_paths, start, end)
+            else:
+                batch_parts = self.create_batch_parts(current_paths, start, end)
+        return batch_parts
 
     def publish_at_prepared_batch_event(self, batch_parts):
         for i, obs in enumerate(self.stream_batcher.at_batch_prepared_observers):
@@ -160,74 +313,348 @@ class DataLoaderSlave(threading.Thread):
 
     def run(self):
         while not self.stopped():
+            # idle loaders block here; the batcher wakes them with a None
+            # sentinel when it stops them
+            work = self.stream_batcher.work.get()
+            if work is None: break
+            seq, batch_idx, segments = work
 
-            # we have this to terminate threads gracefully
-            # if we use daemons then the terminational signal might not be heard while loading files
-            # thus causing ugly exceptions
             try:
-                batch_idx = self.stream_batcher.work.get(block=False, timeout=1.0)
-            except:
-                continue
-
-            if self.randomize:
-                n = 0
-                while (n - self.stream_batcher.batch_size + 1) <= 0:
-                    shard_idx = self.rdm.choice(len(list(self.shard2batchidx.keys())), 1, p=self.shard_fractions)[0]
-                    current_paths = self.paths[shard_idx]
-
-                    self.load_files_if_needed(current_paths)
-
-                    n = self.current_data[current_paths[0]].shape[0]
-                start = self.rdm.randint(0, n-self.stream_batcher.batch_size+1)
-                end = start + self.stream_batcher.batch_size
-
-                batch_parts = self.create_batch_parts(current_paths, start, end)
-            else:
-                if batch_idx not in self.batchidx2paths:
-                    log.error('{0}, {1}', batch_idx, list(self.batchidx2paths.keys()))
-                current_paths = self.batchidx2paths[batch_idx]
-                start, end = self.batchidx2start_end[batch_idx]
-
-                self.load_files_if_needed(current_paths)
-                batch_parts = self.create_batch_parts(current_paths, start, end)
-
-
-            batch_parts = self.publish_at_prepared_batch_event(batch_parts)
+                batch_parts = self.prepare_batch(batch_idx, segments)
+                batch_parts = self.publish_at_prepared_batch_event(batch_parts)
+            except Exception as e:
+                # the consumer raises the error instead of waiting for the batch
+                log.warning('Loading batch {0} failed: {1}', seq, traceback.format_exc())
+                batch_parts = e
             # pass data to streambatcher
-            self.stream_batcher.prepared_batches[batch_idx] = batch_parts
-            try:
-                self.stream_batcher.prepared_batchidx.put(batch_idx, block=False, timeout=1.0)
-            except:
-                continue
+            self.stream_batcher.add_prepared_batch(seq, batch_parts)
 
-            GB_usage = self.determine_cache_size()
-            if GB_usage > self.cache_size_GB:
-                self.clean_cache(current_paths)
             self.batches_processes += 1
             if self.batches_processes % 100 == 0:
                 if benchmark:
                     for i, obs in enumerate(self.stream_batcher.at_batch_prepared_observers):
                         t = self.t.tock(str(i))
 
+        if self.reader is not None:
+            self.reader.close()
+
+
+def copy_into_buffer(buffer, arrays):
+    '''Copies arrays back to back into a shared memory buffer.
+
+    Returns the dtype, shape and byte offset of each array, or None if the
+    arrays do not fit into the buffer or are not all numpy arrays.
+    '''
+    memory = np.frombuffer(buffer, dtype=np.uint8)
+    layout = []
+    offset = 0
+    for x in arrays:
+        if not isinstance(x, np.ndarray): return None
+        x = np.ascontiguousarray(x)
+        # align to 8 bytes so that the views are aligned for every dtype
+        offset += (-offset) % 8
+        if offset + x.nbytes > memory.shape[0]: return None
+        memory[offset:offset+x.nbytes] = x.reshape(-1).view(np.uint8)
+        layout.append((x.dtype.str, x.shape, offset))
+        offset += x.nbytes
+    return layout
+
+def views_from_buffer(buffer, layout):
+    '''Returns numpy views into a shared memory buffer without copying.'''
+    views = []
+    for dtype, shape, offset in layout:
+        count = int(np.prod(shape))
+        views.append(np.frombuffer(buffer, dtype=dtype, count=count, offset=offset).reshape(shape))
+    return views
+
+
+def get_picklable_error(e):
+    '''Returns the error, or a RuntimeError with its message if it cannot be sent to another process.'''
+    try:
+        pickle.dumps(e)
+        return e
+    except Exception:
+        return RuntimeError(repr(e))
+
+
+class DataLoaderProcess(multiprocessing.Process):
+    def __init__(self, work, results, free_slots, slots, loader_args, cache_size_GB, observers=[]):
+        '''Assembles batches in a separate process.
+
+        Each batch is copied into a free slot of a shared memory ring; only
+        the slot index and the layout of the batch parts are sent back.
+
+        Args:
+            work: Queue of (seq, batch_idx, segments) tuples, where seq is
+                the position of the batch in the stream.
+            results: Queue of (seq, slot, (names, layout)) tuples, where
+                names are the keys of dict batches or None. Batches which do
+                not fit into a slot are sent as (seq, None, parts) and
+                batches which failed as (seq, None, error).
+            free_slots: Queue of slot indices which can be written.
+            slots: List of shared RawArray buffers.
+            loader_args: Keyword arguments of the DataLoaderSlave which loads
+                the shards in this process.
+            cache_size_GB: Memory budget of the shard cache of this process.
+            observers: The at_batch_prepared observers which run in this
+                process before the batch is copied into its slot.
+        '''
+        super(DataLoaderProcess, self).__init__()
+        self.work = work
+        self.results = results
+        self.free_slots = free_slots
+        self.slots = slots
+        self.loader_args = loader_args
+        self.cache_size_GB = cache_size_GB
+        self.observers = observers
+        self._stop_event = multiprocessing.Event()
+        self.daemon = True
+
+    def stop(self):
+        self._stop_event.set()
+
+    def stopped(self):
+        return self._stop_event.is_set()
+
+    def run(self):
+        loader = DataLoaderSlave(None, cache=ShardCache(self.cache_size_GB), **self.loader_args)
+        while not self.stopped():
+            # both queues block; a None sentinel from the batcher ends the loop
+            work = self.work.get()
+            if work is None: break
+            seq, batch_idx, segments = work
+            try:
+                batch_parts = loader.prepare_batch(batch_idx, segments)
+                for obs in self.observers:
+                    batch_parts = obs.at_batch_prepared(batch_parts)
+            except Exception as e:
+                log.warning('Loading batch {0} failed: {1}', seq, traceback.format_exc())
+                self.results.put((seq, None, get_picklable_error(e)))
+                continue
+            names = list(batch_parts.keys()) if isinstance(batch_parts, dict) else None
+            arrays = [batch_parts[name] for name in names] if names is not None else batch_parts
+            slot = self.free_slots.get()
+            if slot is None: break
+            layout = copy_into_buffer(self.slots[slot], arrays)
+            if layout is None:
+                log.debug_once('Batch does not fit into the shared memory slot; it is sent through the queue.')
+                self.free_slots.put(slot)
+                # the queue pickles in the background, while the batch buffers
+                # of the loader are reused for the next batch
+                arrays = [np.array(x) if isinstance(x, np.ndarray) else x for x in arrays]
+                self.results.put((seq, None, dict(zip(names, arrays)) if names is not None else arrays))
+            else:
+                self.results.put((seq, slot, (names, layout)))
+        if loader.reader is not None:
+            loader.reader.close()
+        # results which are not consumed anymore must not block the exit
+        self.results.cancel_join_thread()
+
+
+class EpochShuffler(object):
+    def __init__(self, counts, batch_size, seed):
+        '''Plans the batches of an epoch as one shuffled pass over all samples.
+
+        Each epoch draws a permutation of the shards and of the rows within
+        every shard. Batches are consecutive slices of this order, so no
+        sample is seen twice per epoch while a batch reads from one shard,
+        or from two at a shard boundary. Like the stored order, an epoch has
+        only full batches: the last len(samples) % batch_size rows of the
+        permutation are dropped, which are other rows in every epoch.
+
+        Args:
+            counts: Number of samples of each shard.
+            batch_size: Number of samples per batch.
+            seed: Seed of the plans; each epoch has its own permutation.
+        '''
+        self.counts = counts
+        self.batch_size = batch_size
+        self.seed = seed
+        self.num_batches = int(np.sum(counts)) // batch_size
+
+    def plan(self, epoch):
+        '''Returns the batches of an epoch as lists of (shard_idx, rows).'''
+        rdm = np.random.RandomState([self.seed, epoch])
+        batches = []
+        batch = []
+        needed = self.batch_size
+        for shard_idx in rdm.permutation(len(self.counts)):
+            rows = self.order_rows(rdm, shard_idx)
+            start = 0
+            while start < rows.shape[0] and len(batches) < self.num_batches:
+                end = min(rows.shape[0], start + needed)
+                batch.append((shard_idx, rows[start:end]))
+                needed -= end - start
+                start = end
+                if needed == 0:
+                    batches.append(batch)
+                    batch = []
+                    needed = self.batch_size
+        return self.order_batches(rdm, batches)
+
+    def order_rows(self, rdm, shard_idx):
+        return rdm.permutation(self.counts[shard_idx])
+
+    def order_batches(self, rdm, batches):
+        return batches
+
+
+class BucketShuffler(EpochShuffler):
+    def __init__(self, counts, batch_size, seed, lengths, boundaries=None):
+        '''Plans shuffled batches of rows with similar lengths.
+
+        The shuffled rows of every shard are grouped into length buckets
+        before they are cut into batches, and the batches of each shard are
+        shuffled, so the order of the buckets is random while reads stay
+        mostly shard-local. Rows which do not fill a last batch of a shard
+        are bucketed again together with the next shard, so that batches
+        which span shards hold similar lengths too. As with EpochShuffler,
+        no sample is seen twice per epoch and the rows which do not fill a
+        last batch are dropped. The padding efficiency of each planned
+        epoch, the fraction of batch cells which hold tokens rather than
+        padding, is logged and kept in padding_efficiency.
+
+        Args:
+            lengths: List of the row lengths of each shard.
+            boundaries: Sorted length boundaries between the buckets. By
+                default the length deciles form ten buckets of similar size.
+        '''
+        super(BucketShuffler, self).__init__(counts, batch_size, seed)
+        self.lengths = lengths
+        if boundaries is None:
+            boundaries = np.unique(np.percentile(np.concatenate(lengths), np.arange(10, 100, 10)))
+        self.boundaries = boundaries
+        self.padding_efficiency = {}
+
+    def plan(self, epoch):
+        rdm = np.random.RandomState([self.seed, epoch])
+        batches = []
+        # rows of earlier shards which did not fill a batch are bucketed
+        # again with the next shard
+        left_shards = np.zeros(0, dtype=np.int64)
+        left_rows = np.zeros(0, dtype=np.int64)
+        left_lengths = np.zeros(0, dtype=np.int64)
+        for shard_idx in rdm.permutation(len(self.counts)):
+            rows = rdm.permutation(self.counts[shard_idx])
+            lengths = np.concatenate([left_lengths, self.lengths[shard_idx][rows]])
+            shards = np.concatenate([left_shards, np.full(rows.shape[0], shard_idx, dtype=np.int64)])
+            rows = np.concatenate([left_rows, rows])
+            # a stable sort keeps the rows of each bucket shuffled
+            order = np.argsort(np.digitize(lengths, self.boundaries), kind='mergesort')
+            full = (rows.shape[0] // self.batch_size)*self.batch_size
+            for start in range(0, full, self.batch_size):
+                batch = order[start:start+self.batch_size]
+                batches.append(self.split_by_shard(shards[batch], rows[batch]))
+            left = order[full:]
+            left_shards, left_rows, left_lengths = shards[left], rows[left], lengths[left]
+        batches = self.order_batches(rdm, batches)
+        self.padding_efficiency[epoch] = self.get_padding_efficiency(batches)
+        log.info('Padding efficiency of epoch {0}: {1:.3f}', epoch, self.padding_efficiency[epoch])
+        return batches
+
+    def split_by_shard(self, shards, rows):
+        '''Returns the rows as (shard_idx, rows) segments, one per shard.'''
+        segments = []
+        for shard_idx in shards[np.sort(np.unique(shards, return_index=True)[1])]:
+            segments.append((shard_idx, rows[shards == shard_idx]))
+        return segments
+
+    def order_batches(self, rdm, batches):
+        shard2batches = OrderedDict()
+        for batch in batches:
+            shard2batches.setdefault(batch[0][0], []).append(batch)
+        batches = []
+        for shard_batches in shard2batches.values():
+            rdm.shuffle(shard_batches)
+            batches += shard_batches
+        return batches
+
+    def get_padding_efficiency(self, batches):
+        used = 0
+        padded = 0
+        for batch in batches:
+            lengths = np.concatenate([self.lengths[shard_idx][rows] for shard_idx, rows in batch])
+            # narrow length dtypes would overflow in the sums
+            used += int(np.sum(lengths, dtype=np.int64))
+            padded += int(np.max(lengths))*lengths.shape[0]
+        return float(used)/max(padded, 1)
+
 
 class StreamBatcher(object):
-    def __init__(self, pipeline_name, name, batch_size, loader_threads=4, randomize=False, seed=None, keys=['input', 'support', 'target'], is_volatile=False, cache_size_GB=4):
-        config_path = join(get_data_path(), pipeline_name, name, 'hdf5_config.pkl')
-        if not exists(config_path):
-            log.error('Path {0} does not exists! Have you forgotten to preprocess your dataset?', config_path)
-        config = pickle.load(open(config_path, 'rb'))
+    def __init__(self, pipeline_name, name, batch_size, loader_threads=4, randomize=False, seed=None, keys=['input', 'support', 'target'], is_volatile=False, cache_size_GB=4, stream_from_disk=False, loader_processes=0, batch_buffer_MB=None, prefetch_batches=None, shared_cache=False, bucketing=False, bucket_key='input', bucket_boundaries=None, trim_padding=None):
+        '''Loads the shards of a preprocessed dataset and streams batches.
+        Args:
+            cache_size_GB: Memory budget of the shard cache which is shared
+                by all loader threads. Loader processes split the budget.
+            shared_cache: If True, the shard cache gets its budget from
+                ShardCacheRegistry, which splits one process-wide budget
+                between all batchers with shared caches, instead of
+                cache_size_GB. Not used with loader processes.
+            stream_from_disk: Without randomization, reads only the rows of
+                each batch from disk instead of loading whole shards.
+            loader_processes: If larger than zero, batches are assembled by
+                this many processes instead of loader_threads threads, so
+                that loading does not compete with training for the GIL.
+                The batch parts are zero-copy views into shared memory and
+                are only valid until the next batch is requested; the torch
+                backend copies them into its variables. The
+                leading observers which set runs_in_loader_process, like
+                TrimPadding and DictConverter, run in the processes; the
+                processes start with the first batch.
+            batch_buffer_MB: Size of each shared memory slot. By default it
+                is estimated from the shapes and bytes of the shards in the
+                manifest; larger batches are sent through a queue instead.
+            randomize: Streams the samples in a new shuffled order per
+                epoch, each at most once, see EpochShuffler. Rows which do
+                not fill a last batch are dropped. Dense batch parts are
+                gathered into reused buffers and are only valid until the
+                next batch is requested; the torch backend copies them into
+                its variables.
+            seed: Seed of the shuffled order.
+            bucketing: Samples shuffled batches of rows with similar lengths
+                of bucket_key, see BucketShuffler. Implies randomize.
+            bucket_key: Key whose stored lengths define the buckets.
+            bucket_boundaries: Length boundaries between the buckets.
+            trim_padding: Trims the padding of each batch to its longest
+                sequence before the backend conversion, see TrimPadding. On
+                by default for the torch backend.
+            prefetch_batches: Maximum number of batches which are loaded or
+                ready ahead of the consumer. Loaders only get new work when a
+                batch is consumed, so a slow consumer holds back the loaders
+                instead of piling up batches. Defaults to two batches per
+                loader.
+        '''
+        config = self.load_config(join(get_data_path(), pipeline_name, name))
         self.paths = config['paths']
         self.fractions = config['fractions']
         self.num_batches = int(np.sum(config['counts']) / batch_size)
         self.max_lengths = config['max_lengths']
+        self.shared_cache = shared_cache and loader_processes == 0
+        if shared_cache and loader_processes > 0:
+            log.warning('Loader processes cannot share a shard cache; each process uses a share of cache_size_GB.')
+        if config['shard_GB'] is not None:
+            log.info('Dataset {0} needs {1:.3f} GB in memory, the largest shard {2:.3f} GB', name, np.sum(config['shard_GB']), np.max(config['shard_GB']))
+            if np.max(config['shard_GB']) > cache_size_GB and not self.shared_cache:
+                log.warning('The largest shard ({0:.3f} GB) does not fit into the cache of {1} GB!', np.max(config['shard_GB']), cache_size_GB)
         self.batch_size = batch_size
         self.batch_idx = 0
         self.prefetch_batch_idx = 0
         self.loaders = []
+        # ready batches by their position in the stream; batches which arrive
+        # out of order wait here until it is their turn
         self.prepared_batches = {}
-        self.prepared_batchidx = queue.Queue()
+        self.batch_ready = threading.Condition()
+        self.scheduled_batches = 0
+        self.consumed_batches = 0
+        self.scheduled_epoch = 0
         self.work = queue.Queue()
-        self.cached_batches = {}
+        seed = 2345 if seed is None else seed
+        self.shuffler = None
+        if bucketing:
+            self.shuffler = BucketShuffler(config['counts'], batch_size, seed, self.load_lengths(config, bucket_key), bucket_boundaries)
+        elif randomize:
+            self.shuffler = EpochShuffler(config['counts'], batch_size, seed)
+        self.epoch_plan = None
         self.end_iter_observers = []
         self.end_epoch_observers = []
         self.start_epoch_observers = []
@@ -236,11 +663,19 @@ class StreamBatcher(object):
         self.current_iter = 0
         self.current_epoch = 0
         self.timer = Timer()
-        self.loader_threads = loader_threads
+        self.loader_threads = loader_processes if loader_processes > 0 else loader_threads
+        self.loader_processes = loader_processes
+        self.prefetch_batches = prefetch_batches or 2*self.loader_threads
+        if trim_padding is None:
+            trim_padding = Config.backend == Backends.TORCH
+        if trim_padding:
+            self.subscribe_to_batch_prepared_event(TrimPadding(keys))
         if Config.backend == Backends.TORCH:
             from spodernet.backends.torchbackend import TorchConverter, TorchCUDAConverter
             self.subscribe_to_batch_prepared_event(DictConverter(keys))
-            self.subscribe_to_batch_prepared_event(TorchConverter(is_volatile))
+            # shared memory slots and gather buffers are reused for later batches
+            copy_buffers = loader_processes > 0 or randomize or bucketing
+            self.subscribe_to_batch_prepared_event(TorchConverter(is_volatile, copy_buffers))
             if Config.cuda:
                 import torch
                 self.subscribe_to_batch_prepared_event(TorchCUDAConverter(torch.cuda.current_device()))
@@ -257,20 +692,211 @@ class StreamBatcher(object):
 
         batchidx2paths, batchidx2start_end, shard2batchidx = self.create_batchidx_maps(config['counts'])
 
-        for i in range(loader_threads):
-            seed = 2345 + (i*83)
-            self.loaders.append(DataLoaderSlave(self, batchidx2paths, batchidx2start_end, randomize, self.paths, shard2batchidx, seed, self.fractions, cache_size_GB))
+        self.shard_cache = None
+        self.slots = None
+        if loader_processes > 0:
+            # the processes start with the first batch, so that they run the
+            # observers which are subscribed after the constructor
+            self.row_bytes = config['row_bytes']
+            self.batch_buffer_MB = batch_buffer_MB
+            self.cache_size_GB = cache_size_GB/float(loader_processes)
+            self.loader_args = dict(batchidx2paths=batchidx2paths, batchidx2start_end=batchidx2start_end,
+                randomize=randomize, paths=self.paths, shard2batchidx=shard2batchidx,
+                stream_from_disk=stream_from_disk, batch_size=batch_size, batch_buffers=1)
+        else:
+            if self.shared_cache:
+                dataset_GB = None if config['shard_GB'] is None else np.sum(config['shard_GB'])
+                self.shard_cache = ShardCacheRegistry.register(dataset_GB)
+            else:
+                self.shard_cache = ShardCache(cache_size_GB)
+            for i in range(loader_threads):
+                self.loaders.append(DataLoaderSlave(self, batchidx2paths, batchidx2start_end, self.shard_cache, randomize, self.paths, shard2batchidx, stream_from_disk))
+                self.loaders[-1].start()
+
+    def start_loader_processes(self):
+        '''Starts the loader processes and the shared memory ring of batch slots.
+
+        The leading observers with runs_in_loader_process run in the
+        processes; all other observers run when a batch is received.
+        '''
+        self.work = multiprocessing.Queue()
+        self.results = multiprocessing.Queue()
+        self.free_slots = multiprocessing.Queue()
+        if self.batch_buffer_MB is not None:
+            slot_bytes = int(self.batch_buffer_MB*(1024**2))
+        elif self.row_bytes is not None:
+            # dense batch parts, plus the alignment of every part
+            num_parts = 2*len(self.max_lengths) + 1
+            slot_bytes = max(2**20, self.batch_size*self.row_bytes + 8*num_parts)
+        else:
+            # padded rows of all keys with 8 byte items, plus lengths and index
+            row_bytes = sum([(int(length) + 1)*8 for length in self.max_lengths.values()]) + 8
+            slot_bytes = max(2**20, self.batch_size*row_bytes)
+        self.num_loader_observers = 0
+        for obs in self.at_batch_prepared_observers:
+            if not getattr(obs, 'runs_in_loader_process', False): break
+            self.num_loader_observers += 1
+        observers = self.at_batch_prepared_observers[:self.num_loader_observers]
+        # every prefetched batch and the batch held by the consumer
+        self.slots = [multiprocessing.RawArray('b', slot_bytes) for i in range(self.prefetch_batches+1)]
+        for i in range(len(self.slots)):
+            self.free_slots.put(i)
+        self.batch_slots = {}
+        self.held_slot = None
+        for i in range(self.loader_processes):
+            self.loaders.append(DataLoaderProcess(self.work, self.results, self.free_slots, self.slots, self.loader_args, self.cache_size_GB, observers))
             self.loaders[-1].start()
 
+    def receive_batch(self):
+        '''Receives a batch from the loader processes and runs the remaining observers.'''
+        seq, slot, parts = self.results.get()
+        if isinstance(parts, Exception):
+            self.prepared_batches[seq] = parts
+            return seq
+        if slot is not None:
+            self.batch_slots[seq] = slot
+            names, layout = parts
+            parts = views_from_buffer(self.slots[slot], layout)
+            if names is not None:
+                parts = dict(zip(names, parts))
+        try:
+            for obs in self.at_batch_prepared_observers[self.num_loader_observers:]:
+                parts = obs.at_batch_prepared(parts)
+        except Exception as e:
+            # the batch is already taken from the results; like the errors of
+            # the loaders, it is raised when the batch is due
+            log.warning('Observers of batch {0} failed: {1}', seq, traceback.format_exc())
+            parts = e
+        self.prepared_batches[seq] = parts
+        return seq
+
+    def release_held_slot(self):
+        # the views of the last returned batch become invalid here
+        if self.held_slot is not None:
+            self.free_slots.put(self.held_slot)
+            self.held_slot = None
+
+    def add_prepared_batch(self, seq, batch_parts):
+        '''Hands a batch of a loader thread to the consumer.
+
+        Args:
+            batch_parts: The batch, or the exception which was raised while
+                loading it; the consumer raises it when the batch is due.
+        '''
+        with self.batch_ready:
+            self.prepared_batches[seq] = batch_parts
+            self.batch_ready.notify_all()
+
+    def prefetch_occupancy(self):
+        '''Returns the number of batches which are ready ahead of the consumer.
+
+        At most prefetch_batches batches are ready or being loaded.
+        '''
+        return len(self.prepared_batches)
+
+    def schedule_batches(self):
+        '''Hands out work until prefetch_batches batches are ahead of the consumer.'''
+        if self.loader_processes > 0 and self.slots is None:
+            self.start_loader_processes()
+        while self.scheduled_batches - self.consumed_batches < self.prefetch_batches:
+            segments = None
+            if self.shuffler is not None:
+                if self.prefetch_batch_idx == 0:
+                    self.epoch_plan = self.shuffler.plan(self.scheduled_epoch)
+                segments = self.epoch_plan[self.prefetch_batch_idx]
+            self.work.put((self.scheduled_batches, self.prefetch_batch_idx, segments))
+            self.scheduled_batches += 1
+            self.prefetch_batch_idx += 1
+            if self.prefetch_batch_idx >= self.num_batches:
+                self.prefetch_batch_idx = 0
+                self.scheduled_epoch += 1
 
-    def __del__(self):
-        log.debug('Stopping threads...')
+    def publish_at_prepared_batch_event(self, batch_parts):
+        for obs in self.at_batch_prepared_observers:
+            batch_parts = obs.at_batch_prepared(batch_parts)
+        return batch_parts
+
+
+    def load_lengths(self, config, key):
+        '''Returns the stored lengths of a key for the rows of each shard.'''
+        name = key + '_lengths'
+        if config['names'] is not None:
+            idx = config['names'][0].index(name)
+        else:
+            idx = [i for i, path in enumerate(config['paths'][0]) if basename(path).startswith(name + '_')][0]
+        lengths = []
+        for data in load_data_paths([paths[idx] for paths in config['paths']]):
+            data = to_dense(data)
+            # nested keys store one length per sentence
+            data = data.reshape(data.shape[0], -1).max(1) if data.ndim > 1 else data
+            # lengths of narrow datasets may be uint8 or uint16
+            lengths.append(data.astype(np.int64))
+        return lengths
+
+    def load_config(self, folder):
+        '''Plans with the json manifest and falls back to the pickled config of older datasets.'''
+        manifest_path = join(folder, 'manifest.json')
+        config_path = join(folder, 'hdf5_config.pkl')
+        if exists(manifest_path):
+            manifest = load_manifest(manifest_path)
+            config = {}
+            config['paths'] = get_manifest_paths(folder, manifest)
+            config['names'] = [[dataset['name'] for dataset in shard['datasets']] for shard in manifest['shards']]
+            config['counts'] = [shard['rows'] for shard in manifest['shards']]
+            config['fractions'] = (np.array(config['counts']) / np.float32(np.sum(config['counts']))).tolist()
+            config['max_lengths'] = manifest['max_lengths']
+            config['shard_GB'] = [sum([dataset['nbytes'] for dataset in shard['datasets']])/(1024.0**3.0) for shard in manifest['shards']]
+            config['row_bytes'] = max([self.get_row_bytes(shard) for shard in manifest['shards']])
+            return config
+        if not exists(config_path):
+            log.error('Path {0} does not exists! Have you forgotten to preprocess your dataset?', config_path)
+        config = pickle.load(open(config_path, 'rb'))
+        config['shard_GB'] = None
+        config['names'] = None
+        config['row_bytes'] = None
+        return config
+
+    def get_row_bytes(self, shard):
+        '''Returns an upper bound of the bytes of a dense batch row of a manifest shard.'''
+        row_bytes = 0
+        rows = max(shard['rows'], 1)
+        for dataset in shard['datasets']:
+            # ragged and sparse datasets record their dense shape, so the
+            # padded row bounds the batch; the stored bytes add the offsets
+            padded = int(np.prod(dataset['shape'][1:]))*np.dtype(dataset['dtype']).itemsize
+            row_bytes += max(padded, int(np.ceil(dataset['nbytes']/float(rows))))
+        return row_bytes
+
+    def close(self, timeout=5.0):
+        '''Stops the loaders and waits for them to finish.
+
+        Args:
+            timeout: Seconds to wait for each loader. Loaders which are still
+                busy afterwards are daemons and do not block the exit.
+        '''
+        if self.shared_cache:
+            ShardCacheRegistry.unregister(self.shard_cache)
+            self.shared_cache = False
+        if len(self.loaders) == 0: return
+        log.debug('Stopping loaders...')
         for worker in self.loaders:
             worker.stop()
+        # one sentinel per loader wakes all loaders which wait for work
+        for worker in self.loaders:
+            self.work.put(None)
+            if self.loader_processes > 0:
+                self.free_slots.put(None)
 
-        log.debug('Waiting for threads to finish...')
-        while threading.active_count() > 0:
-            time.sleep(0.1)
+        log.debug('Waiting for loaders to finish...')
+        for worker in self.loaders:
+            worker.join(timeout)
+            if worker.is_alive():
+                log.warning('Loader {0} did not stop within {1} seconds.', worker.name, timeout)
+        self.loaders = []
+
+    def __del__(self):
+        if hasattr(self, 'loaders'):
+            self.close()
 
     def subscribe_end_of_iter_event(self, observer):
         self.end_iter_observers.append(observer)
@@ -344,35 +970,44 @@ class StreamBatcher(object):
 
 
     def get_next_batch_parts(self):
-        if self.batch_idx in self.cached_batches:
-            return self.cached_batches.pop(self.batch_idx)
-        else:
-            batch_idx = self.prepared_batchidx.get()
-            if self.batch_idx == batch_idx:
-                return self.prepared_batches.pop(self.batch_idx)
-            else:
-                if batch_idx in self.prepared_batches:
-                    self.cached_batches[batch_idx] = self.prepared_batches.pop(batch_idx)
-                return self.get_next_batch_parts()
+        if self.loader_processes > 0:
+            return self.get_next_shared_batch_parts()
+        seq = self.consumed_batches
+        with self.batch_ready:
+            while seq not in self.prepared_batches:
+                self.batch_ready.wait()
+            batch_parts = self.prepared_batches.pop(seq)
+        self.consumed_batches += 1
+        if isinstance(batch_parts, Exception):
+            raise batch_parts
+        return batch_parts
+
+    def get_next_shared_batch_parts(self):
+        self.release_held_slot()
+        seq = self.consumed_batches
+        # batches which arrive out of order keep their slot until they are returned
+        while seq not in self.prepared_batches:
+            self.receive_batch()
+        self.held_slot = self.batch_slots.pop(seq, None)
+        self.consumed_batches += 1
+        batch_parts = self.prepared_batches.pop(seq)
+        if isinstance(batch_parts, Exception):
+            raise batch_parts
+        return batch_parts
 
     def __iter__(self):
         return self
 
 
     def __next__(self):
-        if self.batch_idx == 0:
-            while self.prefetch_batch_idx < self.loader_threads:
-                self.work.put(self.prefetch_batch_idx)
-                self.prefetch_batch_idx += 1
         if self.batch_idx < self.num_batches:
+            self.schedule_batches()
             batch_parts = self.get_next_batch_parts()
             self.publish_end_of_iter_event()
 
             self.batch_idx += 1
-            self.work.put(self.prefetch_batch_idx)
-            self.prefetch_batch_idx +=1
-            if self.prefetch_batch_idx >= self.num_batches:
-                self.prefetch_batch_idx = 0
+            # the consumed batch frees a place for the loaders
+            self.schedule_batches()
 
             return batch_parts
         else:
@@ -6,8 +6,8 @@ import json
 import zipfile
 import numpy as np
 
-from spodernet.preprocessing.vocab import Vocab
-from spodernet.utils.util import Timer
+from spodernet.preprocessing.vocab import Vocab, StringStore, HashingVocab
+from spodernet.utils.util import Timer, RaggedArray
 from spodernet.preprocessing.processors import SaveLengthsToState
 from sklearn.feature_extraction.text import TfidfVectorizer
 
@@ -78,13 +78,23 @@ class DatasetStreamer(object):
             raise
 
 class Pipeline(object):
-    def __init__(self, name, delete_all_previous_data=False, keys=None, skip_transformation=False, benchmark=False):
+    def __init__(self, name, delete_all_previous_data=False, keys=None, skip_transformation=False, benchmark=False, hash_buckets=None, skip_fit=False):
+        '''Constructor.
+        Args:
+            hash_buckets: If set, all vocabs are HashingVocabs with this many
+                buckets and memory does not grow with the vocabulary.
+            skip_fit: Only runs the transform pass. Use this together with
+                hash_buckets to process a stream in a single pass. No
+                lengths are collected without the fit pass, so StreamToHDF5
+                cannot be used; stream the batches with Pipeline.stream.
+        '''
         self.keys = keys or ['input', 'support', 'target']
         home = os.environ['HOME']
         self.root = join(home, '.data', name)
         self.tfidf = TfidfVectorizer()
         self.skip_transformation = skip_transformation
         self.benchmark = benchmark
+        self.execution_states = ['transform'] if skip_fit else ['fit', 'transform']
 
         if not os.path.exists(self.root):
             log.debug_once('Pipeline path {0} does not exist. Creating folder...', self.root)
@@ -101,10 +111,16 @@ class Pipeline(object):
         self.state = {'name' : name, 'home' : home, 'path' : self.root, 'data' : {}}
         self.state['vocab'] = {}
         self.state['tfidf'] = {}
-        self.state['vocab']['general'] = Vocab(path=join(self.root, 'vocab'))
+        # all vocabs share one string table and only hold their own indices
+        self.state['strings'] = StringStore()
+        if hash_buckets is not None:
+            create_vocab = lambda path: HashingVocab(path, num_buckets=hash_buckets)
+        else:
+            create_vocab = lambda path: Vocab(path, string_store=self.state['strings'])
+        self.state['vocab']['general'] = create_vocab(join(self.root, 'vocab'))
         self.state['tfidf']['general'] = TfidfVectorizer(stop_words=[])
         for key in self.keys:
-            self.state['vocab'][key] = Vocab(path=join(self.root, 'vocab_'+key))
+            self.state['vocab'][key] = create_vocab(join(self.root, 'vocab_'+key))
             self.state['tfidf'][key] = TfidfVectorizer(stop_words=[])
 
         self.text_processors = []
@@ -183,49 +199,72 @@ class Pipeline(object):
 
     def execute(self, data_streamer):
         '''Tokenizes the data, calcs the max length, and creates a vocab.'''
-        for execution_state in ['fit', 'transform']:
-            if execution_state == 'tranform' and self.skip_transformation: return self.state
-            for iter_count, var in enumerate(data_streamer.stream_files()):
-                for filter_keys, textp in self.text_processors:
-                    if execution_state not in textp.execution_state: continue
-                    for i, key in enumerate(self.keys):
-                        if key in filter_keys:
-                            var[i] = textp.abstract_process(var[i], key, self.benchmark)
-
-                for i in range(len(var)):
-                    var[i] = (var[i] if isinstance(var[i], list) else [var[i]])
-
-                for filter_keys, sentp in self.sent_processors:
-                    if execution_state not in sentp.execution_state: continue
-                    for i, key in enumerate(self.keys):
-                        if key in filter_keys:
-                            for j in range(len(var[i])):
-                                var[i][j] = sentp.abstract_process(var[i][j], key, self.benchmark)
-
-                for i in range(len(var)):
-                    var[i] = (var[i] if isinstance(var[i][0], list) else [[sent] for sent in var[i]])
-
-                for filter_keys, tokenp in self.token_processors:
-                    if execution_state not in tokenp.execution_state: continue
-                    for i, key in enumerate(self.keys):
-                        if key in filter_keys:
-                            for j in range(len(var[i])):
-                                for k in range(len(var[i][j])):
-                                    var[i][j][k] = tokenp.abstract_process(var[i][j][k], key, self.benchmark)
-
-                for filter_keys, postp in self.post_processors:
-                    if execution_state not in postp.execution_state: continue
-                    for i, key in enumerate(self.keys):
-                        if key in filter_keys:
-                            var[i] = postp.abstract_process(var[i], key, self.benchmark)
-
+        try:
+            for execution_state in self.execution_states:
+                if execution_state == 'tranform' and self.skip_transformation: break
+                for iter_count, var in enumerate(data_streamer.stream_files()):
+                    for filter_keys, textp in self.text_processors:
+                        if execution_state not in textp.execution_state: continue
+                        for i, key in enumerate(self.keys):
+                            if key in filter_keys:
+                                var[i] = textp.abstract_process(var[i], key, self.benchmark)
+
+                    for i in range(len(var)):
+                        var[i] = (var[i] if isinstance(var[i], list) else [var[i]])
+
+                    for filter_keys, sentp in self.sent_processors:
+                        if execution_state not in sentp.execution_state: continue
+                        for i, key in enumerate(self.keys):
+                            if key in filter_keys:
+                                for j in range(len(var[i])):
+                                    var[i][j] = sentp.abstract_process(var[i][j], key, self.benchmark)
+
+                    for i in range(len(var)):
+                        var[i] = (var[i] if isinstance(var[i][0], list) else [[sent] for sent in var[i]])
+
+                    for filter_keys, tokenp in self.token_processors:
+                        if execution_state not in tokenp.execution_state: continue
+                        for i, key in enumerate(self.keys):
+                            if key in filter_keys:
+                                for j in range(len(var[i])):
+                                    for k in range(len(var[i][j])):
+                                        var[i][j][k] = tokenp.abstract_process(var[i][j][k], key, self.benchmark)
+
+                    for filter_keys, postp in self.post_processors:
+                        if execution_state not in postp.execution_state: continue
+                        for i, key in enumerate(self.keys):
+                            if key in filter_keys:
+                                var[i] = postp.abstract_process(var[i], key, self.benchmark)
+        except Exception:
+            # the error of the run is raised instead of the errors of closing
+            self.close_processors(ignore_errors=True)
+            raise
+        self.close_processors()
         return self.state
 
-    def stream(self, data_streamer, batch_size, skip_probability=0.0):
+    def close_processors(self, ignore_errors=False):
+        '''Closes all processors, so that they finish pending work like shard writes.'''
+        for processors in [self.text_processors, self.sent_processors, self.token_processors, self.post_processors]:
+            for filter_keys, processor in processors:
+                try:
+                    processor.close()
+                except Exception as e:
+                    if not ignore_errors: raise
+                    log.warning('Closing {0} failed: {1}', type(processor).__name__, e)
+
+    def stream(self, data_streamer, batch_size, skip_probability=0.0, nested_keys=None):
+        '''Streams batches without writing the data to disk.
+        Args:
+            nested_keys: Keys whose samples consist of several sentences. These
+                are batched as [batch, max sentences, max tokens] together with
+                the token count of each sentence [batch, max sentences]; other
+                keys only use the first sentence.
+        '''
+        nested_keys = nested_keys or []
         str2var = {}
         key2max_len_and_type = {}
         index = 0
-        for execution_state in ['fit', 'transform']:
+        for execution_state in self.execution_states:
             for iter_count, var in enumerate(data_streamer.stream_files()):
                 for filter_keys, textp in self.text_processors:
                     if execution_state not in textp.execution_state: continue
@@ -266,7 +305,8 @@ class Pipeline(object):
                             str2var[key] = []
                             str2var[key+'_length'] = []
                         str2var[key].append(var[i])
-                        str2var[key+'_length'].append(self.state['data']['lengths'][key][index])
+                        # length of the (first) sentence which is written into the batch below
+                        str2var[key+'_length'].append(len(var[i][0]) if isinstance(var[i][0], list) else len(var[i]))
                     if 'index' not in str2var: str2var['index'] = []
                     str2var['index'].append(index)
 
@@ -282,10 +322,23 @@ class Pipeline(object):
                                 else:
                                     raise Exception('Unknown data type: {0} for item {1}'.format(type(batches[0][0][0]), batches[0][0][0]))
 
-                                max_len = np.max(self.state['data']['lengths'][key])
+                                if key in self.state['data']['lengths']:
+                                    max_len = np.max(self.state['data']['lengths'][key])
+                                else:
+                                    # no fit pass: pad to the max length of each batch
+                                    max_len = None
                                 key2max_len_and_type[key] = (max_len, dtype)
 
-                            empty_batch = np.zeros((batch_size, key2max_len_and_type[key][0]), dtype=key2max_len_and_type[key][1])
+                            if key in nested_keys:
+                                dtype = key2max_len_and_type[key][1]
+                                sents = RaggedArray.from_nested_rows(str2var[key], dtype)
+                                str2var[key] = sents.to_dense()
+                                lengths = [[len(sent) for sent in sample] for sample in batches]
+                                str2var[key+'_length'] = RaggedArray.from_rows(lengths, np.int32).to_dense()
+                                continue
+
+                            max_len = key2max_len_and_type[key][0] or np.max(str2var[key+'_length'])
+                            empty_batch = np.zeros((batch_size, max_len), dtype=key2max_len_and_type[key][1])
                             var = str2var[key]
                             lengths = str2var[key+'_length']
                             for row in range(len(var)):
@@ -2,6 +2,9 @@ from __future__ import unicode_literals
 from os.path import join
 from spodernet.utils.util import Timer
 from spodernet.utils.util import get_data_path, save_data, make_dirs_if_not_exists, load_data, Timer
+from spodernet.utils.util import save_shard_hdf, save_npy, get_shard_dataset_path, RaggedArray
+from spodernet.utils.util import get_nbytes, get_checksum, save_manifest, narrow_ints, get_narrow_int_dtype, MANIFEST_VERSION
+from spodernet.utils.util import benchmark_codecs, select_codec, get_compression_filter, get_saved_arrays
 from spodernet.interfaces import IAtBatchPreparedObservable
 from spodernet.utils.global_config import Config
 from past.builtins import basestring, long
@@ -13,6 +16,9 @@ import spacy
 import nltk
 import json
 import pickle
+import shutil
+import threading
+import queue
 
 from spodernet.utils.logger import Logger
 log = Logger('processors.py.txt')
@@ -21,6 +27,8 @@ nlp = spacy.load('en')
 timer = Timer()
 
 class KeyToKeyMapper(IAtBatchPreparedObservable):
+    runs_in_loader_process = True
+
     def __init__(self, key2key):
         self.key2key = key2key
 
@@ -33,6 +41,8 @@ class KeyToKeyMapper(IAtBatchPreparedObservable):
         return new_str2var
 
 class DictConverter(IAtBatchPreparedObservable):
+    runs_in_loader_process = True
+
     def __init__(self, keys=['input', 'support', 'target']):
         self.keys = keys
 
@@ -51,7 +61,37 @@ class DictConverter(IAtBatchPreparedObservable):
         return str2var
 
 
+class TrimPadding(IAtBatchPreparedObservable):
+    runs_in_loader_process = True
+
+    def __init__(self, keys=['input', 'support', 'target']):
+        '''Trims the padding of every sequence key to the longest sequence of the batch.
+
+        Works on the positional batch parts (key, key_length, ..., index) and
+        thus needs to run before the DictConverter.
+
+        Args:
+            keys: The keys of the batch parts, in stored order.
+        '''
+        self.keys = keys
+
+    def at_batch_prepared(self, batch_parts):
+        batch_parts = list(batch_parts)
+        for i in range(len(self.keys)):
+            if 2*i+1 >= len(batch_parts) - 1: break
+            data = batch_parts[2*i]
+            lengths = batch_parts[2*i+1]
+            # padded rows, or padded sentences of nested keys
+            if data.ndim < 2 or lengths.ndim != data.ndim - 1 or lengths.size == 0: continue
+            max_length = max(int(np.max(lengths)), 1)
+            if max_length < data.shape[-1]:
+                batch_parts[2*i] = np.ascontiguousarray(data[..., :max_length])
+        return batch_parts
+
+
 class TargetIdx2MultiTarget(IAtBatchPreparedObservable):
+    runs_in_loader_process = True
+
     def __init__(self, num_labels, variable_name, new_variable_name, shape=None, stop_index=0):
         self.num_labels = num_labels
         self.variable_name = variable_name
@@ -82,6 +122,8 @@ class TargetIdx2MultiTarget(IAtBatchPreparedObservable):
         return str2var
 
 class VariableLengthSorter(IAtBatchPreparedObservable):
+    runs_in_loader_process = True
+
     def __init__(self, variable_name, postfix):
         self.variable_name = variable_name
         self.postfix = postfix
@@ -159,6 +201,10 @@ class AbstractProcessor(object):
     def process(self, inputs, inp_type):
         raise NotImplementedError('Classes that inherit from AbstractProcessor need to implement the process method')
 
+    def close(self):
+        '''Called once the pipeline finished or stopped a run over the data.'''
+        pass
+
 
 class AbstractLoopLevelTokenProcessor(AbstractProcessor):
     def __init__(self):
@@ -417,7 +463,15 @@ class SaveLengthsToState(AbstractLoopLevelListOfTokensProcessor):
     def link_with_pipeline(self, state):
         self.state = state
         self.state['data']['lengths'] = {}
+        self.state['data']['num_samples'] = {}
         self.data = self.state['data']['lengths']
+        self.num_samples = self.state['data']['num_samples']
+
+    def process(self, sample, inp_type):
+        # lengths are stored per sentence, so we count samples separately
+        if inp_type not in self.num_samples: self.num_samples[inp_type] = 0
+        self.num_samples[inp_type] += 1
+        return super(SaveLengthsToState, self).process(sample, inp_type)
 
     def process_list_of_tokens(self, tokens, inp_type):
         if inp_type not in self.data: self.data[inp_type] = []
@@ -456,8 +510,107 @@ class SaveMaxLengthsToState(AbstractLoopLevelListOfTokensProcessor):
         self.data[inp_type] = max(self.data[inp_type], len(tokens))
         return tokens
 
+class ShardLayouts:
+    files = 'FILES'
+    single_file = 'SINGLE_FILE'
+
+class ShardFormats:
+    hdf5 = 'HDF5'
+    npy = 'NPY'
+
+class ShardStorage:
+    padded = 'PADDED'
+    ragged = 'RAGGED'
+    nested = 'NESTED'
+
+class ShardWriter(threading.Thread):
+    def __init__(self, max_pending=2):
+        '''Writes finished shards in a background thread.
+
+        Jobs go through a bounded queue: the pipeline fills the next shard
+        while the last one is written, but never gets more than max_pending
+        shards ahead of the disk.
+        '''
+        super(ShardWriter, self).__init__()
+        self.jobs = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.daemon = True
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None: break
+            # skip the remaining jobs after an error; it is raised by write or close
+            if self.error is not None: continue
+            func, args = job
+            try:
+                func(*args)
+            except Exception as e:
+                log.warning('Writing shard failed: {0}', e)
+                self.error = e
+
+    def write(self, func, *args):
+        self.check_error()
+        self.jobs.put((func, args))
+
+    def close(self):
+        '''Waits until all shards are written.'''
+        self.jobs.put(None)
+        self.join()
+        self.check_error()
+
+    def check_error(self):
+        if self.error is not None:
+            raise self.error
+
 class StreamToHDF5(AbstractLoopLevelListOfTokensProcessor):
-    def __init__(self, name, samples_per_file=50000, keys=['input', 'support', 'target']):
+    def __init__(self, name, samples_per_file=50000, keys=['input', 'support', 'target'], layout=ShardLayouts.files, chunk_rows=None, compression=None, compression_opts=None, storage=ShardStorage.padded, nested_keys=None, shard_format=ShardFormats.hdf5, async_writes=False, max_pending_shards=2, narrow_dtypes=False, target_shard_bytes=None, max_compression_ratio=1.0):
+        '''Streams the data into hdf5 shards.
+        Args:
+            layout: ShardLayouts.files writes one file per key, length and
+                index of each shard; ShardLayouts.single_file writes one file
+                per shard with one dataset for each of them.
+            chunk_rows: Number of rows per hdf5 chunk, so that a batch only
+                needs to read the chunks which hold its rows.
+            compression: hdf5 compression filter, for example 'gzip' or 'lzf'.
+                With 'auto' the codecs are benchmarked on the first shard of
+                each dataset and the codec with the fastest reads whose files
+                are at most max_compression_ratio times the memory size is
+                used. The choice and the benchmark are recorded in the
+                manifest.
+            compression_opts: Options of the compression filter, for example
+                the gzip level. With 'auto' they are the options of gzip and
+                are only used if gzip is selected.
+            storage: ShardStorage.padded pads every row to the max length of
+                the dataset; ShardStorage.ragged stores flat values plus row
+                offsets and the batcher pads to the max length of each batch.
+                ShardStorage.nested stores all sentences of a sample with a
+                second level of offsets; batches have the shape
+                [batch, max sentences, max tokens] and the lengths are the
+                token counts of the sentences [batch, max sentences].
+            nested_keys: Keys which are stored with all their sentences if the
+                storage is ShardStorage.nested. Defaults to all keys; other
+                keys are stored as ragged rows of their first sentence.
+            shard_format: ShardFormats.hdf5 or ShardFormats.npy. Npy shards
+                are memory-mapped by the batcher, so batches are row views
+                and all loader threads share the OS page cache. Npy shards
+                are never compressed and need the files layout.
+            async_writes: Writes the shards with a background ShardWriter
+                while the pipeline fills the next shard.
+            max_pending_shards: Maximum number of finished shard files which
+                wait for the background writer.
+            narrow_dtypes: Stores integer keys and lengths as uint8, uint16
+                or int32, whichever is the narrowest dtype that holds the
+                vocab size or the max length of the key. All shards of a key
+                share the dtype, so vocabs with less than 65536 tokens need
+                half of the space.
+            target_shard_bytes: If set, replaces samples_per_file. The rows
+                per shard are derived from the bytes of a row of all keys, so
+                that each shard needs about this many bytes in memory and the
+                shards of all keys stay row-aligned.
+            max_compression_ratio: Size budget of compression='auto' as file
+                bytes divided by memory bytes.
+        '''
         super(StreamToHDF5, self).__init__()
         self.execution_state = set(['transform'])
         self.max_length = None
@@ -487,6 +640,32 @@ class StreamToHDF5(AbstractLoopLevelListOfTokensProcessor):
         self.paths = {}
         self.shuffle_idx = None
         self.current_X = {}
+        self.layout = layout
+        self.chunk_rows = chunk_rows
+        self.compression = compression
+        self.compression_opts = compression_opts
+        self.max_compression_ratio = max_compression_ratio
+        self.codecs = {}
+        self.codec_benchmarks = {}
+        self.pending_shard = ([], [])
+        self.storage = storage
+        self.shard_format = shard_format
+        self.narrow_dtypes = narrow_dtypes
+        self.narrow_dtype = {}
+        self.target_shard_bytes = target_shard_bytes
+        self.row_bytes = None
+        self.dataset_names = {}
+        self.dataset_info = {}
+        # the background writer starts with the first shard
+        self.async_writes = async_writes
+        self.max_pending_shards = max_pending_shards
+        self.writer = None
+        if shard_format == ShardFormats.npy and layout != ShardLayouts.files:
+            raise ValueError('Npy shards need the layout ShardLayouts.files, but found: {0}'.format(layout))
+        if storage == ShardStorage.nested:
+            self.nested_keys = nested_keys or self.keys[:-1]
+        else:
+            self.nested_keys = []
 
     def link_with_pipeline(self, state):
         self.state = state
@@ -494,27 +673,92 @@ class StreamToHDF5(AbstractLoopLevelListOfTokensProcessor):
         make_dirs_if_not_exists(self.base_path)
 
     def init_and_checks(self):
-        if 'lengths' not in self.state['data']:
-            log.error('Do a first pass to produce lengths first, that is use the "SaveLengths" ' \
-                       'processor, execute, clean processors, then rerun the pipeline with hdf5 streaming.')
+        if self.keys[0] not in self.state['data'].get('lengths', {}):
+            # SaveLengthsToState only runs in the fit pass, which skip_fit=True omits
+            raise ValueError('StreamToHDF5 needs the lengths of a fit pass (SaveLengthsToState), ' \
+                             'but found none for key {0}. Do not use skip_fit=True with StreamToHDF5.'.format(self.keys[0]))
         if self.num_samples == None:
             self.num_samples = len(self.state['data']['lengths'][self.keys[0]])
         log.debug('Using type int32 for inputs and supports for now, but this may not be correct in the future')
         self.checked_for_lengths = True
-        self.num_samples = len(self.state['data']['lengths'][self.keys[0]])
+        if self.storage == ShardStorage.nested:
+            # one row per sample instead of one row per sentence
+            self.num_samples = self.state['data']['num_samples'][self.keys[0]]
+        else:
+            self.num_samples = len(self.state['data']['lengths'][self.keys[0]])
         log.debug('Number of samples as calcualted with the length data (SaveLengthsToState): {0}', self.num_samples)
+        if self.target_shard_bytes is not None:
+            self.row_bytes = self.estimate_row_bytes()
+            self.samples_per_file = max(1, int(self.target_shard_bytes // self.row_bytes))
+            log.info('Using {0} samples per shard for {1} bytes per row and {2} bytes per shard', self.samples_per_file, self.row_bytes, self.target_shard_bytes)
+
+    def estimate_row_bytes(self):
+        '''Estimates the bytes of one sample over all keys, lengths and the index.'''
+        # ids are stored as int32 or float32, or narrower, so 4 bytes are an upper bound
+        itemsize = 4
+        row_bytes = itemsize
+        for key in self.keys[:-1]:
+            lengths = self.state['data']['lengths'][key]
+            if self.storage == ShardStorage.padded:
+                if 'max_lengths' in self.state['data']:
+                    max_length = self.state['data']['max_lengths'][key]
+                else:
+                    max_length = np.max(lengths)
+                row_bytes += (max_length + 1)*itemsize
+            else:
+                # ragged rows need their mean length plus the int64 offset
+                sentences_per_sample = len(lengths)/float(self.num_samples)
+                row_bytes += np.sum(lengths)/float(self.num_samples)*itemsize + 8
+                if key in self.nested_keys:
+                    row_bytes += sentences_per_sample*(8 + itemsize)
+                else:
+                    row_bytes += itemsize
+        return int(np.ceil(row_bytes))
+
+    def get_max_idx(self):
+        # token ids and label ids are bounded by the size of the largest vocab
+        return max([max(vocab.num_token, vocab.num_labels) for vocab in self.state['vocab'].values()])
+
+    def get_narrow_dtype(self, name, data, max_value):
+        '''Picks the dtype of a dataset once, so that all shards of a key share it.
+
+        Args:
+            max_value: Upper bound of the values of all shards, like the vocab
+                size or the max length. The first shard may widen it.
+        '''
+        if name not in self.narrow_dtype:
+            values = data
+            while isinstance(values, RaggedArray):
+                # nested storage has ragged values of ragged values
+                values = values.values
+            if not np.issubdtype(values.dtype, np.integer) or values.size == 0:
+                return None
+            self.narrow_dtype[name] = get_narrow_int_dtype(min(0, values.min()), max(max_value, values.max()))
+            log.debug('Using dtype {0} for all shards of {1}', self.narrow_dtype[name], name)
+        return self.narrow_dtype[name]
+
+    def process(self, sample, inp_type):
+        if inp_type in self.nested_keys:
+            # the whole sample with all its sentences is one row
+            return self.process_list_of_tokens(sample, inp_type)
+        if self.storage == ShardStorage.nested:
+            # other keys keep one row per sample, so only their first sentence is stored
+            self.process_list_of_tokens(sample[0], inp_type)
+            return sample
+        return super(StreamToHDF5, self).process(sample, inp_type)
 
     def process_list_of_tokens(self, tokens, inp_type):
         if not self.checked_for_lengths:
             self.init_and_checks()
 
         if self.datatypes[inp_type] is None:
-            if isinstance(tokens[0], float):
+            token = tokens[0][0] if inp_type in self.nested_keys else tokens[0]
+            if isinstance(token, float):
                 self.datatypes[inp_type] = np.float32
-            elif isinstance(tokens[0], int):
+            elif isinstance(token, int):
                 self.datatypes[inp_type] = np.int32
             else:
-                raise ValueError('Unsupported type: {0} for key {1}'.format(type(tokens[0]), inp_type))
+                raise ValueError('Unsupported type: {0} for key {1}'.format(type(token), inp_type))
 
         if self.max_lengths[inp_type] == 0:
             if 'max_lengths' in self.state['data']:
@@ -525,9 +769,15 @@ class StreamToHDF5(AbstractLoopLevelListOfTokensProcessor):
             self.max_lengths[inp_type] = max_length
             log.statistical('max length of the dataset: {0}', 0.0001, max_length)
         if inp_type not in self.current_X:
-            self.current_X[inp_type] = np.zeros((self.samples_per_file, self.max_lengths[inp_type]), dtype=self.datatypes[inp_type])
+            if self.storage in [ShardStorage.ragged, ShardStorage.nested]:
+                self.current_X[inp_type] = []
+            else:
+                self.current_X[inp_type] = np.zeros((self.samples_per_file, self.max_lengths[inp_type]), dtype=self.datatypes[inp_type])
             self.current_sample[inp_type] = 0
-        self.current_X[inp_type][self.current_sample[inp_type], :len(tokens)] = tokens
+        if self.storage in [ShardStorage.ragged, ShardStorage.nested]:
+            self.current_X[inp_type].append(tokens)
+        else:
+            self.current_X[inp_type][self.current_sample[inp_type], :len(tokens)] = tokens
         self.current_sample[inp_type] += 1
 
         if inp_type == self.keys[-2]:
@@ -546,7 +796,8 @@ class StreamToHDF5(AbstractLoopLevelListOfTokensProcessor):
             else:
                 log.debug('Processed {0} samples so far...', self.idx[inp_type])
 
-        if self.idx[inp_type] == self.num_samples:
+        # finish once the last shard of every key has been handed to the writer
+        if all([self.idx[key] == self.num_samples for key in self.keys[:-1]]):
             counts = np.array(self.config['sample_count'])
             log.debug('Counts for each shard: {0}'.format(counts))
             fractions = counts / np.float32(np.sum(counts))
@@ -554,62 +805,192 @@ class StreamToHDF5(AbstractLoopLevelListOfTokensProcessor):
             self.config['counts'] = counts.tolist()
             self.config['paths'] = []
             self.config['max_lengths'] = self.max_lengths
+            self.config['storage'] = self.storage
+            self.config['shard_format'] = self.shard_format
             for i in range(fractions.size):
                 self.config['paths'].append(self.paths[i])
 
-            pickle.dump(self.config, open(join(self.base_path, 'hdf5_config.pkl'), 'wb'), pickle.HIGHEST_PROTOCOL)
+            self.close()
+            # the config is written last and atomically: it only exists once all shards are on disk
+            config_path = join(self.base_path, 'hdf5_config.pkl')
+            with open(config_path + '.tmp', 'wb') as f:
+                pickle.dump(self.config, f, pickle.HIGHEST_PROTOCOL)
+            os.rename(config_path + '.tmp', config_path)
+            save_manifest(join(self.base_path, 'manifest.json'), self.create_manifest())
 
         return tokens
 
+    def create_manifest(self):
+        '''Describes the dataset with plain types, so that it can be stored as json.'''
+        manifest = {}
+        manifest['version'] = MANIFEST_VERSION
+        manifest['name'] = self.name
+        manifest['keys'] = self.keys[:-1]
+        manifest['layout'] = self.layout
+        manifest['storage'] = self.storage
+        manifest['shard_format'] = self.shard_format
+        manifest['num_samples'] = int(self.num_samples)
+        manifest['shard_sizing'] = {'samples_per_file' : int(self.samples_per_file),
+                                    'target_shard_bytes' : self.target_shard_bytes, 'row_bytes' : self.row_bytes}
+        if self.compression == 'auto':
+            manifest['compression'] = dict([(name, {'codec' : codec, 'benchmark' : self.codec_benchmarks[name]}) for name, codec in self.codecs.items()])
+        else:
+            manifest['compression'] = self.compression
+        manifest['max_lengths'] = dict([(key, int(length)) for key, length in self.max_lengths.items()])
+        # counts of each length; lengths of nested keys are sentence lengths
+        manifest['length_histograms'] = {}
+        for key in self.keys[:-1]:
+            if key in self.state['data']['lengths']:
+                manifest['length_histograms'][key] = np.bincount(self.state['data']['lengths'][key]).tolist()
+        manifest['shards'] = []
+        for i, count in enumerate(self.config['counts']):
+            # datasets keep the order of the paths, which is the order of the batch parts
+            shard = {'rows' : count, 'datasets' : []}
+            for name, path in zip(self.dataset_names[i], self.paths[i]):
+                dataset = self.dataset_info[(i, name)]
+                dataset['name'] = name
+                dataset['path'] = os.path.relpath(path, self.base_path)
+                shard['datasets'].append(dataset)
+            manifest['shards'].append(shard)
+        return manifest
+
+    def describe_dataset(self, idx, name, data):
+        self.dataset_info[(idx, name)] = {'dtype' : np.dtype(data.dtype).name, 'shape' : list(data.shape),
+                                          'nbytes' : int(get_nbytes(data)), 'sha1' : get_checksum(data)}
+
     def save_to_hdf5(self, inp_type):
         idx = self.shard_id[inp_type]
-        if self.current_sample[inp_type] >= self.samples_per_file -1:
+        if inp_type in self.nested_keys:
+            X = RaggedArray.from_nested_rows(self.current_X[inp_type], self.datatypes[inp_type])
+        elif self.storage in [ShardStorage.ragged, ShardStorage.nested]:
+            X = RaggedArray.from_rows(self.current_X[inp_type], self.datatypes[inp_type])
+        elif self.current_sample[inp_type] >= self.samples_per_file -1:
             X = self.current_X[inp_type]
         else:
             X = self.current_X[inp_type][:self.current_sample[inp_type]]
-        file_name = inp_type + '_' + str(idx+1) + '.hdf5'
 
         if inp_type == 'input':
             #self.shuffle_idx = np.arange(X.shape[0])
             log.debug_once('First row of input data with shape {1} written to hdf5: {0}', X[0], X.shape)
             #X = X[self.shuffle_idx]
-        log.debug('Writing hdf5 file for input type {0} to disk. Using index {1} and path {2}', inp_type, idx, join(self.base_path, file_name))
-        log.debug('Writing hdf5 data. One sample row: {0}, shape: {1}, type: {2}', X[0], X.shape, X.dtype)
-        save_data(join(self.base_path, file_name), X)
-        if idx not in self.paths: self.paths[idx] = []
-        self.paths[idx].append(join(self.base_path, file_name))
+        log.debug('Writing hdf5 data for input type {0} and shard {1}. One sample row: {2}, shape: {3}, type: {4}', inp_type, idx, X[0], X.shape, X.dtype)
 
         if inp_type == self.keys[0]:
             log.statistical('Count of shard {0}; should be {1} most of the time'.format(X.shape[0], self.samples_per_file), 0.1)
             self.config['sample_count'].append(X.shape[0])
 
-        if inp_type != self.keys[-2]:
-            start = idx*self.samples_per_file
-            end = (idx+1)*self.samples_per_file
-            X_len = np.array(self.state['data']['lengths'][inp_type][start:end], dtype=np.int32)
-            file_name_len = inp_type + '_lengths_' + str(idx+1) + '.hdf5'
-            #X_len = X_len[self.shuffle_idx]
-            save_data(join(self.base_path, file_name_len), X_len)
-            self.paths[idx].append(join(self.base_path, file_name_len))
+        start = idx*self.samples_per_file
+        end = (idx+1)*self.samples_per_file
+        if inp_type in self.nested_keys:
+            X_len = RaggedArray.from_rows([[len(sent) for sent in sample] for sample in self.current_X[inp_type]], np.int32)
+        elif self.storage == ShardStorage.nested:
+            # the lengths in the state count every sentence, but only the first one is stored
+            X_len = np.array([len(tokens) for tokens in self.current_X[inp_type]], dtype=np.int32)
         else:
-            start = idx*self.samples_per_file
-            end = (idx+1)*self.samples_per_file
             X_len = np.array(self.state['data']['lengths'][inp_type][start:end], dtype=np.int32)
-            file_name_len = inp_type + '_lengths_' + str(idx+1) + '.hdf5'
-            #X_len = X_len[self.shuffle_idx]
-            save_data(join(self.base_path, file_name_len), X_len)
-            self.paths[idx].append(join(self.base_path, file_name_len))
-
-            file_name_index = 'index_' + str(idx+1) + '.hdf5'
+        #X_len = X_len[self.shuffle_idx]
+        if self.narrow_dtypes:
+            X = narrow_ints(X, self.get_narrow_dtype(inp_type, X, self.get_max_idx()))
+            X_len = narrow_ints(X_len, self.get_narrow_dtype(inp_type + '_lengths', X_len, self.max_lengths[inp_type]))
+        names = [inp_type, inp_type + '_lengths']
+        arrays = [X, X_len]
+        if inp_type == self.keys[-2]:
             index = np.arange(self.idx[inp_type] - X.shape[0], self.idx[inp_type], dtype=np.int32)
             #index = index[self.shuffle_idx]
-            save_data(join(self.base_path, file_name_index), index)
-            self.paths[idx].append(join(self.base_path, file_name_index))
+            names.append('index')
+            arrays.append(index)
+
+        if self.compression == 'auto' and self.shard_format == ShardFormats.hdf5:
+            for name, data in zip(names, arrays):
+                if name not in self.codecs: self.choose_codec(name, data)
+
+        if idx not in self.paths: self.paths[idx] = []
+        if idx not in self.dataset_names: self.dataset_names[idx] = []
+        self.dataset_names[idx] += names
+        for name, data in zip(names, arrays):
+            # checksums are calculated by the writer, next to the write
+            self.write(self.describe_dataset, idx, name, data)
+        if self.layout == ShardLayouts.single_file:
+            # all keys of a shard go into one file once the last key is complete
+            self.pending_shard[0].extend(names)
+            self.pending_shard[1].extend(arrays)
+            if inp_type == self.keys[-2]:
+                path = join(self.base_path, 'shard_' + str(idx+1) + '.hdf5')
+                log.debug('Writing hdf5 shard {0} to disk with path {1}', idx, path)
+                self.paths[idx] += [get_shard_dataset_path(path, name) for name in self.pending_shard[0]]
+                self.write(save_shard_hdf, path, self.pending_shard[0], self.pending_shard[1], self.chunk_rows, self.get_compression(), self.get_compression_opts())
+                self.pending_shard = ([], [])
+        elif self.layout == ShardLayouts.files:
+            for name, data in zip(names, arrays):
+                if self.shard_format == ShardFormats.npy:
+                    path = join(self.base_path, name + '_' + str(idx+1) + '.npy')
+                    log.debug('Writing npy file for input type {0} to disk. Using index {1} and path {2}', inp_type, idx, path)
+                    self.write(save_npy, path, data)
+                else:
+                    path = join(self.base_path, name + '_' + str(idx+1) + '.hdf5')
+                    log.debug('Writing hdf5 file for input type {0} to disk. Using index {1} and path {2}', inp_type, idx, path)
+                    self.write(save_data, path, data, self.chunk_rows, self.get_compression(name), self.get_compression_opts(name))
+                self.paths[idx].append(path)
+        else:
+            raise ValueError('Unknown shard layout: {0}'.format(self.layout))
 
         self.shard_id[inp_type] += 1
+        # the buffer now belongs to the writer; the next sample starts a new one
         self.current_X.pop(inp_type, None)
         self.current_sample[inp_type] = 0
 
+    def choose_codec(self, name, data):
+        folder = join(self.base_path, 'codec_benchmark')
+        # the files layout writes mostly zero shards in CSR form, single
+        # files store every dataset dense
+        arrays = get_saved_arrays(data) if self.layout == ShardLayouts.files else [data]
+        try:
+            results = benchmark_codecs(arrays, folder, chunk_rows=self.chunk_rows, codec_opts=self.get_codec_opts())
+        finally:
+            # a failed benchmark may leave its files behind
+            shutil.rmtree(folder, ignore_errors=True)
+        self.codecs[name] = select_codec(results, self.max_compression_ratio)
+        self.codec_benchmarks[name] = results
+        log.info('Selected codec {0} for dataset {1}. Benchmark: {2}', self.codecs[name], name, results)
+
+    def get_compression(self, name=None):
+        '''Returns the compression filter of a dataset, or of all datasets if name is None.'''
+        if self.compression != 'auto':
+            return self.compression
+        if name is None:
+            return dict([(name, get_compression_filter(codec)) for name, codec in self.codecs.items()])
+        return get_compression_filter(self.codecs[name])
+
+    def get_codec_opts(self):
+        # options of 'auto' are written for gzip; lzf and 'none' take none
+        if self.compression_opts is None:
+            return {}
+        return {'gzip' : self.compression_opts}
+
+    def get_compression_opts(self, name=None):
+        '''Returns the compression options of a dataset, or of all datasets if name is None.'''
+        if self.compression != 'auto':
+            return self.compression_opts
+        if name is None:
+            return dict([(name, self.get_compression_opts(name)) for name in self.codecs])
+        return self.get_codec_opts().get(self.codecs[name])
+
+    def write(self, func, *args):
+        if not self.async_writes:
+            func(*args)
+            return
+        if self.writer is None:
+            self.writer = ShardWriter(self.max_pending_shards)
+            self.writer.start()
+        self.writer.write(func, *args)
+
+    def close(self):
+        '''Waits until all shards are written and raises the errors of the background writer.'''
+        if self.writer is not None:
+            writer = self.writer
+            self.writer = None
+            writer.close()
+
 
 
 
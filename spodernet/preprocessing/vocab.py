@@ -1,4 +1,9 @@
-from collections import Counter
+from collections import Counter, OrderedDict
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+from array import array
 
 import numpy as np
 import os
@@ -9,6 +14,8 @@ import urllib
 import bashmagic
 import time
 import json
+import hashlib
+import struct
 
 from spodernet.utils.util import get_data_path, save_data, xavier_uniform_weight
 from os.path import join
@@ -18,42 +25,299 @@ log = Logger('vocab.py.txt')
 
 '''This models the vocabulary and token embeddings'''
 
+class StringStore(object):
+    '''Interned string table which is shared between several vocabularies.
+
+    Each distinct string is stored and hashed exactly once and is identified
+    by a string id (sid). Vocabularies map these sids to their own indices.
+    '''
+
+    def __init__(self):
+        self.string2sid = {}
+        self.sid2string = []
+
+    def __len__(self):
+        return len(self.sid2string)
+
+    def __getitem__(self, sid):
+        return self.sid2string[sid]
+
+    def add(self, string):
+        '''Interns the string and returns its sid.'''
+        sid = self.string2sid.get(string)
+        if sid is None:
+            sid = len(self.sid2string)
+            self.string2sid[string] = sid
+            self.sid2string.append(string)
+        return sid
+
+    def get_sid(self, string):
+        '''Returns the sid of the string or None if it was never interned.'''
+        return self.string2sid.get(string)
+
+
+class TokenToIdxView(Mapping):
+    '''Read-only dict view (token -> idx) over a vocabulary.'''
+
+    def __init__(self, vocab):
+        self.vocab = vocab
+
+    def __getitem__(self, token):
+        idx = self.vocab.lookup(token)
+        if idx is None:
+            raise KeyError(token)
+        return idx
+
+    def __contains__(self, token):
+        return self.vocab.lookup(token) is not None
+
+    def __iter__(self):
+        strings = self.vocab.strings
+        for sid, idx in enumerate(self.vocab.sid2idx):
+            if idx >= 0:
+                yield strings[sid]
+
+    def __len__(self):
+        return self.vocab.num_entries
+
+
+class IdxToTokenView(Mapping):
+    '''Read-only dict view (idx -> token) over a vocabulary.'''
+
+    def __init__(self, vocab):
+        self.vocab = vocab
+
+    def __getitem__(self, idx):
+        idx2sid = self.vocab.idx2sid
+        if idx < 0 or idx >= len(idx2sid) or idx2sid[idx] < 0:
+            raise KeyError(idx)
+        return self.vocab.strings[idx2sid[idx]]
+
+    def __iter__(self):
+        for idx, sid in enumerate(self.vocab.idx2sid):
+            if sid >= 0:
+                yield idx
+
+    def __len__(self):
+        return sum(1 for sid in self.vocab.idx2sid if sid >= 0)
+
+
+def fill_matrix_from_text_file(path, X, token2idx):
+    '''Fills the rows of X with one sequential pass over an embedding text file.
+
+    Returns the number of filled rows.
+    '''
+    dim = X.shape[1]
+    count = 0
+    with open(path, 'rb') as f:
+        for line in f:
+            data = line.rstrip().split(b' ')
+            token = b' '.join(data[:-dim]).decode('utf-8')
+            if token in token2idx:
+                X[token2idx[token]] = np.array(data[-dim:], dtype=np.float32)
+                count += 1
+    return count
+
+
+class EmbeddingStore(object):
+    '''Pretrained embeddings as a float32 .npy matrix plus a frozen token index.
+
+    The matrix is memory-mapped, so a vector lookup is a single row read
+    without reopening or parsing the text file.
+    '''
+
+    def __init__(self, matrix_path, index_path):
+        self.matrix = np.load(matrix_path, mmap_mode='r')
+        self.token2row = {}
+        for row, token in enumerate(json.load(open(index_path, 'r'))):
+            self.token2row.setdefault(token, row)
+
+    def __contains__(self, token):
+        return token in self.token2row
+
+    def __len__(self):
+        return self.matrix.shape[0]
+
+    @property
+    def dimension(self):
+        return self.matrix.shape[1]
+
+    def get_row(self, token):
+        '''Gets the matrix row of the token or None if it does not exist.'''
+        return self.token2row.get(token)
+
+    def get_vector(self, token):
+        '''Gets the (memory-mapped) vector of the token or None.'''
+        row = self.token2row.get(token)
+        if row is None: return None
+        return self.matrix[row]
+
+    def fill_matrix(self, X, token2idx):
+        '''Copies the vectors of all tokens in token2idx into the rows of X.
+
+        Returns the number of filled rows.
+        '''
+        rows = []
+        idx = []
+        for token, i in token2idx.items():
+            row = self.token2row.get(token)
+            if row is not None:
+                rows.append(row)
+                idx.append(i)
+        if len(rows) == 0: return 0
+        rows = np.array(rows, dtype=np.int64)
+        idx = np.array(idx, dtype=np.int64)
+        # sorted rows turn the gather into one forward scan over the mmap
+        order = np.argsort(rows)
+        X[idx[order]] = self.matrix[rows[order]]
+        return len(rows)
+
+    @staticmethod
+    def get_store_paths(text_path):
+        base = os.path.splitext(text_path)[0]
+        return base + '.npy', base + '.tokens.json'
+
+    @staticmethod
+    def from_text_file(text_path):
+        '''Loads the binary store of an embedding text file; converts it first if needed.'''
+        matrix_path, index_path = EmbeddingStore.get_store_paths(text_path)
+        if not (os.path.exists(matrix_path) and os.path.exists(index_path)):
+            EmbeddingStore.convert_text_file(text_path)
+        log.info('Loading embedding store {0}...', matrix_path)
+        return EmbeddingStore(matrix_path, index_path)
+
+    @staticmethod
+    def convert_text_file(text_path):
+        '''Converts a text file with lines "token v1 v2 ..." into a binary store.'''
+        matrix_path, index_path = EmbeddingStore.get_store_paths(text_path)
+        log.info('Converting {0} into a binary embedding store...', text_path)
+        num_rows = 0
+        dim = None
+        with open(text_path, 'rb') as f:
+            for line in f:
+                if dim is None:
+                    dim = len(line.rstrip().split(b' ')) - 1
+                num_rows += 1
+
+        # write to temporary files first, so that an interrupted conversion
+        # never leaves a partial store behind
+        tmp_matrix_path = matrix_path + '.tmp.npy'
+        X = np.lib.format.open_memmap(tmp_matrix_path, mode='w+', dtype=np.float32, shape=(num_rows, dim))
+        tokens = []
+        with open(text_path, 'rb') as f:
+            for row, line in enumerate(f):
+                data = line.rstrip().split(b' ')
+                # some embedding files contain tokens with spaces
+                tokens.append(b' '.join(data[:-dim]).decode('utf-8'))
+                X[row] = np.array(data[-dim:], dtype=np.float32)
+        X.flush()
+        del X
+        json.dump(tokens, open(index_path + '.tmp', 'w'))
+        os.rename(tmp_matrix_path, matrix_path)
+        os.rename(index_path + '.tmp', index_path)
+        log.info('Converted {0} embeddings with dimension {1}.', num_rows, dim)
+
+
+class VectorCache(object):
+    '''LRU cache of vectors with a fixed byte budget.
+
+    All entries are rows of one contiguous slab. Returned vectors are views
+    into that slab which are overwritten once their entry is evicted, so copy
+    a vector if it needs to outlive later cache insertions.
+    '''
+
+    def __init__(self, dimension, max_bytes, dtype=np.float32):
+        self.capacity = max(1, int(max_bytes // (dimension*np.dtype(dtype).itemsize)))
+        # np.empty only reserves memory, pages are touched as the cache fills
+        self.slab = np.empty((self.capacity, dimension), dtype=dtype)
+        self.token2slot = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.token2slot)
+
+    def __contains__(self, token):
+        return token in self.token2slot
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits/float(total) if total > 0 else 0.0
+
+    @property
+    def nbytes(self):
+        return len(self.token2slot)*self.slab.shape[1]*self.slab.itemsize
+
+    def get(self, token):
+        '''Gets the cached vector or None and updates the hit statistics.'''
+        slot = self.token2slot.get(token)
+        if slot is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        # move to the most recently used end
+        self.token2slot[token] = self.token2slot.pop(token)
+        return self.slab[slot]
+
+    def put(self, token, vector):
+        '''Caches the vector, evicting the least recently used one if full.'''
+        slot = self.token2slot.get(token)
+        if slot is not None:
+            self.token2slot[token] = self.token2slot.pop(token)
+        elif len(self.token2slot) < self.capacity:
+            slot = len(self.token2slot)
+            self.token2slot[token] = slot
+        else:
+            evicted_token, slot = self.token2slot.popitem(last=False)
+            self.token2slot[token] = slot
+            self.evictions += 1
+        self.slab[slot] = vector
+        return self.slab[slot]
+
+    def statistics(self):
+        return {'entries' : len(self), 'capacity' : self.capacity, 'bytes' : self.nbytes,
+                'hits' : self.hits, 'misses' : self.misses,
+                'evictions' : self.evictions, 'hit_rate' : self.hit_rate}
+
+
 class Vocab(object):
     '''Class that manages work/char embeddings'''
 
-    def __init__(self, path, vocab = Counter(), labels = {}):
+    def __init__(self, path, vocab = Counter(), labels = {}, string_store=None, glove_cache_size_MB=128):
         '''Constructor.
         Args:
             vocab: Counter object with vocabulary.
+            string_store: StringStore which holds the token strings. Pass the
+                same store to several vocabs to share the strings between them.
+            glove_cache_size_MB: Memory budget of the LRU cache of
+                get_glove_vector for each embedding dimension.
         '''
-        self.index = None
-        token2idx = {}
-        idx2token = {}
+        self.embedding_stores = {}
         self.label2idx = {}
         self.idx2label = {}
         self.glove_cache = {}
+        self.glove_cache_size_MB = glove_cache_size_MB
+        self.strings = string_store if string_store is not None else StringStore()
+        self.sid2idx = array('i')
+        self.idx2sid = array('i')
+        self.num_token = 0
+
         for i, item in enumerate(vocab.items()):
-            token2idx[item[0]] = i+1
-            idx2token[i+1] = item[0]
+            self.set_idx(item[0], i+1)
 
         for idx in labels:
             self.label2idx[labels[idx]] = idx
             self.idx2label[idx] = labels[idx]
 
         # out of vocabulary token
-        token2idx['OOV'] = int(0)
-        idx2token[int(0)] = 'OOV'
+        self.set_idx('OOV', int(0))
         # empty = 0
-        token2idx[''] = int(1)
-        idx2token[int(1)] = ''
+        self.set_idx('', int(1))
 
-        self.token2idx = token2idx
-        self.idx2token = idx2token
         self.path = path
-        if len(idx2token.keys()) > 0:
-            self.next_idx = int(np.max(list(idx2token.keys())) + 1)
-        else:
-            self.next_idx = int(2)
+        self.next_idx = int(len(self.idx2sid))
 
         if len(self.idx2label.keys()) > 0:
             self.next_label_2dx = int(int(np.max(self.idx2label.keys())) + 1)
@@ -61,17 +325,44 @@ class Vocab(object):
             self.next_label_idx = int(0)
 
     @property
-    def num_token(self):
-        return len(self.token2idx)
+    def token2idx(self):
+        return TokenToIdxView(self)
+
+    @property
+    def idx2token(self):
+        return IdxToTokenView(self)
 
     @property
     def num_labels(self):
         return len(self.label2idx)
 
+    @property
+    def num_entries(self):
+        '''Number of tokens which have their own index.'''
+        return self.num_token
+
+    def lookup(self, token):
+        '''Returns the idx of the token or None if it is not in the vocab.'''
+        sid = self.strings.get_sid(token)
+        if sid is None or sid >= len(self.sid2idx):
+            return None
+        idx = self.sid2idx[sid]
+        return idx if idx >= 0 else None
+
+    def set_idx(self, token, idx):
+        sid = self.strings.add(token)
+        if sid >= len(self.sid2idx):
+            self.sid2idx.extend([-1]*(sid + 1 - len(self.sid2idx)))
+        if idx >= len(self.idx2sid):
+            self.idx2sid.extend([-1]*(idx + 1 - len(self.idx2sid)))
+        if self.sid2idx[sid] < 0:
+            self.num_token += 1
+        self.sid2idx[sid] = idx
+        self.idx2sid[idx] = sid
+
     def add_token(self, token):
-        if token not in self.token2idx:
-            self.token2idx[token] = self.next_idx
-            self.idx2token[self.next_idx] = token
+        if self.lookup(token) is None:
+            self.set_idx(token, self.next_idx)
             self.next_idx += 1
 
     def add_label(self, label):
@@ -82,10 +373,11 @@ class Vocab(object):
 
     def get_idx(self, word):
         '''Gets the idx if it exists, otherwise returns -1.'''
-        if word in self.token2idx:
-            return self.token2idx[word]
+        idx = self.lookup(word)
+        if idx is not None:
+            return idx
         else:
-            return self.token2idx['OOV']
+            return self.lookup('OOV')
 
     def get_idx_label(self, label):
         '''Gets the idx of the label'''
@@ -93,15 +385,15 @@ class Vocab(object):
 
     def get_word(self, idx):
         '''Gets the word if it exists, otherwise returns OOV.'''
-        if idx in self.idx2token:
-            return self.idx2token[idx]
+        if 0 <= idx < len(self.idx2sid) and self.idx2sid[idx] >= 0:
+            return self.strings[self.idx2sid[idx]]
         else:
-            return self.idx2token[0]
+            return self.strings[self.idx2sid[0]]
 
     def save_to_disk(self, name=''):
         log.info('Saving vocab to: {0}'.format(self.path))
-        pickle.dump([self.token2idx, self.idx2token, self.label2idx,
-            self.idx2label], open(self.path + name, 'wb'))
+        pickle.dump([dict(self.token2idx.items()), dict(self.idx2token.items()),
+            self.label2idx, self.idx2label], open(self.path + name, 'wb'))
 
     def load_from_disk(self, name=''):
         if not os.path.exists(self.path + name):
@@ -110,7 +402,16 @@ class Vocab(object):
         timestamp = datetime.datetime.strptime(timestamp, '%a %b %d %H:%M:%S %Y')
         age_in_hours = (datetime.datetime.now() - timestamp).seconds/60./60.
         log.info('Loading vocab from: {0}'.format(self.path + name))
-        self.token2idx, self.idx2token, self.label2idx, self.idx2label = pickle.load(open(self.path, 'rb'))
+        token2idx, idx2token, self.label2idx, self.idx2label = pickle.load(open(self.path, 'rb'))
+        self.sid2idx = array('i')
+        self.idx2sid = array('i')
+        self.num_token = 0
+        for token, idx in token2idx.items():
+            self.set_idx(token, idx)
+        # restores the token of indices which are shared by several tokens
+        for idx, token in idx2token.items():
+            self.idx2sid[idx] = self.strings.add(token)
+        self.next_idx = int(len(self.idx2sid))
         if age_in_hours > 12:
             log.info('Vocabulary outdated: {0}'.format(self.path + name))
             return False
@@ -125,79 +426,122 @@ class Vocab(object):
             bashmagic.unzip(join(get_data_path(), 'glove', 'glove.6B.zip'), join(get_data_path(), 'glove'))
 
     def prepare_glove(self, dimension):
-        if self.index is not None: return
-        if not os.path.exists(join(get_data_path(), 'glove', 'index_50.p')):
-            dims = [50, 100, 200, 300]
-            base_filename = 'glove.6B.{0}d.txt'
-            paths = [join(get_data_path(), 'glove', base_filename.format(dim)) for dim in dims]
-            for path, dim in zip(paths, dims):
-                index = {}
-                index = {'PATH' : path}
-                with open(path, 'rb') as f:
-                    log.info('Building index for {0}', path)
-                    while True:
-                        prev_pos = f.tell()
-                        line = f.readline().decode('utf-8')
-                        if line == '': break
-                        next_pos = f.tell()
-                        data = line.strip().split(' ')
-                        token = data[0]
-                        index[token] = (prev_pos, next_pos)
-
-                log.info('Saving glove index...')
-                json.dump(index, open(join(get_data_path(), 'glove', 'index_{0}.p'.format(dim)), 'w'))
-
-        log.info('Loading glove index...')
-        self.index = json.load(open(join(get_data_path(), 'glove', 'index_{0}.p'.format(dimension)), 'r'))
-
-
-    def load_matrix(self, dim):
+        if dimension in self.embedding_stores: return
+        path = join(get_data_path(), 'glove', 'glove.6B.{0}d.txt'.format(dimension))
+        self.embedding_stores[dimension] = EmbeddingStore.from_text_file(path)
+
+
+    def load_matrix(self, dim, path=None):
+        '''Creates the embedding matrix for the vocab.
+
+        Args:
+            dim: Embedding dimension.
+            path: Optional embedding text file which is read in a single
+                sequential pass. Otherwise the GloVe store of that dimension
+                is used.
+        '''
         log.info('Initializing glove matrix...')
-        X = xavier_uniform_weight(len(self.token2idx), dim)
+        X = xavier_uniform_weight(self.next_idx, dim)
         log.info('Loading vectors into glove matrix with dimension: {0}', X.shape)
-        pretrained_count = 0
-        n = len(self.token2idx)-2
-        for i, (token, idx) in enumerate(self.token2idx.items()):
-            if i % 10000 == 0: print(i)
-            vec = self.get_glove_list(token, dim)
-            if vec is not None:
-                X[idx] = vec
-                pretrained_count += 1
+        if path is None:
+            self.prepare_glove(dim)
+            pretrained_count = self.embedding_stores[dim].fill_matrix(X, self.token2idx)
+        else:
+            pretrained_count = fill_matrix_from_text_file(path, X, self.token2idx)
+        n = self.num_token-2
         log.info('Filled matrix with {0} pretrained embeddings and {1} xavier uniform initialized embeddings.', pretrained_count, n-pretrained_count)
+        log.info('Pretrained embedding coverage of the vocabulary: {0:.2f}%', 100.0*pretrained_count/max(n, 1))
         return X
 
     def get_glove_vector(self, token, dimension=300):
-        if token in self.glove_cache: return self.glove_cache[token]
+        '''Gets a copy of the GloVe vector of the token or None.'''
+        if dimension not in self.glove_cache:
+            self.glove_cache[dimension] = VectorCache(dimension, self.glove_cache_size_MB*(1024**2))
+        cache = self.glove_cache[dimension]
+        vec = cache.get(token)
+        if vec is not None: return np.array(vec)
         vec = self.get_glove_list(token, dimension)
         if vec is not None:
-            arr = np.array(vec, dtype=np.float32)
-            self.glove_cache[token] = arr
-            return arr
+            # the cached row is overwritten once it is evicted
+            return np.array(cache.put(token, vec))
         else: return None
 
     def get_glove_list(self, token, dimension=300):
         assert dimension in [50, 100, 200, 300], 'Dimension not supported! Only dimension 50, 100, 200, and 300 are supported!'
         self.download_glove()
         self.prepare_glove(dimension)
-        vec = None
-        if token in self.index:
-            p = self.index['PATH']
-            with open(p, 'rb') as f:
-                start, end = self.index[token]
-                f.seek(start)
-                line = f.read(end-start).decode('utf-8')
-                data = line.strip().split(' ')
-                vec = data[1:]
-
-        return vec
+        return self.embedding_stores[dimension].get_vector(token)
 
     def exists_in_glove(self, token, dimension=300):
         self.download_glove()
         self.prepare_glove(dimension)
-        return token in self.index
+        return token in self.embedding_stores[dimension]
 
 
     def get_glove_matrix(self, dimension):
         assert dimension in [50, 100, 200, 300], 'Dimension not supported! Only dimension 50, 100, 200, and 300 are supported!'
         self.download_glove()
         return self.load_matrix(dimension)
+
+
+class HashingVocab(Vocab):
+    '''Vocabulary which maps tokens into a fixed number of hash buckets.
+
+    Memory does not grow with the number of distinct tokens and no fit pass
+    is needed to assign indices, so a pipeline can run transform-only. As in
+    Vocab, index 0 is OOV and index 1 is the empty token; buckets start at 2.
+    '''
+
+    def __init__(self, path, num_buckets=2**18, labels = {}):
+        '''Constructor.
+        Args:
+            num_buckets: Number of hash buckets, that is the number of
+                token indices next to OOV and the empty token.
+        '''
+        super(HashingVocab, self).__init__(path, labels=labels)
+        assert num_buckets > 0, 'The number of buckets needs to be larger than zero!'
+        self.num_buckets = num_buckets
+        self.num_token = num_buckets + 2
+        self.next_idx = self.num_token
+
+    @property
+    def num_entries(self):
+        # num_token counts the buckets; hashed tokens have no entry
+        return sum(1 for idx in self.sid2idx if idx >= 0)
+
+    def hash_token(self, token):
+        # md5 is stable across processes, unlike the salted built-in hash
+        digest = hashlib.md5(token.encode('utf-8')).digest()
+        h = struct.unpack('<Q', digest[:8])[0]
+        return h % self.num_buckets + 2
+
+    def lookup(self, token):
+        idx = super(HashingVocab, self).lookup(token)
+        if idx is not None:
+            return idx
+        return self.hash_token(token)
+
+    def add_token(self, token):
+        # buckets are fixed, there is nothing to add
+        pass
+
+    def get_idx_label(self, label):
+        '''Gets the idx of the label; unseen labels are added on the fly.'''
+        if label not in self.label2idx:
+            self.add_label(label)
+        return self.label2idx[label]
+
+    def save_to_disk(self, name=''):
+        log.info('Saving hashing vocab to: {0}'.format(self.path))
+        pickle.dump([self.num_buckets, self.label2idx,
+            self.idx2label], open(self.path + name, 'wb'))
+
+    def load_from_disk(self, name=''):
+        if not os.path.exists(self.path + name):
+            return False
+        log.info('Loading hashing vocab from: {0}'.format(self.path + name))
+        self.num_buckets, self.label2idx, self.idx2label = pickle.load(open(self.path + name, 'rb'))
+        self.num_token = self.num_buckets + 2
+        self.next_idx = self.num_token
+        self.next_label_idx = len(self.label2idx)
+        return True
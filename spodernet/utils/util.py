@@ -1,10 +1,13 @@
 from os.path import join
 from scipy.sparse import csr_matrix, spmatrix
+from collections import OrderedDict
 
 import h5py
 import os
 import time
 import os
+import json
+import hashlib
 import numpy as np
 import torch
 
@@ -13,13 +16,256 @@ log = Logger('util.py.txt')
 
 rdm = np.random.RandomState(2345235)
 
-def save_dense_hdf(path, data):
+class RaggedArray(object):
+    '''Rows of different lengths stored as flat values plus int64 row offsets.
+
+    Row i holds values[offsets[i]:offsets[i+1]]. Slicing rows is zero-copy;
+    to_dense pads the rows to their own maximum length. The values can be a
+    RaggedArray themselves, for example documents -> sentences -> tokens,
+    which are padded to [rows, max sentences, max tokens].
+    '''
+
+    def __init__(self, values, offsets):
+        self.values = values
+        self.offsets = offsets
+
+    @staticmethod
+    def from_rows(rows, dtype):
+        lengths = np.array([len(row) for row in rows], dtype=np.int64)
+        offsets = np.zeros((len(rows)+1,), dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        values = np.fromiter((value for row in rows for value in row), dtype=dtype, count=offsets[-1])
+        return RaggedArray(values, offsets)
+
+    @staticmethod
+    def from_nested_rows(rows, dtype):
+        '''Creates a two level ragged array from rows of lists of lists.'''
+        inner_rows = [inner_row for row in rows for inner_row in row]
+        values = RaggedArray.from_rows(inner_rows, dtype)
+        offsets = np.zeros((len(rows)+1,), dtype=np.int64)
+        np.cumsum([len(row) for row in rows], out=offsets[1:])
+        return RaggedArray(values, offsets)
+
+    @staticmethod
+    def concatenate(arrays):
+        values = [x.values[x.offsets[0]:x.offsets[-1]] for x in arrays]
+        if isinstance(values[0], RaggedArray):
+            values = RaggedArray.concatenate(values)
+        else:
+            values = np.concatenate(values)
+        offsets = [np.zeros((1,), dtype=np.int64)]
+        for x in arrays:
+            offsets.append(x.offsets[1:] - x.offsets[0] + (offsets[-1][-1]))
+        return RaggedArray(values, np.concatenate(offsets))
+
+    def __len__(self):
+        return self.offsets.shape[0] - 1
+
+    @property
+    def shape(self):
+        shape = (len(self), int(self.lengths.max()) if len(self) > 0 else 0)
+        if isinstance(self.values, RaggedArray):
+            shape += self.values[self.offsets[0]:self.offsets[-1]].shape[1:]
+        return shape
+
+    @property
+    def dtype(self):
+        return self.values.dtype
+
+    @property
+    def nbytes(self):
+        return self.values.nbytes + self.offsets.nbytes
+
+    @property
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            start, stop, step = idx.indices(len(self))
+            assert step == 1, 'Only contiguous slices are supported for ragged arrays!'
+            stop = max(start, stop)
+            return RaggedArray(self.values, self.offsets[start:stop+1])
+        elif np.ndim(idx) == 0:
+            return self.values[self.offsets[idx]:self.offsets[idx+1]]
+        else:
+            # gather rows into new flat storage
+            idx = np.asarray(idx)
+            starts = self.offsets[idx]
+            lengths = self.offsets[idx+1] - starts
+            offsets = np.zeros((idx.shape[0]+1,), dtype=np.int64)
+            np.cumsum(lengths, out=offsets[1:])
+            positions = np.repeat(starts - offsets[:-1], lengths) + np.arange(offsets[-1])
+            return RaggedArray(self.values[positions], offsets)
+
+    def to_dense(self, width=None):
+        '''Pads the rows with zeros to the longest row or to the given width.'''
+        lengths = self.lengths
+        if width is None:
+            width = int(lengths.max()) if len(self) > 0 else 0
+        values = self.values[self.offsets[0]:self.offsets[-1]]
+        if isinstance(values, RaggedArray):
+            values = values.to_dense()
+        X = np.zeros((len(self), width) + values.shape[1:], dtype=self.values.dtype)
+        mask = np.arange(width)[None, :] < lengths[:, None]
+        X[mask] = values
+        return X
+
+
+def to_dense(data):
+    '''Turns stored shard data into a dense numpy array.'''
+    if isinstance(data, RaggedArray):
+        return data.to_dense()
+    if isinstance(data, spmatrix):
+        return data.toarray()
+    return data
+
+def get_nbytes(data):
+    '''Returns the memory of dense, sparse or ragged shard data in bytes.'''
+    if isinstance(data, spmatrix):
+        sparse = csr_matrix(data)
+        return sparse.data.nbytes + sparse.indices.nbytes + sparse.indptr.nbytes
+    return data.nbytes
+
+def get_narrow_int_dtype(min_value, max_value):
+    '''Returns the narrowest of uint8, uint16 and int32 which holds the value range.'''
+    for dtype in [np.uint8, np.uint16, np.int32]:
+        info = np.iinfo(dtype)
+        if min_value >= info.min and max_value <= info.max:
+            return dtype
+    return None
+
+def narrow_ints(data, dtype=None):
+    '''Converts integer data, like token ids and lengths, to the narrowest safe dtype.
+
+    Args:
+        dtype: Converts to this dtype instead, so that several arrays can
+            share one dtype. Raises a ValueError if a value does not fit.
+    '''
+    if isinstance(data, RaggedArray):
+        values = data.values[data.offsets[0]:data.offsets[-1]]
+        return RaggedArray(narrow_ints(values, dtype), data.offsets - data.offsets[0])
+    if not np.issubdtype(data.dtype, np.integer) or data.size == 0:
+        return data
+    if dtype is None:
+        dtype = get_narrow_int_dtype(data.min(), data.max())
+        if dtype is None:
+            return data
+    else:
+        info = np.iinfo(dtype)
+        if data.min() < info.min or data.max() > info.max:
+            raise ValueError('Values in [{0}, {1}] do not fit into {2}!'.format(data.min(), data.max(), np.dtype(dtype).name))
+    return data.astype(dtype, copy=False)
+
+def get_checksum(data, sha1=None):
+    '''Returns the sha1 hex digest of dense, sparse or ragged shard data.'''
+    sha1 = sha1 or hashlib.sha1()
+    if isinstance(data, RaggedArray):
+        values = data.values[data.offsets[0]:data.offsets[-1]]
+        get_checksum(values, sha1)
+        sha1.update(np.ascontiguousarray(data.offsets - data.offsets[0]).tobytes())
+    else:
+        sha1.update(np.ascontiguousarray(to_dense(data)).tobytes())
+    return sha1.hexdigest()
+
+# increase when the meaning of existing manifest fields changes
+MANIFEST_VERSION = 1
+
+def save_manifest(path, manifest):
+    '''Writes the manifest as json; the file is replaced atomically.'''
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.rename(path + '.tmp', path)
+
+def load_manifest(path):
+    with open(path) as f:
+        manifest = json.load(f)
+    if manifest['version'] > MANIFEST_VERSION:
+        raise ValueError('Manifest version {0} of {1} is newer than the supported version {2}!'.format(manifest['version'], path, MANIFEST_VERSION))
+    return manifest
+
+def get_manifest_paths(folder, manifest):
+    '''Returns the absolute dataset paths of each shard in the manifest.'''
+    return [[join(folder, dataset['path']) for dataset in shard['datasets']] for shard in manifest['shards']]
+
+def verify_manifest(folder, manifest):
+    '''Returns the paths of all datasets whose checksum does not match the manifest.'''
+    corrupted = []
+    for shard, paths in zip(manifest['shards'], get_manifest_paths(folder, manifest)):
+        for dataset, path, data in zip(shard['datasets'], paths, load_data_paths(paths)):
+            if get_checksum(data) != dataset['sha1']:
+                corrupted.append(path)
+    return corrupted
+
+def save_dense_hdf(path, data, chunk_rows=None, compression=None, compression_opts=None):
     '''Writes a numpy array to a hdf5 file under the given path.'''
     log.debug_once('Saving hdf5 file to: {0}', path)
     h5file = h5py.File(path, "w")
-    h5file.create_dataset("default", data=data)
+    create_hdf_dataset(h5file, 'default', data, chunk_rows, compression, compression_opts)
     h5file.close()
 
+def create_hdf_dataset(h5file, name, data, chunk_rows=None, compression=None, compression_opts=None):
+    '''Creates a dataset with row chunks of the given size and optional compression.'''
+    if isinstance(data, RaggedArray):
+        group = h5file.create_group(name)
+        create_hdf_dataset(group, 'values', data.values, None, compression, compression_opts)
+        create_hdf_dataset(group, 'offsets', data.offsets, chunk_rows, compression, compression_opts)
+        return group
+    data = np.asarray(data)
+    chunks = None
+    if data.ndim > 0 and data.shape[0] > 0:
+        if chunk_rows is not None:
+            chunks = (min(chunk_rows, data.shape[0]),) + data.shape[1:]
+        elif compression is not None:
+            chunks = True
+    else:
+        # scalars and empty arrays can be neither chunked nor compressed
+        compression = None
+        compression_opts = None
+    return h5file.create_dataset(name, data=data, chunks=chunks, compression=compression, compression_opts=compression_opts)
+
+def save_ragged_hdf(path, data, chunk_rows=None, compression=None, compression_opts=None):
+    folder, filename = os.path.split(path)
+    if isinstance(data.values, RaggedArray):
+        save_ragged_hdf(join(folder, 'values_' + filename), data.values, None, compression, compression_opts)
+    else:
+        save_dense_hdf(join(folder, 'values_' + filename), data.values, None, compression, compression_opts)
+    save_dense_hdf(join(folder, 'offsets_' + filename), data.offsets, chunk_rows, compression, compression_opts)
+
+def load_ragged_hdf(path):
+    folder, filename = os.path.split(path)
+    if os.path.exists(join(folder, 'offsets_values_' + filename)):
+        values = load_ragged_hdf(join(folder, 'values_' + filename))
+    else:
+        values = load_dense_hdf(join(folder, 'values_' + filename))
+    offsets = load_dense_hdf(join(folder, 'offsets_' + filename))
+    return RaggedArray(values, offsets)
+
+def read_hdf_node(node):
+    '''Reads a hdf5 dataset, or a group holding a ragged array.'''
+    if isinstance(node, h5py.Group):
+        return RaggedArray(read_hdf_node(node['values']), node['offsets'][:])
+    return node[:]
+
+def read_ragged_rows(offsets, read_values, start=None, end=None):
+    '''Reads rows of a ragged array from its offsets and a reader for its values.
+
+    Args:
+        offsets: Array or hdf5 dataset with the row offsets.
+        read_values: Function which returns the values [start:end].
+    '''
+    start, end, step = slice(start, end).indices(offsets.shape[0]-1)
+    end = max(start, end)
+    row_offsets = offsets[start:end+1]
+    values = read_values(int(row_offsets[0]), int(row_offsets[-1]))
+    return RaggedArray(values, row_offsets - row_offsets[0])
+
+def read_hdf_rows(node, start=None, end=None):
+    '''Reads the rows [start:end] of a hdf5 dataset or of a ragged array group.'''
+    if isinstance(node, h5py.Group):
+        read_values = lambda values_start, values_end: read_hdf_rows(node['values'], values_start, values_end)
+        return read_ragged_rows(node['offsets'], read_values, start, end)
+    return node[start:end]
 
 def load_dense_hdf(path, keyword='default'):
     '''Reads and returns a numpy array for a hdf5 file'''
@@ -30,55 +276,318 @@ def load_dense_hdf(path, keyword='default'):
     h5file.close()
     return data
 
-def save_sparse_hdf(path, data):
+def save_sparse_hdf(path, data, compression=None, compression_opts=None):
     shape = data.shape
     sparse = csr_matrix(data)
     folder, filename = os.path.split(path)
-    save_dense_hdf(join(folder, 'data_' + filename), sparse.data)
-    save_dense_hdf(join(folder, 'indices_' + filename), sparse.indices)
-    save_dense_hdf(join(folder, 'indptr_' + filename), sparse.indptr)
+    save_dense_hdf(join(folder, 'data_' + filename), sparse.data, compression=compression, compression_opts=compression_opts)
+    save_dense_hdf(join(folder, 'indices_' + filename), sparse.indices, compression=compression, compression_opts=compression_opts)
+    save_dense_hdf(join(folder, 'indptr_' + filename), sparse.indptr, compression=compression, compression_opts=compression_opts)
     save_dense_hdf(join(folder, 'shape_dense_' + filename), shape)
     save_dense_hdf(join(folder, 'shape_sparse_' + filename), sparse.shape)
 
-def load_sparse_hdf(path, keyword='default'):
+def load_sparse_hdf(path, keyword='default', keep_sparse=False):
+    '''Loads data saved in CSR form.
+
+    Args:
+        keep_sparse: Returns the CSR matrix itself if the data is a matrix, so
+            that rows can be sliced without densifying the whole array.
+    '''
     folder, filename = os.path.split(path)
     data = load_dense_hdf(join(folder, 'data_' + filename))
     indices = load_dense_hdf(join(folder, 'indices_' + filename))
     indptr = load_dense_hdf(join(folder, 'indptr_' + filename))
     shape = load_dense_hdf(join(folder, 'shape_dense_' + filename))
     shape_sparse = load_dense_hdf(join(folder, 'shape_sparse_' + filename))
-    return csr_matrix((data, indices, indptr), shape=shape_sparse).toarray().reshape(shape)
+    sparse = csr_matrix((data, indices, indptr), shape=shape_sparse)
+    if keep_sparse and tuple(shape) == tuple(shape_sparse):
+        return sparse
+    return sparse.toarray().reshape(shape)
 
-def load_data(path):
+def save_npy(path, data):
+    '''Saves a numpy or ragged array as .npy files which can be memory-mapped.'''
+    folder, filename = os.path.split(path)
+    if isinstance(data, RaggedArray):
+        save_npy(join(folder, 'values_' + filename), data.values)
+        np.save(join(folder, 'offsets_' + filename), data.offsets)
+    else:
+        np.save(path, to_dense(data))
+
+def load_npy(path):
+    '''Memory-maps .npy files; row slices are views into the OS page cache.'''
+    log.debug_once('Memory-mapping npy file: {0}', path)
+    folder, filename = os.path.split(path)
+    if os.path.exists(join(folder, 'offsets_' + filename)):
+        values = load_npy(join(folder, 'values_' + filename))
+        return RaggedArray(values, np.load(join(folder, 'offsets_' + filename), mmap_mode='r'))
+    return np.load(path, mmap_mode='r')
+
+# datasets inside a single-file shard are addressed as <file path>::<dataset name>
+SHARD_DATASET_SEPARATOR = '::'
+
+def get_shard_dataset_path(path, name):
+    return path + SHARD_DATASET_SEPARATOR + name
+
+def split_shard_dataset_path(path):
+    '''Splits a path into the file path and the dataset name.'''
+    if SHARD_DATASET_SEPARATOR in path:
+        return tuple(path.rsplit(SHARD_DATASET_SEPARATOR, 1))
+    return path, None
+
+def save_shard_hdf(path, names, arrays, chunk_rows=None, compression=None, compression_opts=None):
+    '''Writes several arrays as datasets of one hdf5 file.
+
+    Args:
+        compression: A compression filter for all datasets, or a dict which
+            maps dataset names to their filter.
+        compression_opts: Options of the compression filter, or a dict which
+            maps dataset names to their options.
+    '''
+    log.debug_once('Saving hdf5 shard to: {0}', path)
+    h5file = h5py.File(path, 'w')
+    for name, data in zip(names, arrays):
+        codec = compression.get(name) if isinstance(compression, dict) else compression
+        if isinstance(compression_opts, dict):
+            opts = compression_opts.get(name)
+        else:
+            opts = compression_opts if codec == compression else None
+        create_hdf_dataset(h5file, name, data, chunk_rows, codec, opts)
+    h5file.close()
+    return [get_shard_dataset_path(path, name) for name in names]
+
+# codecs are named 'none' instead of None in benchmark results and manifests
+CODECS = ['none', 'lzf', 'gzip']
+
+def get_compression_filter(codec):
+    return None if codec == 'none' else codec
+
+def benchmark_codecs(arrays, folder, codecs=CODECS, chunk_rows=None, repeats=3, codec_opts=None):
+    '''Measures write and read throughput and the compression ratio of hdf5 codecs.
+
+    Use data of real shards, for example load_data_paths(paths) of a shard, since
+    the ratio and speed of a codec depend on the data.
+
+    Args:
+        arrays: List of dense, sparse or ragged arrays which are written
+            together into one file.
+        folder: Folder for the temporary benchmark files.
+        codecs: Names of the codecs to compare.
+        repeats: The fastest of this many writes and reads is used.
+        codec_opts: Dict of codec name to its compression options, for
+            example {'gzip' : 9}. Other codecs use their defaults.
+
+    Returns:
+        Dict of codec name to write_MB_s, read_MB_s, ratio (file bytes
+        divided by memory bytes) and file_bytes.
+    '''
+    make_dirs_if_not_exists(folder)
+    nbytes = float(sum([get_nbytes(data) for data in arrays]))
+    names = ['data_{0}'.format(i) for i in range(len(arrays))]
+    arrays = [data if isinstance(data, RaggedArray) else to_dense(data) for data in arrays]
+    codec_opts = codec_opts or {}
+    results = {}
+    for codec in codecs:
+        path = join(folder, 'codec_benchmark_{0}.hdf5'.format(codec))
+        write_secs = []
+        read_secs = []
+        for i in range(repeats):
+            t0 = time.time()
+            save_shard_hdf(path, names, arrays, chunk_rows, get_compression_filter(codec), codec_opts.get(codec))
+            write_secs.append(time.time() - t0)
+            t0 = time.time()
+            h5file = h5py.File(path, 'r')
+            for name in names:
+                read_hdf_node(h5file[name])
+            h5file.close()
+            read_secs.append(time.time() - t0)
+        file_bytes = os.path.getsize(path)
+        os.remove(path)
+        results[codec] = {'write_MB_s' : nbytes/(1024**2)/max(min(write_secs), 1e-9),
+                          'read_MB_s' : nbytes/(1024**2)/max(min(read_secs), 1e-9),
+                          'ratio' : file_bytes/max(nbytes, 1.0), 'file_bytes' : file_bytes}
+    return results
+
+def select_codec(results, max_ratio=1.0):
+    '''Selects the codec with the fastest reads among those which are not larger than max_ratio.
+
+    The hdf5 headers are not counted against the budget: they are measured
+    as the bytes by which the uncompressed file exceeds the memory bytes and
+    are subtracted from the ratios of all codecs. If no codec meets the size
+    budget, the codec with the smallest files is used.
+    '''
+    header_ratio = results['none']['ratio'] - 1.0 if 'none' in results else 0.0
+    def data_ratio(codec):
+        # the uncompressed file holds nothing but the data and the headers
+        return 1.0 if codec == 'none' else results[codec]['ratio'] - header_ratio
+    within_budget = [codec for codec in results if data_ratio(codec) <= max_ratio]
+    if len(within_budget) == 0:
+        return min(results, key=lambda codec: results[codec]['ratio'])
+    return max(within_budget, key=lambda codec: results[codec]['read_MB_s'])
+
+def load_data(path, keep_sparse=False):
+    file_path, name = split_shard_dataset_path(path)
+    if name is not None:
+        h5file = h5py.File(file_path, 'r')
+        data = read_hdf_node(h5file[name])
+        h5file.close()
+        return data
+    if path.endswith('.npy'):
+        return load_npy(path)
     folder, filename = os.path.split(path)
     if os.path.exists(join(folder, 'indptr_' + filename)):
-        data = load_sparse_hdf(path)
+        data = load_sparse_hdf(path, keep_sparse=keep_sparse)
         return data
+    elif os.path.exists(join(folder, 'offsets_' + filename)):
+        return load_ragged_hdf(path)
     else:
         return load_dense_hdf(path)
 
-def save_data(path, data):
-    assert data.size > 0
-    is_sparse = isinstance(data, spmatrix)
-    if is_sparse:
-        save_sparse_hdf(path, data)
+def load_data_paths(paths, keep_sparse=False):
+    '''Loads a list of paths; datasets of the same shard file are read with one open.'''
+    data = [None]*len(paths)
+    file2names = {}
+    for i, path in enumerate(paths):
+        file_path, name = split_shard_dataset_path(path)
+        if name is None:
+            data[i] = load_data(path, keep_sparse)
+        else:
+            if file_path not in file2names: file2names[file_path] = []
+            file2names[file_path].append((i, name))
+
+    for file_path, names in file2names.items():
+        log.debug_once('Reading hdf5 shard from: {0}', file_path)
+        h5file = h5py.File(file_path, 'r')
+        for i, name in names:
+            data[i] = read_hdf_node(h5file[name])
+        h5file.close()
+    return data
+
+def save_data(path, data, chunk_rows=None, compression=None, compression_opts=None):
+    if isinstance(data, RaggedArray):
+        save_ragged_hdf(path, data, chunk_rows, compression, compression_opts)
         return
+    assert data.size > 0
+    if is_saved_sparse(data):
+        save_sparse_hdf(path, data, compression, compression_opts)
+    else:
+        save_dense_hdf(path, data, chunk_rows, compression, compression_opts)
 
+def is_saved_sparse(data):
+    '''Returns True if save_data writes the data in CSR form.'''
+    if isinstance(data, spmatrix):
+        return True
     zero = (data == 0.0).sum()
     percent = zero/float(data.size)
-    if percent > 0.5:
-        save_sparse_hdf(path, data)
-    else:
-        save_dense_hdf(path, data)
+    return percent > 0.5
 
+def get_saved_arrays(data):
+    '''Returns the arrays which save_data writes to disk for the data.'''
+    if isinstance(data, RaggedArray) or not is_saved_sparse(data):
+        return [data]
+    sparse = csr_matrix(data)
+    return [sparse.data, sparse.indices, sparse.indptr]
 
-def load_hdf5_paths(paths, limit=None):
-    data = []
-    for path in paths:
-        if limit != None:
-            data.append(load_data(path)[:limit])
+
+class ShardReader(object):
+    def __init__(self, max_open_files=32, chunk_cache_MB=16):
+        '''Reads row ranges of shards through a pool of open hdf5 files.
+
+        Only the chunks which hold the requested rows are read, so batches
+        can be streamed from disk without loading whole shards.
+
+        Args:
+            max_open_files: Number of hdf5 files which are kept open; the
+                least recently used file is closed first.
+            chunk_cache_MB: Size of the hdf5 chunk cache of each open file.
+        '''
+        self.max_open_files = max_open_files
+        self.chunk_cache_bytes = int(chunk_cache_MB*(1024**2))
+        self.files = OrderedDict()
+        self.path2kind = {}
+        # npy shards are mapped once; a mapping holds no open file handle
+        self.memmaps = {}
+
+    def get_file(self, path):
+        if path in self.files:
+            h5file = self.files.pop(path)
+        else:
+            if len(self.files) >= self.max_open_files:
+                self.files.popitem(last=False)[1].close()
+            h5file = h5py.File(path, 'r', rdcc_nbytes=self.chunk_cache_bytes)
+        self.files[path] = h5file
+        return h5file
+
+    def get_kind(self, path):
+        if path not in self.path2kind:
+            folder, filename = os.path.split(path)
+            if split_shard_dataset_path(path)[1] is not None:
+                kind = 'shard'
+            elif path.endswith('.npy'):
+                kind = 'npy'
+            elif os.path.exists(join(folder, 'indptr_' + filename)):
+                kind = 'sparse'
+            elif os.path.exists(join(folder, 'offsets_' + filename)):
+                kind = 'ragged'
+            else:
+                kind = 'dense'
+            self.path2kind[path] = kind
+        return self.path2kind[path]
+
+    def read_rows(self, path, start=None, end=None, keep_sparse=False):
+        '''Reads the rows [start:end] of the data under a shard path.
+
+        Args:
+            keep_sparse: Returns the rows of CSR data as CSR matrix.
+        '''
+        kind = self.get_kind(path)
+        folder, filename = os.path.split(path)
+        if kind == 'shard':
+            file_path, name = split_shard_dataset_path(path)
+            return read_hdf_rows(self.get_file(file_path)[name], start, end)
+        elif kind == 'npy':
+            if path not in self.memmaps:
+                self.memmaps[path] = load_npy(path)
+            return self.memmaps[path][start:end]
+        elif kind == 'ragged':
+            values_path = join(folder, 'values_' + filename)
+            read_values = lambda values_start, values_end: self.read_rows(values_path, values_start, values_end)
+            offsets = self.get_file(join(folder, 'offsets_' + filename))['default']
+            return read_ragged_rows(offsets, read_values, start, end)
+        elif kind == 'sparse':
+            return self.read_sparse_rows(path, start, end, keep_sparse)
         else:
-            data.append(load_data(path))
+            return self.get_file(path)['default'][start:end]
+
+    def read_sparse_rows(self, path, start, end, keep_sparse):
+        folder, filename = os.path.split(path)
+        shape = self.get_file(join(folder, 'shape_dense_' + filename))['default'][:]
+        shape_sparse = self.get_file(join(folder, 'shape_sparse_' + filename))['default'][:]
+        if tuple(shape) != tuple(shape_sparse):
+            # vectors are stored as a single sparse row
+            return load_sparse_hdf(path)[start:end]
+        indptr = self.get_file(join(folder, 'indptr_' + filename))['default']
+        start, end, step = slice(start, end).indices(indptr.shape[0]-1)
+        end = max(start, end)
+        row_indptr = indptr[start:end+1]
+        data = self.get_file(join(folder, 'data_' + filename))['default'][row_indptr[0]:row_indptr[-1]]
+        indices = self.get_file(join(folder, 'indices_' + filename))['default'][row_indptr[0]:row_indptr[-1]]
+        rows = csr_matrix((data, indices, row_indptr - row_indptr[0]), shape=(end-start, shape[1]))
+        return rows if keep_sparse else rows.toarray()
+
+    def close(self):
+        for h5file in self.files.values():
+            h5file.close()
+        self.files = OrderedDict()
+        # rows which were returned earlier are views and keep their mapping alive
+        self.memmaps = {}
+
+def load_hdf5_paths(paths, limit=None):
+    if limit is None:
+        return load_data_paths(paths)
+    # only the first rows are read from disk
+    reader = ShardReader()
+    data = [reader.read_rows(path, 0, limit) for path in paths]
+    reader.close()
     return data
 
 def get_home_path():
@@ -3,16 +3,20 @@ from io import StringIO
 from os.path import join
 
 import uuid
+import re
 import os
 import nltk
 import pytest
 import json
 import numpy as np
 import shutil
+import time
+import threading
 import itertools
 import scipy.stats
 import spacy
 import pickle
+from scipy.sparse import csr_matrix
 
 from io import StringIO
 from sklearn.feature_extraction.text import TfidfVectorizer
@@ -20,11 +24,14 @@ from sklearn.feature_extraction.text import TfidfVectorizer
 from spodernet.preprocessing.pipeline import Pipeline, DatasetStreamer, StreamMethods
 from spodernet.preprocessing.processors import Tokenizer, CustomTokenizer, SaveStateToList, AddToVocab, ToLower, ConvertTokenToIdx, SentTokenizer
 from spodernet.preprocessing.processors import JsonLoaderProcessors, RemoveLineOnJsonValueCondition, DictKey2ListMapper
-from spodernet.preprocessing.processors import StreamToHDF5, DeepSeqMap, StreamToBatch, TargetIdx2MultiTarget
+from spodernet.preprocessing.processors import StreamToHDF5, DeepSeqMap, StreamToBatch, TargetIdx2MultiTarget, ShardLayouts, ShardStorage, TrimPadding, DictConverter
 from spodernet.preprocessing.processors import NERTokenizer, POSTokenizer, DependencyParser, TfidfFitter, TfidfTransformer
-from spodernet.preprocessing.vocab import Vocab
-from spodernet.preprocessing.batching import StreamBatcher, BatcherState
-from spodernet.utils.util import get_data_path, load_data
+from spodernet.preprocessing.vocab import Vocab, StringStore, HashingVocab, EmbeddingStore, VectorCache
+from spodernet.preprocessing.batching import StreamBatcher, BatcherState, ShardCache, ShardCacheRegistry, EpochShuffler
+from spodernet.interfaces import IAtBatchPreparedObservable
+from spodernet.backends.torchbackend import TorchConverter
+from spodernet.utils.util import get_data_path, load_data, save_data, load_hdf5_paths, xavier_uniform_weight, to_dense
+from spodernet.utils.util import get_manifest_paths, verify_manifest, MANIFEST_VERSION
 from spodernet.utils.global_config import Config, Backends
 from spodernet.hooks import LossHook, AccuracyHook, ETAHook
 
@@ -347,6 +354,28 @@ def test_separate_vocabs():
         assert token in tar_vocab.token2idx, 'Token {0} not found in the vocabulary when it should have been there!'.format(token)
 
 
+def test_shared_string_store():
+    strings = StringStore()
+    v1 = Vocab('test1', string_store=strings)
+    v2 = Vocab('test2', string_store=strings)
+    for token in ['a', 'b', 'c']:
+        v1.add_token(token)
+    for token in ['c', 'd']:
+        v2.add_token(token)
+
+    # OOV, '', a, b, c, d
+    assert len(strings) == 6, 'Each string should be stored only once, but the store has {0} strings.'.format(len(strings))
+    assert v1.num_token == 3 + 2, 'Vocab token count should be 5, but was {0} instead.'.format(v1.num_token)
+    assert v2.num_token == 2 + 2, 'Vocab token count should be 4, but was {0} instead.'.format(v2.num_token)
+    assert v1.get_idx('c') == 4, 'Index for token not the same!'
+    assert v2.get_idx('c') == 2, 'Index for token not the same!'
+    assert v2.get_idx('a') == 0, 'Token of another vocab should be out of vocabulary!'
+    assert v2.get_word(3) == 'd', 'Token for index not the same!'
+    assert 'd' not in v1.token2idx, 'Token d should not be in the first vocab!'
+    assert len(v2.token2idx) == len(list(v2.token2idx)) == v2.num_token, 'The length of the view should match its items!'
+    assert dict(v2.idx2token.items()) == {0 : 'OOV', 1 : '', 2 : 'c', 3 : 'd'}, 'Index to token mapping not the same!'
+
+
 def test_to_lower_sent():
     path = get_test_data_path_dict()['snli']
 
@@ -754,6 +783,424 @@ def test_stream_to_hdf5():
     # 7. clean up
     shutil.rmtree(base_path)
 
+def test_single_file_shard_layout():
+    tokenizer = nltk.tokenize.WordPunctTokenizer()
+    pipeline_folder = 'test_pipeline'
+    base_path = join(get_data_path(), pipeline_folder)
+    for folder in ['snli_files', 'snli_single']:
+        if os.path.exists(join(base_path, folder)):
+            shutil.rmtree(join(base_path, folder))
+
+    s = DatasetStreamer()
+    s.set_path(get_test_data_path_dict()['snli'])
+    s.add_stream_processor(JsonLoaderProcessors())
+    p = Pipeline(pipeline_folder)
+    p.add_token_processor(AddToVocab())
+    p.add_sent_processor(CustomTokenizer(tokenizer.tokenize))
+    p.add_post_processor(ConvertTokenToIdx())
+    streamer1 = StreamToHDF5('snli_files', samples_per_file=30)
+    streamer2 = StreamToHDF5('snli_single', samples_per_file=30, layout=ShardLayouts.single_file, chunk_rows=8, compression='gzip')
+    p.add_post_processor(streamer1)
+    p.add_post_processor(streamer2)
+    p.execute(s)
+
+    assert streamer1.config['counts'] == streamer2.config['counts'], 'Both layouts should have the same shards!'
+    for shard_id, (paths1, paths2) in enumerate(zip(streamer1.config['paths'], streamer2.config['paths'])):
+        assert len(paths2) == 7, 'One path type is missing! Paths: {0}'.format(paths2)
+        files = set([path.split('::')[0] for path in paths2])
+        assert files == set([join(base_path, 'snli_single', 'shard_{0}.hdf5'.format(shard_id+1))]), 'All data of a shard should be in one file!'
+        for data1, data2 in zip(load_hdf5_paths(paths1), load_hdf5_paths(paths2)):
+            np.testing.assert_array_equal(data1, data2, 'Shard data of both layouts not equal!')
+
+    for folder in ['snli_files', 'snli_single']:
+        shutil.rmtree(join(base_path, folder))
+
+def test_async_shard_writer():
+    tokenizer = nltk.tokenize.WordPunctTokenizer()
+    pipeline_folder = 'test_pipeline'
+    base_path = join(get_data_path(), pipeline_folder)
+    for folder in ['snli_sync', 'snli_async']:
+        if os.path.exists(join(base_path, folder)):
+            shutil.rmtree(join(base_path, folder))
+
+    s = DatasetStreamer()
+    s.set_path(get_test_data_path_dict()['snli'])
+    s.add_stream_processor(JsonLoaderProcessors())
+    p = Pipeline(pipeline_folder)
+    p.add_token_processor(AddToVocab())
+    p.add_sent_processor(CustomTokenizer(tokenizer.tokenize))
+    p.add_post_processor(ConvertTokenToIdx())
+    streamer1 = StreamToHDF5('snli_sync', samples_per_file=7)
+    streamer2 = StreamToHDF5('snli_async', samples_per_file=7, async_writes=True, max_pending_shards=1)
+    p.add_post_processor(streamer1)
+    p.add_post_processor(streamer2)
+    assert streamer2.writer is None, 'The writer should start with the first shard!'
+    p.execute(s)
+
+    assert streamer2.writer is None, 'The writer should be closed after the last sample!'
+    assert not os.path.exists(join(base_path, 'snli_async', 'hdf5_config.pkl.tmp')), 'The config should be moved into place!'
+    config = pickle.load(open(join(base_path, 'snli_async', 'hdf5_config.pkl'), 'rb'))
+    assert config['counts'] == streamer1.config['counts'], 'Both streamers should write the same shards!'
+    for paths1, paths2 in zip(streamer1.config['paths'], config['paths']):
+        for data1, data2 in zip(load_hdf5_paths(paths1), load_hdf5_paths(paths2)):
+            np.testing.assert_array_equal(data1, data2, 'Shard data of the async writer not equal!')
+
+    # errors of the background writer are raised by the pipeline
+    def fail(*args):
+        raise IOError('Disk full!')
+    p = Pipeline(pipeline_folder)
+    p.add_token_processor(AddToVocab())
+    p.add_sent_processor(CustomTokenizer(tokenizer.tokenize))
+    p.add_post_processor(ConvertTokenToIdx())
+    streamer3 = StreamToHDF5('snli_async_error', samples_per_file=7, async_writes=True)
+    streamer3.describe_dataset = fail
+    p.add_post_processor(streamer3)
+    with pytest.raises(IOError):
+        p.execute(s)
+    assert streamer3.writer is None, 'The writer should be closed after an error!'
+    assert not os.path.exists(join(base_path, 'snli_async_error', 'hdf5_config.pkl')), 'No config should be written after an error!'
+
+    for folder in ['snli_sync', 'snli_async', 'snli_async_error']:
+        shutil.rmtree(join(base_path, folder), ignore_errors=True)
+
+def test_dataset_manifest():
+    tokenizer = nltk.tokenize.WordPunctTokenizer()
+    pipeline_folder = 'test_pipeline'
+    base_path = join(get_data_path(), pipeline_folder, 'snli_manifest')
+    if os.path.exists(base_path):
+        shutil.rmtree(base_path)
+
+    s = DatasetStreamer()
+    s.set_path(get_test_data_path_dict()['snli'])
+    s.add_stream_processor(JsonLoaderProcessors())
+    p = Pipeline(pipeline_folder)
+    p.add_token_processor(AddToVocab())
+    p.add_sent_processor(CustomTokenizer(tokenizer.tokenize))
+    p.add_post_processor(ConvertTokenToIdx())
+    streamer = StreamToHDF5('snli_manifest', samples_per_file=30)
+    p.add_post_processor(streamer)
+    state = p.execute(s)
+
+    with open(join(base_path, 'manifest.json')) as f:
+        manifest = json.load(f)
+    assert manifest['version'] == MANIFEST_VERSION, 'Manifest version not equal!'
+    assert [shard['rows'] for shard in manifest['shards']] == streamer.config['counts'], 'Shard rows not equal!'
+    assert manifest['max_lengths']['input'] == np.max(state['data']['lengths']['input']), 'Max length not equal!'
+    histogram = manifest['length_histograms']['support']
+    assert sum(histogram) == manifest['num_samples'], 'The length histogram should count every sample!'
+    assert len(histogram) == np.max(state['data']['lengths']['support']) + 1, 'The histogram should end at the max length!'
+    assert get_manifest_paths(base_path, manifest) == streamer.config['paths'], 'Manifest paths not equal!'
+    for shard, paths in zip(manifest['shards'], streamer.config['paths']):
+        assert [dataset['name'] for dataset in shard['datasets']] == ['input', 'input_lengths', 'support', 'support_lengths', 'target', 'target_lengths', 'index'], 'Datasets should be in the order of the batch parts!'
+        for dataset, data in zip(shard['datasets'], load_hdf5_paths(paths)):
+            assert dataset['dtype'] == 'int32', 'Datasets should be int32!'
+            assert tuple(dataset['shape']) == data.shape, 'Dataset shape not equal!'
+            assert dataset['nbytes'] == data.nbytes, 'Dataset bytes not equal!'
+
+    assert verify_manifest(base_path, manifest) == [], 'Checksums of all datasets should match!'
+    path = streamer.config['paths'][1][4]
+    data = load_data(path)
+    data[0] += 1
+    os.remove(path)
+    save_data(path, data)
+    assert verify_manifest(base_path, manifest) == [path], 'The changed target shard should be detected!'
+
+    shutil.rmtree(base_path)
+
+def test_narrow_dtypes():
+    tokenizer = nltk.tokenize.WordPunctTokenizer()
+    pipeline_folder = 'test_pipeline'
+    base_path = join(get_data_path(), pipeline_folder)
+    for folder in ['snli_wide', 'snli_narrow']:
+        if os.path.exists(join(base_path, folder)):
+            shutil.rmtree(join(base_path, folder))
+
+    s = DatasetStreamer()
+    s.set_path(get_test_data_path_dict()['snli'])
+    s.add_stream_processor(JsonLoaderProcessors())
+    p = Pipeline(pipeline_folder)
+    p.add_token_processor(AddToVocab())
+    p.add_sent_processor(CustomTokenizer(tokenizer.tokenize))
+    p.add_post_processor(ConvertTokenToIdx())
+    streamer1 = StreamToHDF5('snli_wide', samples_per_file=30)
+    streamer2 = StreamToHDF5('snli_narrow', samples_per_file=30, narrow_dtypes=True)
+    p.add_post_processor(streamer1)
+    p.add_post_processor(streamer2)
+    state = p.execute(s)
+
+    num_token = state['vocab']['general'].num_token
+    assert 256 <= num_token < 2**16, 'The test vocab should need uint16 ids, but has {0} tokens'.format(num_token)
+    dtypes = {}
+    for paths1, paths2 in zip(streamer1.config['paths'], streamer2.config['paths']):
+        data1 = load_hdf5_paths(paths1)
+        data2 = load_hdf5_paths(paths2)
+        for name, x1, x2 in zip(['input', 'input_length', 'support', 'support_length', 'target', 'target_length', 'index'], data1, data2):
+            np.testing.assert_array_equal(x1, x2, 'Narrow data not equal for {0}!'.format(name))
+            dtypes.setdefault(name, set()).add(x2.dtype)
+            if name == 'index':
+                assert x2.dtype == np.int32, 'The index should keep int32!'
+            else:
+                assert x2.dtype in [np.uint8, np.uint16], 'Dtype {0} of {1} should be narrow!'.format(x2.dtype, name)
+                assert x2.nbytes <= x1.nbytes/2, 'Narrow data should need at most half the space!'
+    for name, key_dtypes in dtypes.items():
+        assert len(key_dtypes) == 1, 'All shards of {0} should share one dtype, but found {1}!'.format(name, key_dtypes)
+    assert dtypes['input'] == set([np.dtype(np.uint16)]), 'Token ids should use the dtype of the vocab size!'
+
+    for folder in ['snli_wide', 'snli_narrow']:
+        shutil.rmtree(join(base_path, folder))
+
+test_data = [ShardLayouts.files, ShardLayouts.single_file]
+ids = ['files', 'single_file']
+@pytest.mark.parametrize("layout", test_data, ids=ids)
+def test_auto_compression(layout):
+    tokenizer = nltk.tokenize.WordPunctTokenizer()
+    pipeline_folder = 'test_pipeline'
+    base_path = join(get_data_path(), pipeline_folder, 'snli_auto')
+    if os.path.exists(base_path):
+        shutil.rmtree(base_path)
+
+    s = DatasetStreamer()
+    s.set_path(get_test_data_path_dict()['snli'])
+    s.add_stream_processor(JsonLoaderProcessors())
+    p = Pipeline(pipeline_folder)
+    p.add_token_processor(AddToVocab())
+    p.add_sent_processor(CustomTokenizer(tokenizer.tokenize))
+    p.add_post_processor(ConvertTokenToIdx())
+    p.add_post_processor(SaveStateToList('idx'))
+    # padded ids compress well, so only compressed files are within the budget
+    streamer = StreamToHDF5('snli_auto', samples_per_file=30, layout=layout, compression='auto', max_compression_ratio=0.5)
+    p.add_post_processor(streamer)
+    state = p.execute(s)
+
+    with open(join(base_path, 'manifest.json')) as f:
+        manifest = json.load(f)
+    compression = manifest['compression']
+    assert set(compression.keys()) == set(['input', 'input_lengths', 'support', 'support_lengths', 'target', 'target_lengths', 'index']), 'Each dataset needs a codec!'
+    for name, choice in compression.items():
+        assert set(choice['benchmark'].keys()) == set(['none', 'lzf', 'gzip']), 'All codecs should be benchmarked!'
+        ratios = dict([(codec, result['ratio']) for codec, result in choice['benchmark'].items()])
+        # the hdf5 headers, which the uncompressed file adds to the data, do not count
+        data_ratio = 1.0 if choice['codec'] == 'none' else ratios[choice['codec']] - (ratios['none'] - 1.0)
+        assert data_ratio <= 0.5 or ratios[choice['codec']] == min(ratios.values()), 'The codec should meet the size budget!'
+    assert compression['input']['codec'] != 'none', 'Padded ids should be compressed!'
+    assert not os.path.exists(join(base_path, 'codec_benchmark')), 'Benchmark files should be removed!'
+
+    inp_indices = state['data']['idx']['input']
+    for paths in streamer.config['paths']:
+        inp, inp_len, sup, sup_len, t, t_len, index = load_hdf5_paths(paths)
+        for row, i in enumerate(index):
+            np.testing.assert_array_equal(inp[row, :inp_len[row]], inp_indices[i][0], 'Input data not equal!')
+
+    shutil.rmtree(base_path)
+
+test_data = [ShardStorage.padded, ShardStorage.ragged]
+ids = ['padded', 'ragged']
+@pytest.mark.parametrize("storage", test_data, ids=ids)
+def test_byte_budgeted_shards(storage):
+    tokenizer = nltk.tokenize.WordPunctTokenizer()
+    pipeline_folder = 'test_pipeline'
+    base_path = join(get_data_path(), pipeline_folder, 'snli_budget')
+    if os.path.exists(base_path):
+        shutil.rmtree(base_path)
+
+    s = DatasetStreamer()
+    s.set_path(get_test_data_path_dict()['snli'])
+    s.add_stream_processor(JsonLoaderProcessors())
+    p = Pipeline(pipeline_folder)
+    p.add_token_processor(AddToVocab())
+    p.add_sent_processor(CustomTokenizer(tokenizer.tokenize))
+    p.add_post_processor(ConvertTokenToIdx())
+    target_shard_bytes = 4096
+    streamer = StreamToHDF5('snli_budget', target_shard_bytes=target_shard_bytes, storage=storage)
+    p.add_post_processor(streamer)
+    p.execute(s)
+
+    with open(join(base_path, 'manifest.json')) as f:
+        manifest = json.load(f)
+    sizing = manifest['shard_sizing']
+    assert sizing['target_shard_bytes'] == target_shard_bytes, 'The target bytes should be recorded!'
+    assert sizing['samples_per_file'] == target_shard_bytes // sizing['row_bytes'], 'Rows per shard should follow from the row bytes!'
+    rows = [shard['rows'] for shard in manifest['shards']]
+    assert rows[:-1] == [sizing['samples_per_file']]*(len(rows)-1), 'All but the last shard should be full!'
+    shard_bytes = []
+    for shard in manifest['shards']:
+        assert len(set([dataset['shape'][0] for dataset in shard['datasets']])) == 1, 'Shards of all keys should be row-aligned!'
+        shard_bytes.append(sum([dataset['nbytes'] for dataset in shard['datasets']]))
+    if storage == ShardStorage.padded:
+        assert max(shard_bytes) <= target_shard_bytes, 'Padded shards should not exceed the target bytes!'
+    # ragged rows are estimated with the mean length, so single shards vary
+    mean_bytes = np.mean(shard_bytes[:-1])
+    assert target_shard_bytes*0.8 <= mean_bytes <= target_shard_bytes*1.1, 'Shards should have {0} bytes on average, but have {1}!'.format(target_shard_bytes, mean_bytes)
+
+    shutil.rmtree(base_path)
+
+def split_into_sentences(text):
+    # splits after commas and 'and' to get documents with a varying number of sentences
+    sents = [sent for sent in re.split(r',| and ', text) if len(sent.strip()) > 0]
+    return sents if len(sents) > 0 else [text]
+
+def test_nested_shard_storage():
+    tokenizer = nltk.tokenize.WordPunctTokenizer()
+    pipeline_folder = 'test_pipeline'
+    base_path = join(get_data_path(), pipeline_folder, 'snli_nested')
+    if os.path.exists(base_path):
+        shutil.rmtree(base_path)
+
+    s = DatasetStreamer()
+    s.set_path(get_test_data_path_dict()['snli'])
+    s.add_stream_processor(JsonLoaderProcessors())
+    p = Pipeline(pipeline_folder)
+    p.add_text_processor(CustomTokenizer(split_into_sentences), keys=['support'])
+    p.add_token_processor(AddToVocab())
+    p.add_sent_processor(CustomTokenizer(tokenizer.tokenize))
+    p.add_post_processor(ConvertTokenToIdx())
+    p.add_post_processor(SaveStateToList('idx'))
+    streamer = StreamToHDF5('snli_nested', samples_per_file=30, storage=ShardStorage.nested, nested_keys=['support'])
+    p.add_post_processor(streamer)
+    state = p.execute(s)
+
+    sup_indices = state['data']['idx']['support']
+    assert max([len(doc) for doc in sup_indices]) > 1, 'Test data should have documents with several sentences!'
+    assert sum(streamer.config['counts']) == len(sup_indices), 'Every document should be one row!'
+    for paths in streamer.config['paths']:
+        inp, inp_len, sup, sup_len, t, t_len, index = [to_dense(x) for x in load_hdf5_paths(paths)]
+        assert sup.shape[1:] == (max([len(sup_indices[i]) for i in index]), max([len(sent) for i in index for sent in sup_indices[i]])), 'Support should be padded to the max sentences and tokens of the shard!'
+        for row, i in enumerate(index):
+            doc = sup_indices[i]
+            assert sup_len[row, :len(doc)].tolist() == [len(sent) for sent in doc], 'Sentence lengths not equal!'
+            assert np.sum(sup_len[row, len(doc):]) == 0, 'Padded sentences should have length zero!'
+            for j, sent in enumerate(doc):
+                np.testing.assert_array_equal(sup[row, j, :len(sent)], sent, 'Support data not equal!')
+            np.testing.assert_array_equal(inp[row, :inp_len[row]], state['data']['idx']['input'][i][0], 'Input data not equal!')
+
+    for str2var in p.stream(s, 17, nested_keys=['support']):
+        assert len(str2var['support'].shape) == 3, 'Nested keys should be batched as [batch, max_sents, max_tokens]!'
+        for row, i in enumerate(str2var['index']):
+            doc = sup_indices[i]
+            assert str2var['support_length'][row, :len(doc)].tolist() == [len(sent) for sent in doc], 'Sentence lengths not equal!'
+            for j, sent in enumerate(doc):
+                np.testing.assert_array_equal(str2var['support'][row, j, :len(sent)], sent, 'Support data not equal!')
+
+    shutil.rmtree(base_path)
+
+def test_nested_shard_storage_first_sentence():
+    tokenizer = nltk.tokenize.WordPunctTokenizer()
+    pipeline_folder = 'test_pipeline'
+    base_path = join(get_data_path(), pipeline_folder, 'snli_nested_first')
+    if os.path.exists(base_path):
+        shutil.rmtree(base_path)
+
+    s = DatasetStreamer()
+    s.set_path(get_test_data_path_dict()['snli'])
+    s.add_stream_processor(JsonLoaderProcessors())
+    p = Pipeline(pipeline_folder)
+    # the input has several sentences too, but is not a nested key
+    p.add_text_processor(CustomTokenizer(split_into_sentences), keys=['input', 'support'])
+    p.add_token_processor(AddToVocab())
+    p.add_sent_processor(CustomTokenizer(tokenizer.tokenize))
+    p.add_post_processor(ConvertTokenToIdx())
+    p.add_post_processor(SaveStateToList('idx'))
+    streamer = StreamToHDF5('snli_nested_first', samples_per_file=30, storage=ShardStorage.nested, nested_keys=['support'])
+    p.add_post_processor(streamer)
+    state = p.execute(s)
+
+    inp_indices = state['data']['idx']['input']
+    assert max([len(doc) for doc in inp_indices]) > 1, 'Test data should have inputs with several sentences!'
+    assert streamer.config['counts'] is not None, 'All keys should have one row per sample!'
+    assert sum(streamer.config['counts']) == len(inp_indices), 'Every sample should be one row!'
+    assert os.path.exists(join(base_path, 'manifest.json')), 'The manifest should be written!'
+    for paths in streamer.config['paths']:
+        inp, inp_len, sup, sup_len, t, t_len, index = [to_dense(x) for x in load_hdf5_paths(paths)]
+        assert inp.shape[0] == sup.shape[0] == index.shape[0], 'All keys of a shard should have the same rows!'
+        for row, i in enumerate(index):
+            first = inp_indices[i][0]
+            assert inp_len[row] == len(first), 'Input length should be the length of the first sentence!'
+            np.testing.assert_array_equal(inp[row, :inp_len[row]], first, 'Input should be the first sentence!')
+
+    shutil.rmtree(base_path)
+
+def test_nested_shard_storage_narrow_dtypes():
+    tokenizer = nltk.tokenize.WordPunctTokenizer()
+    pipeline_folder = 'test_pipeline'
+    base_path = join(get_data_path(), pipeline_folder, 'snli_nested_narrow')
+    if os.path.exists(base_path):
+        shutil.rmtree(base_path)
+
+    s = DatasetStreamer()
+    s.set_path(get_test_data_path_dict()['snli'])
+    s.add_stream_processor(JsonLoaderProcessors())
+    p = Pipeline(pipeline_folder)
+    p.add_text_processor(CustomTokenizer(split_into_sentences), keys=['support'])
+    p.add_token_processor(AddToVocab())
+    p.add_sent_processor(CustomTokenizer(tokenizer.tokenize))
+    p.add_post_processor(ConvertTokenToIdx())
+    p.add_post_processor(SaveStateToList('idx'))
+    streamer = StreamToHDF5('snli_nested_narrow', samples_per_file=30, storage=ShardStorage.nested, nested_keys=['support'], narrow_dtypes=True)
+    p.add_post_processor(streamer)
+    state = p.execute(s)
+
+    sup_indices = state['data']['idx']['support']
+    for paths in streamer.config['paths']:
+        inp, inp_len, sup, sup_len, t, t_len, index = load_hdf5_paths(paths)
+        assert sup.values.values.dtype == np.uint16, 'Nested token ids should be narrow, but found {0}!'.format(sup.values.values.dtype)
+        assert inp.values.dtype == np.uint16, 'Ragged token ids should be narrow, but found {0}!'.format(inp.values.dtype)
+        inp, inp_len, sup, sup_len, index = [to_dense(x) for x in [inp, inp_len, sup, sup_len, index]]
+        for row, i in enumerate(index):
+            doc = sup_indices[i]
+            assert sup_len[row, :len(doc)].tolist() == [len(sent) for sent in doc], 'Sentence lengths not equal!'
+            for j, sent in enumerate(doc):
+                np.testing.assert_array_equal(sup[row, j, :len(sent)], sent, 'Support data not equal!')
+            np.testing.assert_array_equal(inp[row, :inp_len[row]], state['data']['idx']['input'][i][0], 'Input data not equal!')
+
+    for str2var in p.stream(s, 17, nested_keys=['support']):
+        for row, i in enumerate(str2var['index']):
+            for j, sent in enumerate(sup_indices[i]):
+                np.testing.assert_array_equal(str2var['support'][row, j, :len(sent)], sent, 'Support data not equal!')
+
+    shutil.rmtree(base_path)
+
+test_data = [(False, False), (True, False), (False, True)]
+ids = ['in order', 'randomized', 'stream from disk']
+@pytest.mark.parametrize("randomize, stream_from_disk", test_data, ids=ids)
+def test_mixed_sparse_dense_shards(randomize, stream_from_disk):
+    pipeline_folder = 'test_pipeline'
+    data_folder_name = 'mixed_shards'
+    base_path = join(get_data_path(), pipeline_folder, data_folder_name)
+    if os.path.exists(base_path):
+        shutil.rmtree(base_path)
+    os.makedirs(base_path)
+
+    # the first shard is mostly padding and is saved in CSR form, the second one is dense
+    rdm = np.random.RandomState(1)
+    n, max_length = 40, 20
+    X_len = np.int32(np.r_[rdm.randint(1, 5, n//2), rdm.randint(15, 21, n//2)])
+    X = np.zeros((n, max_length), dtype=np.int32)
+    for i, l in enumerate(X_len):
+        X[i, :l] = rdm.randint(1, 100, l)
+    config = {'paths' : [], 'counts' : [n//2, n//2], 'fractions' : [0.5, 0.5], 'max_lengths' : {'input' : max_length}}
+    for shard, rows in enumerate([slice(0, n//2), slice(n//2, n)]):
+        paths = [join(base_path, name + '_' + str(shard+1) + '.hdf5') for name in ['input', 'input_lengths', 'index']]
+        for path, data in zip(paths, [X[rows], X_len[rows], np.arange(n, dtype=np.int32)[rows]]):
+            save_data(path, data)
+        config['paths'].append(paths)
+    with open(join(base_path, 'hdf5_config.pkl'), 'wb') as f:
+        pickle.dump(config, f)
+    assert isinstance(load_data(config['paths'][0][0], keep_sparse=True), csr_matrix), 'The first shard should be sparse!'
+    assert isinstance(load_data(config['paths'][1][0], keep_sparse=True), np.ndarray), 'The second shard should be dense!'
+
+    # batches of 7 rows span both shards
+    batcher = StreamBatcher(pipeline_folder, data_folder_name, 7, loader_threads=2, randomize=randomize, keys=['input'], stream_from_disk=stream_from_disk)
+    del batcher.at_batch_prepared_observers[:]
+    seen = []
+    for x, x_len, idx in batcher:
+        np.testing.assert_array_equal(X[idx], x, 'Input data not equal!')
+        np.testing.assert_array_equal(X_len[idx], x_len, 'Input length data not equal!')
+        seen += idx.tolist()
+    batcher.close()
+    assert len(seen) == batcher.num_batches*7, 'Every batch should be streamed!'
+
+    shutil.rmtree(base_path)
+
 batch_size = [17, 128]
 samples_per_file = [500]
 randomize = [True, False]
@@ -830,8 +1277,11 @@ def test_non_random_stream_batcher(samples_per_file, randomize, batch_size):
     del batcher.at_batch_prepared_observers[:]
 
     # 4. test data equality
+    orders = []
     for epoch in range(epochs):
+        orders.append([])
         for i, (x, x_len, s, s_len, t, t_len, idx) in enumerate(batcher):
+            orders[-1] += idx.tolist()
             assert np.int32 == x_len.dtype, 'Input length type should be int32!'
             assert np.int32 == s_len.dtype, 'Support length type should be int32!'
             assert np.int32 == x.dtype, 'Input type should be int32!'
@@ -843,10 +1293,374 @@ def test_non_random_stream_batcher(samples_per_file, randomize, batch_size):
             np.testing.assert_array_equal(X[idx], x, 'Input data not equal!')
             np.testing.assert_array_equal(S[idx], s, 'Support data not equal!')
             np.testing.assert_array_equal(T[idx], t, 'Target data not equal!')
+        # every sample is streamed at most once per epoch, also in randomized order
+        assert len(orders[-1]) == batcher.num_batches*batch_size, 'Every batch of the epoch should be streamed!'
+        assert len(set(orders[-1])) == len(orders[-1]), 'No sample should be streamed twice per epoch!'
+        # only full batches are streamed; the remaining rows are dropped
+        assert len(orders[-1]) == n - n % batch_size, 'The rows which do not fill a last batch should be dropped!'
+    if randomize and n % batch_size > 0:
+        dropped = [set(range(n)) - set(order) for order in orders]
+        assert dropped[0] != dropped[1], 'Each epoch should drop other rows!'
+    if randomize:
+        assert orders[0] != orders[1], 'Every epoch should have its own order!'
+        assert orders[0] != sorted(orders[0]), 'Samples should be shuffled!'
+
+    # 5. idle loaders wait for work without polling and stop promptly
+    loaders = batcher.loaders
+    batcher.close(timeout=1.0)
+    assert not any([loader.is_alive() for loader in loaders]), 'All loader threads should be stopped!'
+    # shuffled batches are gathered from shards in stored order
+    for paths, shard in batcher.shard_cache.data.items():
+        for path, data in zip(paths, shard):
+            np.testing.assert_array_equal(load_data(path), to_dense(data), 'Cached shards should not be shuffled!')
+
+    # 6. clean up
+    shutil.rmtree(base_path)
 
-    # 5. clean up
+@pytest.mark.parametrize("randomize", [True, False], ids=['randomize=True', 'randomize=False'])
+def test_process_stream_batcher(randomize):
+    tokenizer = nltk.tokenize.WordPunctTokenizer()
+    data_folder_name = 'snli_test'
+    pipeline_folder = 'test_pipeline'
+    base_path = join(get_data_path(), pipeline_folder, data_folder_name)
+    if os.path.exists(base_path):
+        shutil.rmtree(base_path)
+
+    s = DatasetStreamer()
+    s.set_path(get_test_data_path_dict()['snli1k'])
+    s.add_stream_processor(JsonLoaderProcessors())
+    p = Pipeline(pipeline_folder)
+    p.add_token_processor(AddToVocab())
+    p.add_sent_processor(CustomTokenizer(tokenizer.tokenize))
+    p.add_post_processor(ConvertTokenToIdx())
+    p.add_post_processor(SaveStateToList('idx'))
+    streamer = StreamToHDF5(data_folder_name, samples_per_file=300, keys=['input', 'support', 'target'])
+    p.add_post_processor(streamer)
+    state = p.execute(s)
+
+    inp_indices = state['data']['idx']['input']
+    t_indices = state['data']['idx']['target']
+    n = len(inp_indices)
+    X = np.zeros((n, np.max(state['data']['lengths']['input'])), dtype=np.int64)
+    X_len = np.zeros((n), dtype=np.int64)
+    T = np.zeros((n, 1), dtype=np.int64)
+    for i in range(n):
+        X_len[i] = len(inp_indices[i][0])
+        X[i, :X_len[i]] = inp_indices[i][0]
+        T[i] = t_indices[i][0][0]
+
+    batch_size = 32
+    batcher = StreamBatcher(pipeline_folder, data_folder_name, batch_size, randomize=randomize, loader_processes=2)
+    del batcher.at_batch_prepared_observers[:]
+    for epoch in range(2):
+        num_samples = 0
+        for i, (x, x_len, s, s_len, t, t_len, idx) in enumerate(batcher):
+            assert np.int32 == x.dtype, 'Input type should be int32!'
+            np.testing.assert_array_equal(X_len[idx], x_len, 'Input length data not equal!')
+            np.testing.assert_array_equal(X[idx], x, 'Input data not equal!')
+            np.testing.assert_array_equal(T[idx], t, 'Target data not equal!')
+            num_samples += idx.shape[0]
+        assert num_samples == (n // batch_size)*batch_size, 'Every batch of the epoch should be streamed!'
+
+    loaders = batcher.loaders
+    batcher.close()
+    assert not any([loader.is_alive() for loader in loaders]), 'All loader processes should be stopped!'
+
+    # numpy observers run in the loader processes, all others in the consumer
+    class CountBatches(IAtBatchPreparedObservable):
+        def __init__(self):
+            self.count = 0
+
+        def at_batch_prepared(self, str2var):
+            self.count += 1
+            return str2var
+
+    counter = CountBatches()
+    batcher = StreamBatcher(pipeline_folder, data_folder_name, batch_size, randomize=randomize, loader_processes=2, trim_padding=False)
+    del batcher.at_batch_prepared_observers[:]
+    batcher.subscribe_to_batch_prepared_event(TrimPadding())
+    batcher.subscribe_to_batch_prepared_event(DictConverter())
+    batcher.subscribe_to_batch_prepared_event(TargetIdx2MultiTarget(3, 'target', 'target_multi', stop_index=-1))
+    batcher.subscribe_to_batch_prepared_event(counter)
+    for i, str2var in enumerate(batcher):
+        idx = str2var['index']
+        l = np.max(X_len[idx])
+        np.testing.assert_array_equal(X[idx][:, :l], str2var['input'], 'Input should be trimmed to the longest sequence!')
+        assert str2var['target_multi'].shape == (batch_size, 3), 'Multi targets should be added!'
+        assert np.all(str2var['target_multi'][np.arange(batch_size), T[idx, 0]] == 1), 'Multi targets not equal!'
+    assert batcher.num_loader_observers == 3, 'The numpy observers should run in the loader processes!'
+    # prefetched batches of the next epoch may already have been received
+    assert counter.count >= batcher.num_batches, 'Other observers should run in the consumer!'
+    assert len(batcher.slots[0]) >= batch_size*X.shape[1]*4, 'Slots should hold a padded int32 batch!'
+    batcher.close()
+    shutil.rmtree(base_path)
+
+class FailingObserver(IAtBatchPreparedObservable):
+    runs_in_loader_process = True
+
+    def at_batch_prepared(self, batch_parts):
+        if np.any(batch_parts[-1] == 100):
+            raise ValueError('Sample 100 cannot be loaded!')
+        return batch_parts
+
+@pytest.mark.parametrize("loader_processes", [0, 2], ids=['threads', 'processes'])
+def test_loader_errors(loader_processes):
+    tokenizer = nltk.tokenize.WordPunctTokenizer()
+    data_folder_name = 'snli_errors'
+    pipeline_folder = 'test_pipeline'
+    base_path = join(get_data_path(), pipeline_folder, data_folder_name)
+    if os.path.exists(base_path):
+        shutil.rmtree(base_path)
+
+    s = DatasetStreamer()
+    s.set_path(get_test_data_path_dict()['snli1k'])
+    s.add_stream_processor(JsonLoaderProcessors())
+    p = Pipeline(pipeline_folder)
+    p.add_token_processor(AddToVocab())
+    p.add_sent_processor(CustomTokenizer(tokenizer.tokenize))
+    p.add_post_processor(ConvertTokenToIdx())
+    p.add_post_processor(StreamToHDF5(data_folder_name, samples_per_file=300))
+    p.execute(s)
+
+    # errors of the loaders are raised by the consumer instead of blocking it
+    batcher = StreamBatcher(pipeline_folder, data_folder_name, 32, loader_threads=2, loader_processes=loader_processes)
+    del batcher.at_batch_prepared_observers[:]
+    batcher.subscribe_to_batch_prepared_event(FailingObserver())
+    num_batches = 0
+    with pytest.raises(ValueError):
+        for batch_parts in batcher:
+            num_batches += 1
+    assert num_batches == 100 // 32, 'All batches before the failed one should be streamed!'
+    batcher.close()
+    shutil.rmtree(base_path)
+
+class FailingConsumerObserver(FailingObserver):
+    runs_in_loader_process = False
+
+def test_consumer_observer_errors():
+    tokenizer = nltk.tokenize.WordPunctTokenizer()
+    data_folder_name = 'snli_errors'
+    pipeline_folder = 'test_pipeline'
+    base_path = join(get_data_path(), pipeline_folder, data_folder_name)
+    if os.path.exists(base_path):
+        shutil.rmtree(base_path)
+
+    s = DatasetStreamer()
+    s.set_path(get_test_data_path_dict()['snli1k'])
+    s.add_stream_processor(JsonLoaderProcessors())
+    p = Pipeline(pipeline_folder)
+    p.add_token_processor(AddToVocab())
+    p.add_sent_processor(CustomTokenizer(tokenizer.tokenize))
+    p.add_post_processor(ConvertTokenToIdx())
+    p.add_post_processor(StreamToHDF5(data_folder_name, samples_per_file=300))
+    p.execute(s)
+
+    # observers which run in the consumer fail after the batch left the loader processes
+    batcher = StreamBatcher(pipeline_folder, data_folder_name, 32, loader_processes=2)
+    del batcher.at_batch_prepared_observers[:]
+    batcher.subscribe_to_batch_prepared_event(FailingConsumerObserver())
+    num_batches = 0
+    with pytest.raises(ValueError):
+        for batch_parts in batcher:
+            num_batches += 1
+    assert num_batches == 100 // 32, 'All batches before the failed one should be streamed!'
+    # the failed batch is consumed, so the stream goes on with the next one
+    batch_parts = next(batcher)
+    np.testing.assert_array_equal(batch_parts[-1], np.arange(128, 160), 'The batch after the failed one should be streamed!')
+    batcher.close()
+    shutil.rmtree(base_path)
+
+def test_torch_converter_copies_buffers():
+    # int64 and float parts would otherwise share memory with the buffers
+    for copy_buffers in [True, False]:
+        buffers = {'input' : np.arange(12, dtype=np.int64).reshape(3, 4), 'target' : np.ones((3, 2), dtype=np.float32), 'input_length' : np.int32([4, 3, 2])}
+        str2var = TorchConverter(False, copy_buffers).at_batch_prepared(dict(buffers))
+        for x in buffers.values():
+            x[:] = 0
+        shared = [str2var['input'].data.sum() == 0, str2var['target'].data.sum() == 0, str2var['input_length'].sum() == 0]
+        if copy_buffers:
+            assert not any(shared), 'Converted batches should not share memory with reused buffers!'
+        else:
+            assert all(shared), 'Without copy_buffers the batch parts should not be copied!'
+
+def test_prefetch_budget():
+    tokenizer = nltk.tokenize.WordPunctTokenizer()
+    data_folder_name = 'snli_test'
+    pipeline_folder = 'test_pipeline'
+    base_path = join(get_data_path(), pipeline_folder, data_folder_name)
+    if os.path.exists(base_path):
+        shutil.rmtree(base_path)
+
+    s = DatasetStreamer()
+    s.set_path(get_test_data_path_dict()['snli1k'])
+    s.add_stream_processor(JsonLoaderProcessors())
+    p = Pipeline(pipeline_folder)
+    p.add_token_processor(AddToVocab())
+    p.add_sent_processor(CustomTokenizer(tokenizer.tokenize))
+    p.add_post_processor(ConvertTokenToIdx())
+    p.add_post_processor(StreamToHDF5(data_folder_name, samples_per_file=300, keys=['input', 'support', 'target']))
+    p.execute(s)
+
+    batch_size = 16
+    batcher = StreamBatcher(pipeline_folder, data_folder_name, batch_size, loader_threads=4, prefetch_batches=3)
+    del batcher.at_batch_prepared_observers[:]
+    for i, (x, x_len, s, s_len, t, t_len, idx) in enumerate(batcher):
+        np.testing.assert_array_equal(np.arange(i*batch_size, (i+1)*batch_size), idx, 'Batches should be delivered in order!')
+        if i % 10 == 0:
+            # a slow consumer: the loaders fill the budget and then wait
+            start = time.time()
+            while batcher.prefetch_occupancy() < 3 and time.time() - start < 5.0:
+                time.sleep(0.01)
+            time.sleep(0.1)
+            assert batcher.prefetch_occupancy() == 3, 'The loaders should fill but not exceed the prefetch budget!'
+        assert batcher.scheduled_batches - batcher.consumed_batches <= 3, 'No more than prefetch_batches batches should be in flight!'
+    assert i == batcher.num_batches - 1, 'Every batch should be streamed!'
+
+    batcher.close()
     shutil.rmtree(base_path)
 
+def test_bucketed_stream_batcher():
+    tokenizer = nltk.tokenize.WordPunctTokenizer()
+    data_folder_name = 'snli_test'
+    pipeline_folder = 'test_pipeline'
+    base_path = join(get_data_path(), pipeline_folder, data_folder_name)
+    if os.path.exists(base_path):
+        shutil.rmtree(base_path)
+
+    s = DatasetStreamer()
+    s.set_path(get_test_data_path_dict()['snli1k'])
+    s.add_stream_processor(JsonLoaderProcessors())
+    p = Pipeline(pipeline_folder)
+    p.add_token_processor(AddToVocab())
+    p.add_sent_processor(CustomTokenizer(tokenizer.tokenize))
+    p.add_post_processor(ConvertTokenToIdx())
+    p.add_post_processor(SaveStateToList('idx'))
+    # narrow uint8 lengths must not overflow in the padding statistics
+    p.add_post_processor(StreamToHDF5(data_folder_name, samples_per_file=300, keys=['input', 'support', 'target'], narrow_dtypes=True))
+    state = p.execute(s)
+    lengths = np.array([len(x[0]) for x in state['data']['idx']['input']])
+
+    batch_size = 16
+    boundaries = [8, 12, 16, 24]
+    batcher = StreamBatcher(pipeline_folder, data_folder_name, batch_size, bucketing=True, bucket_boundaries=boundaries)
+    del batcher.at_batch_prepared_observers[:]
+    for epoch in range(2):
+        seen = []
+        single_bucket = 0
+        for i, (x, x_len, s, s_len, t, t_len, idx) in enumerate(batcher):
+            np.testing.assert_array_equal(lengths[idx], x_len, 'Input length data not equal!')
+            seen += idx.tolist()
+            single_bucket += len(set(np.digitize(x_len, boundaries))) == 1
+        assert len(seen) == len(set(seen)) == batcher.num_batches*batch_size, 'Every sample should be streamed once per epoch!'
+        assert single_bucket > 0.6*batcher.num_batches, 'Most batches should hold rows of a single bucket!'
+
+    shuffler = batcher.shuffler
+    unbucketed = shuffler.get_padding_efficiency(EpochShuffler(shuffler.counts, batch_size, 2345).plan(0))
+    assert sorted(shuffler.padding_efficiency.keys())[:2] == [0, 1], 'The padding efficiency should be recorded per epoch!'
+    assert 0 < unbucketed < shuffler.padding_efficiency[0] <= 1, 'Bucketing should reduce the padding!'
+    # batches which span two shards are bucketed like the others
+    for batch in shuffler.plan(2):
+        buckets = np.digitize(np.concatenate([shuffler.lengths[shard_idx][rows] for shard_idx, rows in batch]), boundaries)
+        assert buckets.max() - buckets.min() <= 2, 'Batches should not join short and long rows, but found buckets {0}!'.format(sorted(set(buckets)))
+    batcher.close()
+    shutil.rmtree(base_path)
+
+def test_trim_padding():
+    tokenizer = nltk.tokenize.WordPunctTokenizer()
+    data_folder_name = 'snli_test'
+    pipeline_folder = 'test_pipeline'
+    base_path = join(get_data_path(), pipeline_folder, data_folder_name)
+    if os.path.exists(base_path):
+        shutil.rmtree(base_path)
+
+    s = DatasetStreamer()
+    s.set_path(get_test_data_path_dict()['snli1k'])
+    s.add_stream_processor(JsonLoaderProcessors())
+    p = Pipeline(pipeline_folder)
+    p.add_token_processor(AddToVocab())
+    p.add_sent_processor(CustomTokenizer(tokenizer.tokenize))
+    p.add_post_processor(ConvertTokenToIdx())
+    p.add_post_processor(SaveStateToList('idx'))
+    p.add_post_processor(StreamToHDF5(data_folder_name, samples_per_file=300, keys=['input', 'support', 'target']))
+    state = p.execute(s)
+    inp_indices = state['data']['idx']['input']
+    n = len(inp_indices)
+    X = np.zeros((n, max([len(x[0]) for x in inp_indices])), dtype=np.int64)
+    for i in range(n):
+        X[i, :len(inp_indices[i][0])] = inp_indices[i][0]
+
+    batch_size = 32
+    batcher = StreamBatcher(pipeline_folder, data_folder_name, batch_size, randomize=True, trim_padding=True)
+    assert isinstance(batcher.at_batch_prepared_observers[0], TrimPadding), 'Padding should be trimmed before any other stage!'
+    trimmed = 0
+    for i, (x, x_len, s, s_len, t, t_len, idx) in enumerate(batcher):
+        assert x.shape[1] == np.max(x_len), 'Inputs should be padded to the batch max length!'
+        assert s.shape[1] == np.max(s_len), 'Supports should be padded to the batch max length!'
+        assert t.shape[1] == 1, 'Targets should keep their shape!'
+        np.testing.assert_array_equal(X[idx, :x.shape[1]], x, 'Input data not equal!')
+        trimmed += x.shape[1] < X.shape[1]
+    assert trimmed > 0, 'Batches should be shorter than the dataset max length!'
+
+    batch = TrimPadding(['input', 'target']).at_batch_prepared([np.ones((2, 10)), np.array([3, 4]), np.ones((2, 1)), np.array([1, 1]), np.arange(2)])
+    assert batch[0].shape == (2, 4) and batch[2].shape == (2, 1), 'Padding should be trimmed to the max length!'
+    batcher.close()
+    shutil.rmtree(base_path)
+
+def test_shard_cache():
+    folder = join(get_data_path(), 'test_shard_cache')
+    if os.path.exists(folder):
+        shutil.rmtree(folder)
+    os.makedirs(folder)
+    shards = []
+    for i in range(3):
+        shards.append([join(folder, 'input_{0}'.format(i)), join(folder, 'index_{0}'.format(i))])
+        save_data(shards[-1][0], np.float32(np.random.randn(1000, 100)))
+        save_data(shards[-1][1], np.arange(1000))
+    shard_bytes = 1000*100*4 + 1000*8
+
+    # room for two shards
+    cache = ShardCache(max_GB=2.5*shard_bytes/(1024.0**3))
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get(shards[0]))) for i in range(8)]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    assert cache.loads == 1, 'Concurrent requests for a shard should read it once!'
+    assert all([result[0] is results[0][0] for result in results]), 'All loaders should share the cached shard!'
+
+    cache.get(shards[1])
+    cache.get(shards[0])
+    np.testing.assert_array_equal(load_data(shards[2][0]), cache.get(shards[2])[0], 'Arrays must be equal')
+    assert cache.loads == 3, 'Cached shards should not be read again!'
+    assert list(cache.data.keys()) == [tuple(shards[0]), tuple(shards[2])], 'The least recently used shard should be evicted!'
+    assert cache.total_bytes == 2*shard_bytes, 'The cache should account for the bytes of its shards!'
+    shutil.rmtree(folder)
+
+def test_shard_cache_registry():
+    GB = 1024**3
+    budget = ShardCacheRegistry.max_GB
+    ShardCacheRegistry.set_budget(10)
+    train = ShardCacheRegistry.register()
+    dev = ShardCacheRegistry.register(0.5)
+    test = ShardCacheRegistry.register(1.0)
+    assert dev.max_bytes == int(0.5*GB), 'Small datasets should get a budget of their full size!'
+    assert test.max_bytes == int(1.0*GB), 'Small datasets should get a budget of their full size!'
+    assert train.max_bytes == int(8.5*GB), 'The largest dataset should get the rest of the budget!'
+    big = ShardCacheRegistry.register(100)
+    assert train.max_bytes == big.max_bytes == int(4.25*GB), 'Large datasets should split the rest evenly!'
+    assert dev.max_bytes == int(0.5*GB), 'Small datasets should stay resident!'
+
+    # a smaller budget evicts shards right away
+    dev.data[('a',)] = [np.zeros(10)]
+    dev.nbytes[('a',)] = 80
+    dev.total_bytes = 80
+    ShardCacheRegistry.set_budget(50.0/GB)
+    assert len(dev.data) == 0 and dev.total_bytes == 0, 'Shards beyond the new budget should be evicted!'
+
+    for cache in [train, dev, test, big]:
+        ShardCacheRegistry.unregister(cache)
+    assert len(ShardCacheRegistry.caches) == 0, 'All caches should be unregistered!'
+    ShardCacheRegistry.set_budget(budget)
+
 def test_abitrary_input_data():
     tokenizer = nltk.tokenize.WordPunctTokenizer()
     base_path = join(get_data_path(), 'test_keys')
@@ -1408,3 +2222,117 @@ def test_batch_streaming_pipeline(batch_size):
             np.testing.assert_array_equal(X[idx], str2var['input'], 'Input data not equal!')
             np.testing.assert_array_equal(S[idx], str2var['support'], 'Support data not equal!')
             np.testing.assert_array_equal(T[idx], str2var['target'], 'Target data not equal!')
+
+
+def test_hashing_vocab_single_pass_stream():
+    tokenizer = nltk.tokenize.WordPunctTokenizer()
+    pipeline_folder = 'test_pipeline'
+    batch_size = 17
+    num_buckets = 1000
+
+    s = DatasetStreamer()
+    s.set_path(get_test_data_path_dict()['snli1k'])
+    s.add_stream_processor(JsonLoaderProcessors())
+    # no fit pass, the hashing vocab needs no vocabulary building
+    p = Pipeline(pipeline_folder, hash_buckets=num_buckets, skip_fit=True)
+    p.add_sent_processor(CustomTokenizer(tokenizer.tokenize))
+    p.add_post_processor(ConvertTokenToIdx())
+
+    v = HashingVocab('test', num_buckets=num_buckets)
+    assert 2 <= v.get_idx('dog') < num_buckets + 2, 'Token index out of the bucket range!'
+    assert v.get_idx('') == 1, 'The empty token should keep index 1!'
+    assert len(v.token2idx) == len(list(v.token2idx)), 'The length of the view should match its items!'
+
+    vocab = p.state['vocab']['general']
+    n = 0
+    with open(get_test_data_path_dict()['snli1k']) as f:
+        lines = [json.loads(line) for line in f]
+    for str2var in p.stream(s, batch_size):
+        for row, idx in enumerate(str2var['index']):
+            tokens = tokenizer.tokenize(lines[idx][0])
+            l = str2var['input_length'][row]
+            assert l == len(tokens), 'Input length data not equal!'
+            np.testing.assert_array_equal([vocab.get_idx(token) for token in tokens], str2var['input'][row, :l], 'Input data not equal!')
+            assert np.all(str2var['input'][row, :l] < num_buckets + 2), 'Token index out of the bucket range!'
+        n += str2var['input'].shape[0]
+
+    assert n == (1000 // batch_size)*batch_size, 'Single pass stream should process every full batch!'
+    assert vocab.num_labels == 3, 'Labels should be added in the transform pass, but found {0}.'.format(vocab.num_labels)
+
+    # without a fit pass there are no lengths to size the shards
+    p = Pipeline(pipeline_folder, hash_buckets=num_buckets, skip_fit=True)
+    p.add_sent_processor(CustomTokenizer(tokenizer.tokenize))
+    p.add_post_processor(ConvertTokenToIdx())
+    p.add_post_processor(StreamToHDF5('test_hashing'))
+    with pytest.raises(ValueError):
+        p.execute(s)
+
+
+def test_embedding_store():
+    folder = join(get_data_path(), 'test_embeddings')
+    if os.path.exists(folder):
+        shutil.rmtree(folder)
+    os.mkdir(folder)
+    text_path = join(folder, 'emb.10d.txt')
+    tokens = ['the', 'a', 'new york', 'dog']
+    X = np.float32(np.random.randn(len(tokens), 10))
+    with open(text_path, 'w') as f:
+        for token, row in zip(tokens, X):
+            f.write(token + ' ' + ' '.join([repr(float(value)) for value in row]) + '\n')
+
+    store = EmbeddingStore.from_text_file(text_path)
+    assert os.path.exists(join(folder, 'emb.10d.npy')), 'Binary embedding matrix was not created!'
+    assert len(store) == 4, 'Store should hold 4 embeddings, but holds {0}.'.format(len(store))
+    assert store.dimension == 10, 'Store dimension should be 10, but was {0}.'.format(store.dimension)
+    for i, token in enumerate(tokens):
+        assert token in store, 'Token {0} not found in the embedding store!'.format(token)
+        np.testing.assert_array_almost_equal(X[i], store.get_vector(token), 5, 'Embedding not equal!')
+    assert store.get_vector('cat') is None, 'Unknown tokens should not have an embedding!'
+
+    # the second load uses the existing binary store
+    store2 = EmbeddingStore.from_text_file(text_path)
+    np.testing.assert_array_equal(store.matrix, store2.matrix, 'Embedding matrix not equal!')
+
+    # bulk matrix construction from the store and from the text file
+    v = Vocab('test')
+    for token in ['dog', 'cat', 'the']:
+        v.add_token(token)
+    E1 = v.load_matrix(10, path=text_path)
+    E2 = xavier_uniform_weight(v.num_token, 10)
+    assert store.fill_matrix(E2, v.token2idx) == 2, 'Two tokens should have pretrained embeddings!'
+    for E in [E1, E2]:
+        assert E.shape == (5, 10), 'Embedding matrix shape should be (5, 10), but was {0}.'.format(E.shape)
+        np.testing.assert_array_almost_equal(X[3], E[v.get_idx('dog')], 5, 'Embedding not equal!')
+        np.testing.assert_array_almost_equal(X[0], E[v.get_idx('the')], 5, 'Embedding not equal!')
+        assert not np.allclose(E[v.get_idx('cat')], 0.0), 'Missing embeddings should be xavier initialized!'
+    shutil.rmtree(folder)
+
+
+def test_vector_cache():
+    # room for exactly three vectors with dimension 4
+    cache = VectorCache(4, 3*4*4)
+    vectors = {}
+    for i, token in enumerate(['a', 'b', 'c']):
+        vectors[token] = np.float32(np.random.randn(4))
+        cache.put(token, vectors[token])
+
+    np.testing.assert_array_equal(vectors['a'], cache.get('a'), 'Cached vector not equal!')
+    # b is now the least recently used entry and gets evicted
+    cache.put('d', np.ones((4,), dtype=np.float32))
+    assert 'b' not in cache, 'The least recently used entry should have been evicted!'
+    assert cache.get('b') is None, 'Evicted entries should be cache misses!'
+    assert len(cache) == 3, 'Cache should hold 3 entries, but holds {0}.'.format(len(cache))
+    assert cache.nbytes <= 3*4*4, 'Cache exceeds its byte budget!'
+    np.testing.assert_array_equal(vectors['c'], cache.get('c'), 'Cached vector not equal!')
+    assert cache.get('d').base is cache.slab, 'Cached vectors should be views into the slab!'
+    assert cache.hits == 3 and cache.misses == 1, 'Hit statistics not correct!'
+    assert cache.hit_rate == 0.75, 'Hit rate should be 0.75, but was {0}.'.format(cache.hit_rate)
+
+    # vectors of the vocab outlive the eviction of their cache entry
+    v = Vocab('test', glove_cache_size_MB=2*4*4/(1024.0**2))
+    v.get_glove_list = lambda token, dimension: vectors.get(token)
+    vec = v.get_glove_vector('a', 4)
+    for token in ['b', 'c']:
+        v.get_glove_vector(token, 4)
+    assert 'a' not in v.glove_cache[4], 'The first vector should have been evicted!'
+    np.testing.assert_array_equal(vectors['a'], vec, 'Returned vectors should not be overwritten by the cache!')
@@ -1,6 +1,7 @@
 from __future__ import print_function
 from spodernet.utils.logger import Logger, GlobalLogger
-from spodernet.utils.util import save_data, load_data, get_data_path
+from spodernet.utils.util import save_data, load_data, get_data_path, save_shard_hdf, load_data_paths, to_dense, get_nbytes, save_npy, load_hdf5_paths, ShardReader, narrow_ints, RaggedArray
+from spodernet.utils.util import benchmark_codecs, select_codec, get_saved_arrays
 from os.path import join
 from scipy.sparse import csr_matrix
 
@@ -68,3 +69,176 @@ def test_sparse_save_load_data(dtype):
         np.testing.assert_array_equal(data1.toarray(), data2, 'Arrays must be equal')
     shutil.rmtree(folder)
 
+def test_keep_sparse_rows():
+    folder = join(get_data_path(), 'test_hdf')
+    if os.path.exists(folder):
+        shutil.rmtree(folder)
+    os.mkdir(folder)
+    # padded index matrices are mostly zeros and are saved in CSR form
+    dense = np.zeros((100, 50), dtype=np.int32)
+    for i in range(100):
+        dense[i, :np.random.randint(1, 20)] = np.random.randint(1, 1000)
+    path = join(folder, str(uuid.uuid4()))
+    save_data(path, dense)
+    data = load_data(path, keep_sparse=True)
+    assert isinstance(data, csr_matrix), 'Sparse data should stay in CSR form!'
+    assert get_nbytes(data) < dense.nbytes, 'CSR data should need less memory than dense data!'
+    np.testing.assert_array_equal(dense[20:37], to_dense(data[20:37]), 'Arrays must be equal')
+    np.testing.assert_array_equal(dense, load_data(path), 'Arrays must be equal')
+    shutil.rmtree(folder)
+
+
+
+test_data = [None, 'gzip', 'lzf']
+ids = ['no compression', 'gzip', 'lzf']
+@pytest.mark.parametrize("compression", test_data, ids=ids)
+def test_save_load_shard(compression):
+    folder = join(get_data_path(), 'test_hdf')
+    if os.path.exists(folder):
+        shutil.rmtree(folder)
+    os.mkdir(folder)
+    path = join(folder, str(uuid.uuid4()))
+    arrays = [np.int32(np.random.randint(0, 100, size=(100, 20))), np.float32(np.random.randn(100)), np.arange(100)]
+    names = ['input', 'input_lengths', 'index']
+    paths = save_shard_hdf(path, names, arrays, chunk_rows=16, compression=compression)
+    assert len(paths) == 3, 'There should be one path for each dataset!'
+    for data1, data2 in zip(arrays, load_data_paths(paths)):
+        np.testing.assert_array_equal(data1, data2, 'Arrays must be equal')
+    np.testing.assert_array_equal(arrays[0], load_data(paths[0]), 'Arrays must be equal')
+    shutil.rmtree(folder)
+
+
+def test_ragged_array():
+    folder = join(get_data_path(), 'test_hdf')
+    if os.path.exists(folder):
+        shutil.rmtree(folder)
+    os.mkdir(folder)
+    rows = [list(range(1, np.random.randint(1, 30))) for i in range(100)]
+    rows[10] = list(range(1, 500))
+    dense = np.zeros((100, 500), dtype=np.int32)
+    for i, row in enumerate(rows):
+        dense[i, :len(row)] = row
+    data1 = RaggedArray.from_rows(rows, np.int32)
+    assert data1.shape == (100, 499), 'Ragged shape should be (100, 499), but was {0}'.format(data1.shape)
+
+    path = join(folder, str(uuid.uuid4()))
+    save_data(path, data1)
+    paths = save_shard_hdf(path + '_shard', ['input'], [data1])
+    for data2 in [load_data(path), load_data_paths(paths)[0]]:
+        assert isinstance(data2, RaggedArray), 'Ragged data should be loaded as ragged array!'
+        np.testing.assert_array_equal(data1.to_dense(), data2.to_dense(), 'Arrays must be equal')
+
+    # batches are only padded to their own max length
+    batch = data1[20:37].to_dense()
+    assert batch.shape[1] < 30, 'Batch should be padded to the batch max length!'
+    np.testing.assert_array_equal(dense[20:37, :batch.shape[1]], batch, 'Arrays must be equal')
+    idx = np.array([10, 3, 99])
+    np.testing.assert_array_equal(dense[idx, :499], data1[idx].to_dense(), 'Arrays must be equal')
+    joined = RaggedArray.concatenate([data1[90:], data1[:5]])
+    np.testing.assert_array_equal(dense[list(range(90, 100)) + list(range(5)), :29], joined.to_dense(29), 'Arrays must be equal')
+    shutil.rmtree(folder)
+
+def test_save_load_npy():
+    folder = join(get_data_path(), 'test_hdf')
+    if os.path.exists(folder):
+        shutil.rmtree(folder)
+    os.mkdir(folder)
+    data1 = np.float32(np.random.randn(100, 20))
+    path = join(folder, str(uuid.uuid4()) + '.npy')
+    save_npy(path, data1)
+    data2 = load_data(path)
+    assert isinstance(data2, np.memmap), 'Npy shards should be memory-mapped!'
+    np.testing.assert_array_equal(data1[10:20], data2[10:20], 'Arrays must be equal')
+
+    rows = [list(range(1, np.random.randint(2, 30))) for i in range(100)]
+    data1 = RaggedArray.from_rows(rows, np.int32)
+    path = join(folder, str(uuid.uuid4()) + '.npy')
+    save_npy(path, data1)
+    data2 = load_data(path)
+    assert isinstance(data2.values, np.memmap), 'Ragged values should be memory-mapped!'
+    np.testing.assert_array_equal(data1[5:50].to_dense(), data2[5:50].to_dense(), 'Arrays must be equal')
+    del data2
+    shutil.rmtree(folder)
+
+def test_shard_reader_rows():
+    folder = join(get_data_path(), 'test_hdf')
+    if os.path.exists(folder):
+        shutil.rmtree(folder)
+    os.mkdir(folder)
+    dense = np.float32(np.random.randn(100, 20))
+    sparse = np.zeros((100, 50), dtype=np.int32)
+    for i in range(100):
+        sparse[i, :np.random.randint(1, 20)] = np.random.randint(1, 1000)
+    rows = [[list(range(1, np.random.randint(2, 10))) for j in range(np.random.randint(1, 5))] for i in range(100)]
+    nested = RaggedArray.from_nested_rows(rows, np.int32)
+
+    paths = []
+    for data in [dense, sparse, nested]:
+        paths.append(join(folder, str(uuid.uuid4())))
+        save_data(paths[-1], data)
+    paths += save_shard_hdf(join(folder, 'shard.hdf5'), ['dense', 'nested'], [dense, nested], chunk_rows=8)
+    for name, data in [('dense.npy', dense), ('nested.npy', nested)]:
+        paths.append(join(folder, name))
+        save_npy(paths[-1], data)
+
+    reader = ShardReader(max_open_files=2)
+    for start, end in [(0, 10), (33, 71), (90, None), (None, 5)]:
+        expected = [dense[start:end], sparse[start:end], nested[start:end].to_dense(), dense[start:end], nested[start:end].to_dense(), dense[start:end], nested[start:end].to_dense()]
+        for path, data in zip(paths, expected):
+            np.testing.assert_array_equal(data, to_dense(reader.read_rows(path, start, end)), 'Rows must be equal')
+    assert isinstance(reader.read_rows(paths[1], 0, 10, keep_sparse=True), csr_matrix), 'Sparse rows should stay in CSR form!'
+    assert len(reader.files) <= 2, 'The reader should close the least recently used files!'
+    assert sorted(reader.memmaps.keys()) == sorted(paths[-2:]), 'Npy shards should be mapped once per reader!'
+    reader.close()
+    assert len(reader.memmaps) == 0, 'Closing the reader should drop the mappings!'
+    np.testing.assert_array_equal(dense[:7], load_hdf5_paths(paths[:1], limit=7)[0], 'Rows must be equal')
+    shutil.rmtree(folder)
+
+def test_narrow_ints():
+    assert narrow_ints(np.array([0, 255], dtype=np.int32)).dtype == np.uint8, 'Should fit into uint8!'
+    assert narrow_ints(np.array([0, 256], dtype=np.int32)).dtype == np.uint16, 'Should fit into uint16!'
+    assert narrow_ints(np.array([0, 2**16], dtype=np.int64)).dtype == np.int32, 'Should fit into int32!'
+    assert narrow_ints(np.array([-1, 3], dtype=np.int32)).dtype == np.int32, 'Negative values need a signed type!'
+    assert narrow_ints(np.array([0, 2**40], dtype=np.int64)).dtype == np.int64, 'Values beyond int32 should keep their type!'
+    assert narrow_ints(np.float32([0.5])).dtype == np.float32, 'Floats should keep their type!'
+    data = RaggedArray.from_rows([[1, 2], [300]], np.int32)
+    narrow = narrow_ints(data)
+    assert narrow.dtype == np.uint16, 'Ragged values should be narrowed!'
+    np.testing.assert_array_equal(data.to_dense(), narrow.to_dense(), 'Arrays must be equal')
+    assert narrow_ints(np.array([1, 2], dtype=np.int32), np.uint16).dtype == np.uint16, 'The given dtype should be used!'
+    with pytest.raises(ValueError):
+        narrow_ints(np.array([0, 256], dtype=np.int32), np.uint8)
+
+def test_codec_benchmark():
+    folder = join(get_data_path(), 'test_hdf')
+    if os.path.exists(folder):
+        shutil.rmtree(folder)
+    dense = np.zeros((200, 50), dtype=np.int32)
+    dense[:, :5] = np.random.randint(1, 1000, size=(200, 5))
+    results = benchmark_codecs([dense, np.float32(np.random.randn(200))], folder, repeats=1)
+    assert set(results.keys()) == set(['none', 'lzf', 'gzip']), 'All codecs should be benchmarked!'
+    assert results['gzip']['ratio'] < results['none']['ratio'], 'Gzip should compress padded ids!'
+    assert os.listdir(folder) == [], 'Benchmark files should be removed!'
+
+    # mostly zero data is written in CSR form, so its codec is chosen on the CSR arrays
+    arrays = get_saved_arrays(dense)
+    sparse = csr_matrix(dense)
+    assert len(arrays) == 3, 'Mostly zero data should be saved as CSR data, indices and indptr!'
+    for x1, x2 in zip(arrays, [sparse.data, sparse.indices, sparse.indptr]):
+        np.testing.assert_array_equal(x1, x2, 'CSR arrays not equal!')
+    assert len(get_saved_arrays(np.float32(np.random.randn(200)))) == 1, 'Dense data should be saved as it is!'
+    sparse_results = benchmark_codecs(arrays, folder, repeats=1)
+    assert sparse_results['none']['file_bytes'] < results['none']['file_bytes'], 'CSR files should be smaller than the padded ones!'
+
+    smallest = min(results, key=lambda codec: results[codec]['ratio'])
+    assert select_codec(results, 0.0) == smallest, 'The smallest codec should be selected if no codec is within the budget!'
+    within_budget = [codec for codec in results if results[codec]['ratio'] <= 0.5]
+    assert select_codec(results, 0.5) in within_budget, 'The selected codec should be within the budget!'
+
+    # incompressible data: uncompressed files exceed the memory bytes by their headers
+    results = benchmark_codecs([np.float32(np.random.randn(500000))], folder, codecs=['none', 'gzip'], repeats=2, codec_opts={'gzip' : 9})
+    assert results['none']['ratio'] > 1.0, 'Uncompressed files should have hdf5 headers!'
+    assert select_codec(results, 1.0) == 'none', 'Uncompressed data should be within the default budget!'
+    smallest = min(results, key=lambda codec: results[codec]['ratio'])
+    assert select_codec(results, 0.5) == smallest, 'The measured smallest codec should be selected if no codec is within the budget!'
+    shutil.rmtree(folder)